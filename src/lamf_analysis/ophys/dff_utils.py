@@ -1,28 +1,210 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import numpy as np
+import pandas as pd
 import h5py
 import scipy.stats as stats
 import matplotlib.pyplot as plt
 
 def load_dff_h5(dff_file, remove_nan_rows=True):
-    with h5py.File(dff_file, "r") as f:
-        dff = f["data"][:]
-        roi_names = f["roi_names"][:]
+    # all the data is loaded anyway, so read it once and order the rows in memory
+    # (open_dff_h5 streams the data to order the rows without loading it)
+    dff_lazy = open_dff_h5(dff_file, remove_nan_rows=False, sort_by_percentile=False)
+    dff = np.asarray(dff_lazy)
+    order = _row_order(np.isnan(dff).all(axis=1), np.percentile(dff, 99, axis=1),
+                       remove_nan_rows, sort_by_percentile=True)
+    return dff[order], dff_lazy.roi_names[order]
+
+
+def open_dff_h5(dff_file, roi_names=None, frame_window=None, remove_nan_rows=True,
+                sort_by_percentile=True, percentile=99, chunk_rows=None):
+    """Open a dff h5 lazily (see LazyDff); nothing but roi_names is kept in memory
+
+    NaN rows and the percentile sort order are computed by streaming over blocks of rows.
+
+    Parameters
+    ----------
+    dff_file : str or Path
+        h5 file with 'data' (n_rois, n_frames) and 'roi_names'
+    roi_names : array-like, optional
+        ROIs to select (str or bytes), by default None (all)
+    frame_window : tuple, optional
+        (start, end) frames to select, by default None (all)
+    remove_nan_rows : bool, optional
+        If to remove rows that are all NaN (within the frame window), by default True
+    sort_by_percentile : bool, optional
+        If to sort rows by their percentile value, descending, by default True
+    percentile : int, optional
+        Percentile for the sort, by default 99
+    chunk_rows : int, optional
+        Rows per block to stream, by default None (h5 chunk rows, or about 256 MB)
 
+    Returns
+    -------
+    LazyDff
+    """
+    with h5py.File(dff_file, "r") as f:
+        all_roi_names = f["roi_names"][:]
+    if roi_names is None:
+        row_inds = np.arange(len(all_roi_names))
+    else:
+        # h5 string datasets read as bytes; match names as str on both sides
+        name_to_row = {_roi_name_str(name): i for i, name in enumerate(all_roi_names)}
+        missing = [name for name in roi_names if _roi_name_str(name) not in name_to_row]
+        if len(missing) > 0:
+            raise KeyError(f"ROIs not in {dff_file}: {missing}")
+        row_inds = np.array([name_to_row[_roi_name_str(name)] for name in roi_names], dtype=int)
+    dff_lazy = LazyDff(dff_file, row_inds, frame_window, chunk_rows=chunk_rows)
+
+    if remove_nan_rows or sort_by_percentile:
+        nan_rows = np.zeros(dff_lazy.shape[0], dtype=bool)
+        top_percentile = np.zeros(dff_lazy.shape[0])
+        for rows, block in dff_lazy.iter_blocks():
+            nan_rows[rows] = np.isnan(block).all(axis=1)
+            if sort_by_percentile:
+                top_percentile[rows] = np.percentile(block, percentile, axis=1)
+        dff_lazy = dff_lazy.select_rows(_row_order(nan_rows, top_percentile, remove_nan_rows,
+                                                   sort_by_percentile))
+    return dff_lazy
+
+
+def _row_order(nan_rows, top_percentile, remove_nan_rows, sort_by_percentile):
+    order = np.arange(len(nan_rows))
     if remove_nan_rows:
-        # if row all nans, remove from dff and roi_names
-        nan_rows = np.isnan(dff).all(axis=1)
-        dff = dff[~nan_rows]
-        roi_names = roi_names[~nan_rows]
+        order = order[~nan_rows]
+    if sort_by_percentile:
+        # descending order
+        order = order[np.argsort(top_percentile[order], axis=0)[::-1]]
+    return order
+
 
-    # sort top 1 percentile of dff values by mean
-    top_1_percentile = np.percentile(dff, 99, axis=1)
-    dff_mean = np.mean(top_1_percentile)
-    # descending order
-    sort_idx = np.argsort(top_1_percentile, axis=0)[::-1]
-    dff = dff[sort_idx]
-    roi_names = roi_names[sort_idx]
+def _roi_name_str(name):
+    return name.decode() if isinstance(name, bytes) else str(name)
 
-    return dff,roi_names
+
+class LazyDff():
+    """Lazy view of (a subset of) the dff h5 'data' dataset
+
+    Rows (in any order) and a frame window are selected without reading data.
+    Data is read on indexing (dff_lazy[rows], dff_lazy[rows, frames]),
+    np.asarray(dff_lazy), or block by block with iter_blocks.
+    Rows and frames are indexed independently (outer indexing, as in h5py),
+    and an int row or frame drops its axis, as in numpy.
+    The h5 file is opened once per read, or once per iteration (iter_blocks, iter_frame_blocks).
+
+    Parameters
+    ----------
+    dff_file : str or Path
+        h5 file with 'data' (n_rois, n_frames) and 'roi_names'
+    row_inds : np.ndarray
+        Rows of 'data' in the view, in the view order
+    frame_window : tuple, optional
+        (start, end) frames, by default None (all)
+    chunk_rows : int, optional
+        Rows per block for iter_blocks, by default None (h5 chunk rows, or about 256 MB)
+    """
+
+    def __init__(self, dff_file, row_inds, frame_window=None, chunk_rows=None):
+        self.dff_file = dff_file
+        self.row_inds = np.asarray(row_inds, dtype=int)
+        with h5py.File(dff_file, "r") as f:
+            n_frames = f["data"].shape[1]
+            self.dtype = f["data"].dtype
+            h5_chunks = f["data"].chunks
+            self.roi_names = f["roi_names"][:][self.row_inds]
+        start, end = (0, n_frames) if frame_window is None else frame_window
+        self.frame_window = (max(0, int(start)), min(n_frames, int(end)))
+        if chunk_rows is None:
+            n_window_frames = max(1, self.frame_window[1] - self.frame_window[0])
+            chunk_rows = h5_chunks[0] if h5_chunks is not None \
+                else max(1, (256 * (2**10)**2) // (n_window_frames * self.dtype.itemsize))
+        self.chunk_rows = chunk_rows
+        self._file = None  # open h5 file during an iteration
+
+    def __getstate__(self):
+        # the open h5 file is not picklable (e.g., to send a view to worker processes)
+        return dict(self.__dict__, _file=None)
+
+    @property
+    def shape(self):
+        return (len(self.row_inds), self.frame_window[1] - self.frame_window[0])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def select_rows(self, rows):
+        """New view with rows (indices into this view) selected, no data read"""
+        selected = LazyDff.__new__(LazyDff)
+        selected.__dict__.update(self.__dict__)
+        selected.row_inds = self.row_inds[rows]
+        selected.roi_names = self.roi_names[rows]
+        selected._file = None
+        return selected
+
+    def __getitem__(self, index):
+        rows, frames = index if isinstance(index, tuple) else (index, slice(None))
+        row_inds = self.row_inds[rows]
+        frame_inds = np.arange(*self.frame_window)[frames]
+        data = self._read_rows(np.atleast_1d(row_inds), np.atleast_1d(frame_inds))
+        # drop the axis of an int index, as numpy
+        if np.ndim(frame_inds) == 0:
+            data = data[:, 0]
+        if np.ndim(row_inds) == 0:
+            data = data[0]
+        return data
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def iter_blocks(self, chunk_rows=None):
+        """Yield (row slice in the view, data block) over blocks of rows"""
+        chunk_rows = self.chunk_rows if chunk_rows is None else chunk_rows
+        with self._keep_open():
+            for start in range(0, self.shape[0], chunk_rows):
+                rows = slice(start, min(self.shape[0], start + chunk_rows))
+                yield rows, self[rows]
+
+    def iter_frame_blocks(self, chunk_frames, frame_range=None):
+        """Yield (frame slice in the view, data block) over blocks of frames, all rows
+
+        frame_range : (start, end) frames in the view to iterate over, by default None (all)
+        """
+        start, end = (0, self.shape[1]) if frame_range is None else frame_range
+        with self._keep_open():
+            for block_start in range(start, end, chunk_frames):
+                frames = slice(block_start, min(end, block_start + chunk_frames))
+                yield frames, self[:, frames]
+
+    @contextmanager
+    def _keep_open(self):
+        """Keep the h5 file open for all the reads within (e.g., of an iteration)"""
+        if self._file is not None:  # already open (nested iteration)
+            yield
+            return
+        with h5py.File(self.dff_file, "r") as f:
+            self._file = f
+            try:
+                yield
+            finally:
+                self._file = None
+
+    def _read_rows(self, row_inds, frame_inds):
+        # h5py reads increasing indices; read the sorted unique rows, then reorder
+        # (only one fancy index per read, so frames are read as their covering range)
+        unique_rows, inverse = np.unique(row_inds, return_inverse=True)
+        if len(unique_rows) == 0 or len(frame_inds) == 0:
+            return np.zeros((len(row_inds), len(frame_inds)), dtype=self.dtype)
+        frame_start, frame_end = frame_inds.min(), frame_inds.max() + 1
+        with self._keep_open():
+            if unique_rows[-1] - unique_rows[0] + 1 == len(unique_rows):
+                data = self._file["data"][unique_rows[0]:unique_rows[-1] + 1, frame_start:frame_end]
+            else:
+                data = self._file["data"][unique_rows, frame_start:frame_end]
+        if not (len(frame_inds) == frame_end - frame_start and np.all(np.diff(frame_inds) == 1)):
+            data = data[:, frame_inds - frame_start]
+        return data[inverse]
 
 
 # def dff_robust_noise(dff_trace):
@@ -177,13 +359,20 @@ def dff_robust_snr(robust_signal, robust_noise):
     mean_snr = np.mean(robust_signal / robust_noise)
     return
 
-def compute_robust_snr_on_dataframe(dataframe):
+def compute_robust_snr_on_dataframe(dataframe, batch=True, n_processes=None, inplace=False):
     """takes a dataframe with a "dff" column that has the dff trace array
         for a cell_specimen_id and for noise uses Robust estimate of std for signal
         uses median deviation, and for robust snr the robust signal / robust noise
 
     Arguments:
-        dataframe {[type]} -- [description]
+        dataframe {pd.DataFrame} -- with a "dff" (or "filtered_events") column of trace arrays
+
+    Keyword Arguments:
+        batch {bool} -- compute all traces at once with robust_noise_signal, instead of
+                        a row-wise apply (default: {True}). Traces are stacked by length.
+        n_processes {int} -- with batch, processes to split the rows over (default: {None})
+        inplace {bool} -- add the columns to the input dataframe (default: {False}).
+                          Otherwise a shallow copy; the trace arrays are not copied.
 
     Returns:
         dataframe -- input dataframe but with the following columns added:
@@ -191,14 +380,30 @@ def compute_robust_snr_on_dataframe(dataframe):
                         "robust_signal"
                         "robust_snr"
     """
-    dataframe = dataframe.copy()
     if 'dff' in dataframe.columns:
         column = 'dff'
     elif 'filtered_events' in dataframe.columns:
         column = 'filtered_events'
-    dataframe['robust_noise'] = dataframe.apply(lambda x: dff_robust_noise(x[column]), axis=1) 
-    dataframe["robust_signal"] = dataframe.apply(lambda x: dff_robust_signal(x[column], x["robust_noise"]), axis=1 )
-    dataframe['robust_snr']  = dataframe['robust_signal'] / dataframe['robust_noise']
+    if not batch:
+        dataframe = dataframe.copy()
+        dataframe['robust_noise'] = dataframe.apply(lambda x: dff_robust_noise(x[column]), axis=1) 
+        dataframe["robust_signal"] = dataframe.apply(lambda x: dff_robust_signal(x[column], x["robust_noise"]), axis=1 )
+        dataframe['robust_snr']  = dataframe['robust_signal'] / dataframe['robust_noise']
+        return dataframe
+
+    if not inplace:
+        dataframe = dataframe.copy(deep=False)
+    traces = dataframe[column].values
+    lengths = np.array([len(trace) for trace in traces], dtype=int)
+    robust_noise = np.full(len(traces), np.nan)
+    robust_signal = np.full(len(traces), np.nan)
+    for length in np.unique(lengths):
+        rows = np.flatnonzero(lengths == length)
+        robust_noise[rows], robust_signal[rows] = robust_noise_signal(
+            np.stack([traces[row] for row in rows]), n_processes=n_processes)
+    dataframe['robust_noise'] = robust_noise
+    dataframe['robust_signal'] = robust_signal
+    dataframe['robust_snr'] = robust_signal / robust_noise
     return dataframe
 
 def top_percentile(dff_trace: np.array, percentile=99):
@@ -230,18 +435,617 @@ def calc_dff_metrics(dff_traces: np.array, roi_ids: list=None) -> dict:
     return metrics
 
 
+SIGMA_MAD_CONVERSION_FACTOR = 1.4826
+DEFAULT_METRICS_CHUNK_BYTES = 512 * (2**10)**2  # 512 MB
 
 
-        
+def calc_dff_metrics_df(dff_traces: np.array, roi_ids: list=None,
+                        percentile=99, max_chunk_bytes=DEFAULT_METRICS_CHUNK_BYTES) -> pd.DataFrame:
+    """Calculate metrics for dff traces array (n_cells, n_frames), all cells at once
+
+    Same metrics as calc_dff_metrics (skewness, top_percentile, robust_noise, robust_signal,
+    robust_snr). Each row is sorted once; every masked median of dff_robust_noise and
+    dff_robust_signal is then a median of a contiguous range of the sorted row, and
+    each MAD is an order statistic of the deviations from it, found by binary search
+    (vectorized over cells). NaN frames are ignored.
+    Rows are processed in chunks of up to max_chunk_bytes.
+
+    Parameters
+    ----------
+    dff_traces : np.array
+        (n_cells, n_frames)
+    roi_ids : list, optional
+        Index of the output, by default None (row index)
+    percentile : int, optional
+        Percentile for top_percentile, by default 99
+    max_chunk_bytes : int, optional
+        Memory for the sorted copy of a chunk of rows, by default DEFAULT_METRICS_CHUNK_BYTES
+
+    Returns
+    -------
+    pd.DataFrame
+        Metrics, one row per cell
+    """
+    dff_traces = np.asarray(dff_traces)
+    n_cells = dff_traces.shape[0]
+    if roi_ids is None:
+        roi_ids = np.arange(n_cells)
+    columns = ['skewness', 'top_percentile', 'robust_noise', 'robust_signal', 'robust_snr']
+    metrics = {column: np.full(n_cells, np.nan) for column in columns}
+    chunk_rows = max(1, int(max_chunk_bytes // max(1, dff_traces[:1].nbytes)))
+    for start in range(0, n_cells, chunk_rows):
+        end = min(n_cells, start + chunk_rows)
+        chunk_metrics = _dff_metrics_sorted(np.sort(dff_traces[start:end], axis=1), percentile)
+        chunk_metrics['skewness'] = _skewness_rows(dff_traces[start:end])
+        for column in columns:
+            metrics[column][start:end] = chunk_metrics[column]
+    return pd.DataFrame(metrics, index=roi_ids, columns=columns)
+
+
+def robust_noise_signal(dff_traces: np.array, n_processes=None,
+                        max_chunk_bytes=DEFAULT_METRICS_CHUNK_BYTES) -> tuple:
+    """Robust noise (dff_robust_noise) and robust signal (dff_robust_signal)
+    of each row of dff_traces (n_cells, n_frames), all rows at once (see calc_dff_metrics_df)
+
+    Parameters
+    ----------
+    dff_traces : np.array
+        (n_cells, n_frames)
+    n_processes : int, optional
+        Processes to split the chunks of rows over, by default None (in process)
+    max_chunk_bytes : int, optional
+        Size of a chunk of rows, by default DEFAULT_METRICS_CHUNK_BYTES
+
+    Returns
+    -------
+    np.array
+        robust_noise, (n_cells,)
+    np.array
+        robust_signal, (n_cells,)
+    """
+    dff_traces = np.asarray(dff_traces)
+    n_cells = dff_traces.shape[0]
+    chunk_rows = max(1, int(max_chunk_bytes // max(1, dff_traces[:1].nbytes)))
+    if (n_processes is not None) and (n_processes > 1):
+        # split so that every process gets work
+        chunk_rows = max(1, min(chunk_rows, int(np.ceil(n_cells / n_processes))))
+    chunks = [dff_traces[start:start + chunk_rows] for start in range(0, n_cells, chunk_rows)]
+    if (n_processes is not None) and (n_processes > 1) and (len(chunks) > 1):
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            results = list(executor.map(_robust_noise_signal_rows, chunks))
+    else:
+        results = [_robust_noise_signal_rows(chunk) for chunk in chunks]
+    robust_noise = np.concatenate([result[0] for result in results] + [np.zeros(0)])
+    robust_signal = np.concatenate([result[1] for result in results] + [np.zeros(0)])
+    return robust_noise, robust_signal
+
+
+def _robust_noise_signal_rows(traces):
+    metrics = _dff_metrics_sorted(np.sort(traces, axis=1))
+    return metrics['robust_noise'], metrics['robust_signal']
+
+
+def _skewness_rows(traces, block_rows=64):
+    """Skewness (scipy.stats.skew, bias=True) of each row, ignoring NaN
+    Moments in float64, over blocks of rows to keep the temporaries small"""
+    skew = np.full(traces.shape[0], np.nan)
+    for start in range(0, traces.shape[0], block_rows):
+        block = traces[start:start + block_rows].astype(np.float64)
+        valid = ~np.isnan(block)
+        n_valid = valid.sum(axis=1)
+        block[~valid] = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            deviation = block - (block.sum(axis=1) / n_valid)[:, None]
+            deviation[~valid] = 0
+            deviation_sq = deviation * deviation
+            m2 = deviation_sq.sum(axis=1) / n_valid
+            m3 = (deviation_sq * deviation).sum(axis=1) / n_valid
+            skew[start:start + block_rows] = np.where(m2 > 0, m3 / (m2 * np.sqrt(m2)), np.nan)
+    return skew
+
+
+def _dff_metrics_sorted(sorted_traces, percentile=99):
+    """top_percentile, robust_noise, robust_signal and robust_snr of row-sorted traces (NaN last)"""
+    n_rows = sorted_traces.shape[0]
+    zeros = np.zeros(n_rows, dtype=int)
+    n_valid = (~np.isnan(sorted_traces)).sum(axis=1)
+    with np.errstate(invalid='ignore'):
+        # percentile, linear interpolation (np.percentile default)
+        position = (percentile / 100) * (n_valid - 1)
+        lower = np.clip(np.floor(position).astype(int), 0, None)
+        upper = np.clip(np.ceil(position).astype(int), 0, None)
+        top_percentile = _take_rows(sorted_traces, lower) + \
+            (_take_rows(sorted_traces, upper) - _take_rows(sorted_traces, lower)) * (position - lower)
+        top_percentile = np.where(n_valid > 0, top_percentile, np.nan)
+
+        # robust noise, first pass: remove big positive peaks (values >= 1.5 * |min|)
+        end_1 = _rows_searchsorted(sorted_traces, 1.5 * np.abs(sorted_traces[:, 0]), 'left', zeros, n_valid)
+        median_1 = _median_of_range(sorted_traces, zeros, end_1)
+        noise_1 = SIGMA_MAD_CONVERSION_FACTOR * _mad_of_range(sorted_traces, zeros, end_1, median_1)
+
+        # second pass: keep |x - median| < 2.5 * robust std
+        start_2 = _rows_searchsorted(sorted_traces, median_1 - 2.5 * noise_1, 'right', zeros, end_1)
+        end_2 = _rows_searchsorted(sorted_traces, median_1 + 2.5 * noise_1, 'left', start_2, end_1)
+        median_2 = _median_of_range(sorted_traces, start_2, end_2)
+        robust_noise = SIGMA_MAD_CONVERSION_FACTOR * _mad_of_range(sorted_traces, start_2, end_2, median_2)
+
+        # robust signal: median of values above median + robust noise
+        median_all = _median_of_range(sorted_traces, zeros, n_valid)
+        start_signal = _rows_searchsorted(sorted_traces, median_all + robust_noise, 'right', zeros, n_valid)
+        robust_signal = np.where(np.isnan(robust_noise), np.nan,
+                                 _median_of_range(sorted_traces, start_signal, n_valid))
+        robust_snr = robust_signal / robust_noise
+    return {'top_percentile': top_percentile, 'robust_noise': robust_noise,
+            'robust_signal': robust_signal, 'robust_snr': robust_snr}
+
+
+def _take_rows(sorted_traces, inds):
+    inds = np.clip(inds, 0, sorted_traces.shape[1] - 1)
+    return sorted_traces[np.arange(sorted_traces.shape[0]), inds].astype(np.float64)
+
+
+def _rows_searchsorted(sorted_traces, values, side, lo, hi):
+    """np.searchsorted of values[i] in sorted_traces[i, lo[i]:hi[i]] (returns absolute index)"""
+    lo = np.array(lo, dtype=int)
+    hi = np.array(hi, dtype=int)
+    values = np.asarray(values)
+    while np.any(lo < hi):
+        active = lo < hi
+        mid = (lo + hi) // 2
+        mid_values = _take_rows(sorted_traces, mid)
+        go_right = (mid_values < values) if side == 'left' else (mid_values <= values)
+        lo = np.where(active & go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+    return lo
+
+
+def _median_of_range(sorted_traces, start, end):
+    """Median of sorted_traces[i, start[i]:end[i]], NaN if empty"""
+    n = end - start
+    median = (_take_rows(sorted_traces, start + (n - 1) // 2) + _take_rows(sorted_traces, start + n // 2)) / 2
+    return np.where(n > 0, median, np.nan)
+
+
+def _mad_of_range(sorted_traces, start, end, center):
+    """Median of |sorted_traces[i, start[i]:end[i]] - center[i]|, NaN if empty"""
+    n = end - start
+    lower = _kth_abs_deviation(sorted_traces, start, end, center, np.clip((n - 1) // 2, 0, None))
+    upper = _kth_abs_deviation(sorted_traces, start, end, center, np.clip(n // 2, 0, None))
+    return np.where(n > 0, (lower + upper) / 2, np.nan)
+
+
+def _kth_abs_deviation(sorted_traces, start, end, center, k):
+    """k-th smallest (0-based) |x - center| over x in sorted_traces[i, start[i]:end[i]]
+
+    Deviations of the values below center (read backwards from the split) and
+    of the values above it are two sorted lists; the k-th smallest of the two is
+    found by binary search on the number taken from the lower list.
+    """
+    split = _rows_searchsorted(sorted_traces, center, 'left', start, end)
+    n_lower = split - start
+    n_upper = end - split
+
+    def lower_dev(i):  # i-th smallest deviation below center
+        return center - _take_rows(sorted_traces, split - 1 - i)
+
+    def upper_dev(i):  # i-th smallest deviation above center
+        return _take_rows(sorted_traces, split + i) - center
+
+    lo = np.clip(k + 1 - n_upper, 0, None)
+    hi = np.minimum(k + 1, n_lower)
+    while np.any(lo < hi):
+        active = lo < hi
+        n_from_lower = (lo + hi) // 2
+        n_from_upper = k + 1 - n_from_lower
+        # too few from the lower list if its next deviation is smaller than the last one taken from the upper list
+        take_more = (lower_dev(n_from_lower) < upper_dev(n_from_upper - 1)) & (n_from_upper > 0)
+        lo = np.where(active & take_more, n_from_lower + 1, lo)
+        hi = np.where(active & ~take_more, n_from_lower, hi)
+    n_from_lower = lo
+    n_from_upper = k + 1 - n_from_lower
+    kth_lower = np.where(n_from_lower > 0, lower_dev(n_from_lower - 1), -np.inf)
+    kth_upper = np.where(n_from_upper > 0, upper_dev(n_from_upper - 1), -np.inf)
+    return np.maximum(kth_lower, kth_upper)
+
+
+def benchmark_dff_metrics(n_cells=1000, n_frames=100_000, n_loop_cells=50, seed=0) -> dict:
+    """Benchmark calc_dff_metrics_df against the per-cell calc_dff_metrics
+    on simulated traces (gaussian noise with sparse exponential transients)
+
+    The per-cell loop runs on n_loop_cells only and is extrapolated to n_cells.
+
+    Returns
+    -------
+    dict
+        'vectorized_s', 'loop_s' (extrapolated), 'speedup',
+        'max_abs_diff' (per metric, over the n_loop_cells)
+    """
+    rng = np.random.default_rng(seed)
+    dff_traces = rng.normal(0, 0.1, (n_cells, n_frames)).astype(np.float32)
+    events = rng.random((n_cells, n_frames)) < 0.01
+    dff_traces[events] += rng.exponential(1, events.sum()).astype(np.float32)
+
+    start_time = time.time()
+    metrics_df = calc_dff_metrics_df(dff_traces)
+    vectorized_s = time.time() - start_time
+
+    start_time = time.time()
+    metrics_loop = pd.DataFrame.from_dict(calc_dff_metrics(dff_traces[:n_loop_cells]), orient='index')
+    loop_s = (time.time() - start_time) * n_cells / n_loop_cells
+
+    max_abs_diff = {column: np.nanmax(np.abs(metrics_df[column].values[:n_loop_cells]
+                                             - metrics_loop[column].values.astype(np.float64)))
+                    for column in metrics_df.columns}
+    return {'vectorized_s': vectorized_s, 'loop_s': loop_s, 'speedup': loop_s / vectorized_s,
+            'max_abs_diff': max_abs_diff}
+
+
+
+####################################################################################################
+# Streaming metrics
+#
+# Metrics of traces too long to hold in memory, from one pass over blocks of frames.
+# Per cell, a quantile sketch (counts in log-spaced bins, DDSketch-like) and running central moments.
+# Both merge exactly, so blocks (e.g., frame ranges read by different workers) can be
+# accumulated separately and merged.
+####################################################################################################
+
+DEFAULT_SKETCH_RELATIVE_ACCURACY = 0.005
+DEFAULT_SKETCH_MIN_VALUE = 1e-4
+DEFAULT_SKETCH_MAX_VALUE = 1e4
+DEFAULT_STREAM_CHUNK_VALUES = 2**22  # values (cells x frames) per block, about 32 MB as float64
+
+
+class DffMetricsAccumulator():
+    """Streaming (mergeable) estimate of the calc_dff_metrics_df metrics
+
+    Values are counted per cell in bins with edges at +-min_value * gamma**k,
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy), plus one bin for |x| < min_value.
+    Memory is (n_cells, n_bins) counts, n_bins = 2 * ceil(log(max_value / min_value) / log(gamma)) + 1
+    (3687 bins by default), independent of the number of frames.
+
+    Error bounds:
+    - Any order statistic (and top_percentile, interpolated between two) is within
+      relative_accuracy * |x| of the exact value x for min_value <= |x| <= max_value,
+      and within min_value for |x| < min_value. Values beyond +-max_value are counted
+      in the last bins (quantiles are clipped to the exact min and max).
+    - robust_noise and robust_signal are medians and MADs of subsets of the binned values,
+      so their error is of the same order (a few relative_accuracy; values within one bin of a
+      threshold (1.5 * |min|, 2.5 * robust std, median + robust noise) can land on the wrong side of it).
+    - skewness, min, max are exact (central moments merged with Pebay's pairwise formulas).
+    NaN values are ignored.
+
+    Parameters
+    ----------
+    n_cells : int
+        Number of rows (cells) of the blocks
+    relative_accuracy : float, optional
+        By default DEFAULT_SKETCH_RELATIVE_ACCURACY
+    min_value : float, optional
+        Smallest |value| with relative accuracy, by default DEFAULT_SKETCH_MIN_VALUE
+    max_value : float, optional
+        Largest |value| with relative accuracy, by default DEFAULT_SKETCH_MAX_VALUE
+    """
+
+    def __init__(self, n_cells, relative_accuracy=DEFAULT_SKETCH_RELATIVE_ACCURACY,
+                 min_value=DEFAULT_SKETCH_MIN_VALUE, max_value=DEFAULT_SKETCH_MAX_VALUE):
+        self.n_cells = n_cells
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self._log_gamma = np.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self._n_log_bins = int(np.ceil(np.log(max_value / min_value) / self._log_gamma))
+        self.counts = np.zeros((n_cells, 2 * self._n_log_bins + 1), dtype=np.int64)
+        self.n = np.zeros(n_cells, dtype=np.int64)
+        self.mean = np.zeros(n_cells)
+        self.m2 = np.zeros(n_cells)  # sum of squared deviations from the mean
+        self.m3 = np.zeros(n_cells)  # sum of cubed deviations from the mean
+        self.min = np.full(n_cells, np.inf)
+        self.max = np.full(n_cells, -np.inf)
+
+    @property
+    def bin_values(self) -> np.ndarray:
+        """Representative value of each bin (increasing)"""
+        gamma = np.exp(self._log_gamma)
+        positive = self.min_value * 2 * gamma**np.arange(1, self._n_log_bins + 1) / (gamma + 1)
+        return np.concatenate([-positive[::-1], [0.], positive])
+
+    def update(self, dff_block):
+        """Add a block of frames, (n_cells, n_block_frames)"""
+        block = np.asarray(dff_block, dtype=np.float64).reshape(self.n_cells, -1)
+        valid = ~np.isnan(block)
+        n_bins = self.counts.shape[1]
+        flat_bins = (np.arange(self.n_cells)[:, None] * n_bins + self._bin_index(block))[valid]
+        self.counts += np.bincount(flat_bins, minlength=self.counts.size).reshape(self.counts.shape)
+
+        n = valid.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(valid, block, 0).sum(axis=1) / n
+            deviation = np.where(valid, block - mean[:, None], 0)
+        deviation_sq = deviation * deviation
+        self._merge_moments(n, np.nan_to_num(mean), deviation_sq.sum(axis=1),
+                            (deviation_sq * deviation).sum(axis=1))
+        self.min = np.minimum(self.min, np.where(valid, block, np.inf).min(axis=1, initial=np.inf))
+        self.max = np.maximum(self.max, np.where(valid, block, -np.inf).max(axis=1, initial=-np.inf))
+        return self
+
+    def merge(self, other):
+        """Merge another accumulator (same cells and sketch parameters) into this one"""
+        if (other.n_cells != self.n_cells) or (other.counts.shape != self.counts.shape) \
+                or (other.relative_accuracy != self.relative_accuracy) or (other.min_value != self.min_value):
+            raise ValueError('Accumulators have different cells or sketch parameters')
+        self.counts += other.counts
+        self._merge_moments(other.n, other.mean, other.m2, other.m3)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    def quantile(self, percentile) -> np.ndarray:
+        """Percentile of each cell (np.percentile linear interpolation), NaN for empty cells"""
+        values = self.bin_values
+        cumulative = np.cumsum(self.counts, axis=1)
+        with np.errstate(invalid='ignore'):
+            position = (percentile / 100) * (self.n - 1)
+            lower = np.floor(position)
+            upper = np.ceil(position)
+            lower_value = _binned_order_statistic(values, cumulative, lower)
+            upper_value = _binned_order_statistic(values, cumulative, upper)
+            value = np.clip(lower_value + (upper_value - lower_value) * (position - lower), self.min, self.max)
+        return np.where(self.n > 0, value, np.nan)
+
+    def skewness(self) -> np.ndarray:
+        """Skewness (scipy.stats.skew, bias=True) of each cell"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m2 = self.m2 / self.n
+            m3 = self.m3 / self.n
+            return np.where(m2 > 0, m3 / (m2 * np.sqrt(m2)), np.nan)
+
+    def metrics(self, percentile=99, roi_ids=None) -> pd.DataFrame:
+        """Metrics as in calc_dff_metrics_df, one row per cell
+
+        Parameters
+        ----------
+        percentile : int, optional
+            Percentile for top_percentile, by default 99
+        roi_ids : list, optional
+            Index of the output, by default None (row index)
+
+        Returns
+        -------
+        pd.DataFrame
+            skewness, top_percentile, robust_noise, robust_signal, robust_snr
+        """
+        values = self.bin_values
+        in_bins = self.counts
+        with np.errstate(invalid='ignore'):
+            # robust noise (dff_robust_noise), first pass: remove big positive peaks
+            weights_1 = in_bins * (values[None, :] < 1.5 * np.abs(self.min)[:, None])
+            median_1 = _binned_median(values, weights_1)
+            noise_1 = SIGMA_MAD_CONVERSION_FACTOR * _binned_mad(values, weights_1, median_1)
+            # second pass: keep |x - median| < 2.5 * robust std
+            weights_2 = weights_1 * (np.abs(values[None, :] - median_1[:, None]) < 2.5 * noise_1[:, None])
+            median_2 = _binned_median(values, weights_2)
+            robust_noise = SIGMA_MAD_CONVERSION_FACTOR * _binned_mad(values, weights_2, median_2)
+            # robust signal: median of values above median + robust noise
+            median_all = _binned_median(values, in_bins)
+            weights_signal = in_bins * ((values[None, :] - median_all[:, None]) > robust_noise[:, None])
+            robust_signal = np.where(np.isnan(robust_noise), np.nan, _binned_median(values, weights_signal))
+            metrics = {'skewness': self.skewness(),
+                       'top_percentile': self.quantile(percentile),
+                       'robust_noise': robust_noise,
+                       'robust_signal': robust_signal,
+                       'robust_snr': robust_signal / robust_noise}
+        if roi_ids is None:
+            roi_ids = np.arange(self.n_cells)
+        return pd.DataFrame(metrics, index=roi_ids)
+
+    def _bin_index(self, block):
+        abs_block = np.abs(block)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k = np.ceil(np.log(abs_block / self.min_value) / self._log_gamma)
+        k = np.clip(np.nan_to_num(k, nan=1, posinf=self._n_log_bins, neginf=1), 1, self._n_log_bins).astype(np.int64)
+        k[abs_block < self.min_value] = 0
+        return self._n_log_bins + np.where(block < 0, -k, k)
+
+    def _merge_moments(self, n_b, mean_b, m2_b, m3_b):
+        n_a = self.n
+        n = n_a + n_b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = mean_b - self.mean
+            mean = np.where(n > 0, self.mean + delta * n_b / n, 0)
+            m2 = self.m2 + m2_b + delta**2 * n_a * n_b / n
+            m3 = self.m3 + m3_b + delta**3 * n_a * n_b * (n_a - n_b) / n**2 \
+                + 3 * delta * (n_a * m2_b - n_b * self.m2) / n
+        self.m2 = np.where(n > 0, m2, 0)
+        self.m3 = np.where(n > 0, m3, 0)
+        self.mean = mean
+        self.n = n
+
+
+def calc_dff_metrics_streaming(dff_file, roi_names=None, frame_window=None, percentile=99,
+                               chunk_frames=None, n_processes=None, **sketch_kwargs) -> pd.DataFrame:
+    """Metrics of a dff h5 (as calc_dff_metrics_df) in one streaming pass over blocks of frames
+
+    Only one block of frames (and the per-cell sketches) is in memory at a time.
+    With n_processes, the frame window is split into contiguous ranges, each accumulated
+    in a separate process, and the accumulators are merged. See DffMetricsAccumulator for the error bounds.
+
+    Parameters
+    ----------
+    dff_file : str or Path
+        h5 file with 'data' (n_rois, n_frames) and 'roi_names'
+    roi_names : array-like, optional
+        ROIs to select, by default None (all)
+    frame_window : tuple, optional
+        (start, end) frames to select, by default None (all)
+    percentile : int, optional
+        Percentile for top_percentile, by default 99
+    chunk_frames : int, optional
+        Frames per block, by default None (about DEFAULT_STREAM_CHUNK_VALUES values per block)
+    n_processes : int, optional
+        Processes to split the frames over, by default None (in process)
+    sketch_kwargs : dict
+        relative_accuracy, min_value, max_value of DffMetricsAccumulator
+
+    Returns
+    -------
+    pd.DataFrame
+        Metrics, indexed by roi name
+    """
+    dff_lazy = open_dff_h5(dff_file, roi_names=roi_names, frame_window=frame_window,
+                           remove_nan_rows=False, sort_by_percentile=False)
+    n_cells, n_frames = dff_lazy.shape
+    if chunk_frames is None:
+        chunk_frames = max(1, DEFAULT_STREAM_CHUNK_VALUES // max(1, n_cells))
+    n_ranges = 1 if n_processes is None else max(1, min(n_processes, int(np.ceil(n_frames / chunk_frames))))
+    edges = np.linspace(0, n_frames, n_ranges + 1).astype(int)
+    frame_ranges = list(zip(edges[:-1], edges[1:]))
+    args = [(dff_lazy, frame_range, chunk_frames, sketch_kwargs) for frame_range in frame_ranges]
+    if n_ranges > 1:
+        with ProcessPoolExecutor(max_workers=n_ranges) as executor:
+            accumulators = list(executor.map(_accumulate_dff_frames, *zip(*args)))
+    else:
+        accumulators = [_accumulate_dff_frames(*args[0])]
+    accumulator = accumulators[0]
+    for other in accumulators[1:]:
+        accumulator.merge(other)
+    return accumulator.metrics(percentile=percentile, roi_ids=dff_lazy.roi_names)
+
+
+def _accumulate_dff_frames(dff_lazy, frame_range, chunk_frames, sketch_kwargs):
+    accumulator = DffMetricsAccumulator(dff_lazy.shape[0], **sketch_kwargs)
+    for _, block in dff_lazy.iter_frame_blocks(chunk_frames, frame_range=frame_range):
+        accumulator.update(block)
+    return accumulator
+
+
+def _binned_order_statistic(values, cumulative, rank):
+    """Value of the rank-th (0-based) smallest element per row, from cumulative bin counts
+    values: (n_bins,) shared or (n_rows, n_bins), sorted along the bins"""
+    rank = np.nan_to_num(rank, nan=-1)
+    inds = np.minimum((cumulative <= rank[:, None]).sum(axis=1), cumulative.shape[1] - 1)
+    if values.ndim == 1:
+        return values[inds]
+    return np.take_along_axis(values, inds[:, None], axis=1)[:, 0]
+
+
+def _binned_median(values, weights):
+    """Median per row of values (sorted along the bins) weighted by bin counts, NaN if empty"""
+    cumulative = np.cumsum(weights, axis=1)
+    n = cumulative[:, -1]
+    median = (_binned_order_statistic(values, cumulative, (n - 1) // 2)
+              + _binned_order_statistic(values, cumulative, n // 2)) / 2
+    return np.where(n > 0, median, np.nan)
+
+
+def _binned_mad(values, weights, center):
+    """Median absolute deviation from center per row, of values weighted by bin counts"""
+    deviation = np.abs(values[None, :] - center[:, None])
+    order = np.argsort(deviation, axis=1)
+    return _binned_median(np.take_along_axis(deviation, order, axis=1),
+                          np.take_along_axis(weights, order, axis=1))
 
 
 ####################################################################################################
 # Plotting
 ####################################################################################################
 
-def plot_dff_traces_examples(dff_traces, frame_rate = None, save=True, output_folder=None):
+DEFAULT_N_CLIM_SAMPLES = 1_000_000  # values sampled to estimate vmin/vmax
+
+
+def decimate_traces(traces, n_columns, method='mean'):
+    """Decimate traces (n_traces, n_frames) along frames to about n_columns columns (e.g., pixel width)
+
+    Frames are split into n_columns contiguous bins of equal size (the last one can be shorter)
+    and reduced without copying the traces.
+
+    Parameters
+    ----------
+    traces : np.array
+        (n_traces, n_frames)
+    n_columns : int
+        Number of bins; traces with n_frames <= n_columns are returned as is
+    method : str, optional
+        'mean', 'max', or 'minmax' (min and max of each bin, interleaved, 2 columns per bin),
+        by default 'mean'. 'max' and 'minmax' ignore NaN.
+
+    Returns
+    -------
+    np.array
+        Decimated traces
+    np.array
+        Frame (bin center) of each column
+    """
+    traces = np.asarray(traces)
+    n_frames = traces.shape[1]
+    if n_frames <= n_columns:
+        return traces, np.arange(n_frames)
+    bin_frames = int(np.ceil(n_frames / n_columns))
+    starts = np.arange(0, n_frames, bin_frames)
+    sizes = np.diff(np.append(starts, n_frames))
+    centers = starts + (sizes - 1) / 2
+    if method == 'mean':
+        return np.add.reduceat(traces, starts, axis=1, dtype=np.float64) / sizes, centers
+    elif method == 'max':
+        return np.fmax.reduceat(traces, starts, axis=1), centers
+    elif method == 'minmax':
+        decimated = np.empty((traces.shape[0], 2 * len(starts)), dtype=traces.dtype)
+        decimated[:, 0::2] = np.fmin.reduceat(traces, starts, axis=1)
+        decimated[:, 1::2] = np.fmax.reduceat(traces, starts, axis=1)
+        return decimated, np.repeat(centers, 2)
+    raise ValueError(f"method should be 'mean', 'max', or 'minmax', got {method}")
+
+
+def epoch_auc(traces, epoch_frames=500):
+    """Area under the curve (np.trapz) of each epoch of each trace, all at once
+
+    Epochs split the frames as np.array_split(trace, len(trace) / epoch_frames).
+
+    Parameters
+    ----------
+    traces : np.array
+        (n_traces, n_frames)
+    epoch_frames : int, optional
+        Approximate epoch length, by default 500
+
+    Returns
+    -------
+    np.array
+        AUC, (n_traces, n_epochs)
+    np.array
+        Start frame of each epoch, (n_epochs + 1,) with n_frames at the end
+    """
+    traces = np.atleast_2d(traces)
+    n_frames = traces.shape[1]
+    n_epochs = max(1, int(n_frames / epoch_frames))
+    epoch_size, n_extras = divmod(n_frames, n_epochs)
+    sizes = np.full(n_epochs, epoch_size)
+    sizes[:n_extras] += 1
+    bounds = np.concatenate([[0], np.cumsum(sizes)])
+    # trapz with unit spacing: sum minus half of the first and last values
+    auc = np.add.reduceat(traces, bounds[:-1], axis=1, dtype=np.float64) \
+        - (traces[:, bounds[:-1]] + traces[:, bounds[1:] - 1]) / 2
+    return auc, bounds
+
+
+def _subsample_percentile(traces, percentiles, n_samples=DEFAULT_N_CLIM_SAMPLES, seed=0):
+    """np.percentile of traces, from n_samples random values if there are more"""
+    traces = np.asarray(traces)
+    if traces.size <= n_samples:
+        return np.percentile(traces, percentiles)
+    rng = np.random.default_rng(seed)
+    return np.percentile(traces.reshape(-1)[rng.integers(0, traces.size, n_samples)], percentiles)
+
+
+def _axes_pixel_width(fig, ax):
+    return max(1, int(np.ceil(ax.get_window_extent().width)))
+
+
+def plot_dff_traces_examples(dff_traces, frame_rate = None, save=True, output_folder=None,
+                             max_columns=2000):
     """Plot top 10 skew traces, and zoom on most active 1000 frames
 
+    Full traces are min/max decimated to max_columns bins (see decimate_traces).
     """
     sns.set_style("white")
     sns.set_context("talk")
@@ -264,15 +1068,11 @@ def plot_dff_traces_examples(dff_traces, frame_rate = None, save=True, output_fo
 
 
     #for each row in top skew, find index of trace with largest trapz integral
-    active_indices = []
+    auc, epoch_bounds = epoch_auc(dff_traces[top_skew_idx], epoch_frames=500)
+    active_indices = list(np.argmax(auc, axis=1))
     zoom_dff_epochs = []
-    for trace in dff_traces[top_skew_idx]:
-        n_chunks = len(trace) / 500
-        epochs = np.array_split(trace, n_chunks)
-        max_auc_idx = np.argmax([np.trapz(epoch) for epoch in epochs])
-        active_indices.append(max_auc_idx)
-
-        active_dff = epochs[max_auc_idx]
+    for trace, max_auc_idx in zip(dff_traces[top_skew_idx], active_indices):
+        active_dff = trace[epoch_bounds[max_auc_idx]:epoch_bounds[max_auc_idx + 1]]
         active_dff = active_dff[:500]
         zoom_dff_epochs.append(active_dff)
 
@@ -286,7 +1086,9 @@ def plot_dff_traces_examples(dff_traces, frame_rate = None, save=True, output_fo
         skew = np.round(top_skew[i], 2)
         # plot trace
         ax = fig.add_subplot(gs[i, 0])
-        ax.plot(dff_traces[idx, :],linewidth=0.75)
+        # min/max per pixel column keeps the peaks of long traces
+        trace, frames = decimate_traces(dff_traces[idx:idx + 1, :], max_columns, method='minmax')
+        ax.plot(frames, trace[0], linewidth=0.75)
         #ax.set_title(f"Skew: {skew}")
 
         # plot zoom
@@ -309,18 +1111,32 @@ def plot_dff_traces_examples(dff_traces, frame_rate = None, save=True, output_fo
     plt.tight_layout()
 
 import seaborn as sns
-def plot_population_dff(dff_traces, vmin=None, vmax=None, title=None):
+def plot_population_dff(dff_traces, vmin=None, vmax=None, title=None,
+                        max_columns=None, decimate_method='mean', n_clim_samples=DEFAULT_N_CLIM_SAMPLES):
+    """Heatmap of dff traces (n_cells, n_frames)
+
+    Frames are decimated to max_columns (by default the axes width in pixels) before imshow,
+    with decimate_method (see decimate_traces). vmin/vmax default to the 15th/98th percentile,
+    estimated from n_clim_samples random values.
+    """
     sns.set_style("white")
     sns.set_context("poster")
     y_scale = dff_traces.shape[0] / 100 # 100 works for 80 cells
     y_scale = 1.4
     fig, ax = plt.subplots(1, 1, figsize=(25, 10*y_scale))
 
+    if (vmin is None) or (vmax is None):
+        clim = _subsample_percentile(dff_traces, [15, 98], n_samples=n_clim_samples)
     if vmin is None:
-        vmin = np.percentile(dff_traces, 15)
+        vmin = clim[0]
     if vmax is None:
-        vmax = np.percentile(dff_traces, 98)
-    plt.imshow(dff_traces, aspect='auto', cmap='viridis',vmin=vmin, vmax=vmax)
+        vmax = clim[1]
+    if max_columns is None:
+        max_columns = _axes_pixel_width(fig, ax)
+    n_cells, n_frames = dff_traces.shape
+    decimated, _ = decimate_traces(dff_traces, max_columns, method=decimate_method)
+    plt.imshow(decimated, aspect='auto', cmap='viridis',vmin=vmin, vmax=vmax,
+               extent=(-0.5, n_frames - 0.5, n_cells - 0.5, -0.5))
 
     if title is not None:
         plt.title(title)
@@ -343,17 +1159,28 @@ def plot_population_dff(dff_traces, vmin=None, vmax=None, title=None):
 
 
 
-def plot_population_dff_normalize(dff_traces, vmin=None, vmax=None, title=None):
+def plot_population_dff_normalize(dff_traces, vmin=None, vmax=None, title=None,
+                                  max_columns=None, decimate_method='mean'):
+    """Heatmap of dff traces (n_cells, n_frames), each row divided by its max
+
+    Frames are decimated to max_columns (by default the axes width in pixels) before
+    normalizing (by the max of the full row) and imshow.
+    """
     sns.set_context("poster")
     y_scale = dff_traces.shape[0] / 100 # 100 works for 80 cells
     y_scale = 1.2
     fig, ax = plt.subplots(1, 1, figsize=(25, 10*y_scale))
     
+    if max_columns is None:
+        max_columns = _axes_pixel_width(fig, ax)
+    n_cells, n_frames = dff_traces.shape
+    decimated, _ = decimate_traces(dff_traces, max_columns, method=decimate_method)
     # normalize each row to half max
-    dff_traces = dff_traces / np.max(dff_traces, axis=1)[:, None]
+    decimated = decimated / np.max(dff_traces, axis=1)[:, None]
     vmin = 0
     vmax = .4
-    plt.imshow(dff_traces, aspect='auto', cmap='viridis',vmin=vmin, vmax=vmax)
+    plt.imshow(decimated, aspect='auto', cmap='viridis',vmin=vmin, vmax=vmax,
+               extent=(-0.5, n_frames - 0.5, n_cells - 0.5, -0.5))
 
     if title is not None:
         plt.title(title)
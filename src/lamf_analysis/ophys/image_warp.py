@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import cv2
+import numpy as np
+import scipy.ndimage
+
+####################################################################################################
+# Stack warping
+#
+# Apply one affine transformation to every plane of a stack (e.g., a registered z-stack,
+# or a stack of ROI masks), in a thread pool.
+# Kept free of the heavy imaging I/O dependencies, so light modules (e.g., roi_utils) can use it.
+####################################################################################################
+
+
+CV2_INTERPOLATION = {'nearest': cv2.INTER_NEAREST,
+                     'linear': cv2.INTER_LINEAR,
+                     'cubic': cv2.INTER_CUBIC,
+                     'lanczos': cv2.INTER_LANCZOS4}
+
+
+def warp_stack_affine(stack: np.ndarray,
+                      tmat: np.ndarray,
+                      interpolation: str = 'spline',
+                      n_threads: Optional[int] = None,
+                      border_value: float = 0) -> np.ndarray:
+    """Apply one affine transformation to each plane of a stack, in a thread pool
+
+    Same convention as StackReg.transform (tmat maps output to input coordinates).
+    cv2.warpAffine (and scipy.ndimage.affine_transform) release the GIL,
+    so planes are warped in parallel threads.
+
+    Interpolation and how close it is to StackReg.transform (TurboReg cubic B-splines,
+    half-sample symmetric boundaries, 0 where the mapped coordinate is outside
+    about (-0.5, size - 0.5)):
+    - 'spline' (default): scipy.ndimage.affine_transform with order 3 and mode 'reflect',
+      and border_value outside the image decided exactly as TurboReg (_turboreg_inside).
+      Same output (with border_value 0) up to ~3e-7 of the data range at every pixel,
+      borders included, and the same zero pixels. Use it where results should not change
+      from StackReg.transform.
+      About the speed of StackReg.transform, per thread.
+    - 'linear' (cv2.warpAffine, bilinear): faster, but not the same as StackReg.transform,
+      also for translations. The interpolation differs at any pixel, by an amount that depends
+      on the image texture: e.g., up to ~1% of the data range for smooth images, ~20% at sharp
+      edges of pixel noise. Pixels near the border are blended with border_value instead of
+      cut as in TurboReg, so borders and valid-pixel masks differ too.
+    - 'nearest', 'cubic', 'lanczos': cv2.warpAffine interpolation, same border handling as 'linear'.
+
+    Parameters
+    ----------
+    stack : np.ndarray (3D)
+        Stack to warp, (n_planes, height, width)
+    tmat : np.ndarray
+        Affine transformation matrix, 3x3 (e.g., from StackReg) or 2x3
+    interpolation : str, optional
+        'spline', 'nearest', 'linear', 'cubic' or 'lanczos', by default 'spline'
+    n_threads : int, optional
+        Number of threads, by default None (ThreadPoolExecutor default)
+    border_value : float, optional
+        Value of pixels mapped from outside the image, by default 0
+
+    Returns
+    -------
+    np.ndarray (3D)
+        Warped stack. Same dtype as the input if float, otherwise float32.
+    """
+    assert len(stack.shape) == 3
+    if (interpolation not in CV2_INTERPOLATION) and (interpolation != 'spline'):
+        raise ValueError(f"interpolation should be one of {list(CV2_INTERPOLATION) + ['spline']}")
+    matrix = np.asarray(tmat, dtype=np.float64)[:2]
+    dtype = stack.dtype if np.issubdtype(stack.dtype, np.floating) else np.float32
+    warped = np.zeros(stack.shape, dtype=dtype)
+
+    if interpolation == 'spline':
+        # scipy.ndimage uses (row, col) coordinates, tmat uses (x, y)
+        yx_matrix = matrix[::-1, 1::-1]
+        yx_offset = matrix[::-1, 2]
+        outside = ~_turboreg_inside(matrix, stack.shape[1:])
+
+        def _warp_plane(i):
+            plane = scipy.ndimage.affine_transform(
+                stack[i].astype(np.float64), yx_matrix, yx_offset, order=3, mode='reflect')
+            plane[outside] = border_value
+            warped[i] = plane
+    else:
+        flags = CV2_INTERPOLATION[interpolation] | cv2.WARP_INVERSE_MAP
+        dsize = (stack.shape[2], stack.shape[1])
+
+        def _warp_plane(i):
+            warped[i] = cv2.warpAffine(np.ascontiguousarray(stack[i], dtype=dtype), matrix, dsize,
+                                       flags=flags, borderMode=cv2.BORDER_CONSTANT,
+                                       borderValue=border_value)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(_warp_plane, range(stack.shape[0])))
+    return warped
+
+
+def _turboreg_inside(matrix, shape):
+    """Output pixels mapped inside the input image, exactly as TurboReg (StackReg.transform):
+    coordinates accumulated along each row and down the rows, rounded half away from zero,
+    and inside if the rounded index is within the image (so about (-0.5, size - 0.5),
+    with the same floating point decisions at the edges)"""
+    height, width = shape
+
+    def _accumulated(offset, step_u, step_v):
+        row_starts = np.cumsum(np.concatenate([[offset], np.full(height - 1, step_v)]))
+        return np.cumsum(np.column_stack([row_starts, np.full((height, width - 1), step_u)]), axis=1)
+
+    x = _accumulated(matrix[0, 2], matrix[0, 0], matrix[0, 1])
+    y = _accumulated(matrix[1, 2], matrix[1, 0], matrix[1, 1])
+    x_index = np.where(x >= 0, np.trunc(x + 0.5), np.trunc(x - 0.5))
+    y_index = np.where(y >= 0, np.trunc(y + 0.5), np.trunc(y - 0.5))
+    return (x_index >= 0) & (x_index < width) & (y_index >= 0) & (y_index < height)
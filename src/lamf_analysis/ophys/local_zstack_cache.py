@@ -0,0 +1,430 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from dask import compute, delayed
+from dask.distributed import Client
+
+import lamf_analysis.utils as utils
+from lamf_analysis.ophys import zstack
+from lamf_analysis.ophys.scanimage_metadata import file_fingerprint
+
+####################################################################################################
+# Session-level local z-stack preparation
+#
+# Decrosstalk and register all local z-stacks of a session once, in parallel.
+# Each registered stack is saved to a cache directory, with a key json next to it.
+# Key holds the fingerprints of the input z-stacks and the alpha/beta used for decrosstalk,
+# so a stack is recomputed only when its inputs change.
+# Downstream (z-drift, session-to-session drift) read from this cache.
+####################################################################################################
+
+DEFAULT_CACHE_DIR = Path('/root/capsule/scratch/decrosstalked_zstacks')
+
+
+def cached_zstack_fn(opid, cache_dir: Union[Path, str] = DEFAULT_CACHE_DIR) -> Path:
+    """Path to the cached decrosstalked and registered local z-stack of an opid"""
+    return Path(cache_dir) / f'{opid}_decrosstalked_local_zstack_reg.npy'
+
+
+def cached_zstack_key_fn(opid, cache_dir: Union[Path, str] = DEFAULT_CACHE_DIR) -> Path:
+    """Path to the key json of a cached local z-stack"""
+    return Path(cache_dir) / f'{opid}_decrosstalked_local_zstack_reg.json'
+
+
+def opid_from_plane_path(plane_path: Union[Path, str]) -> int:
+    """Ophys plane ID from a plane directory name (e.g., ophys_experiment_<opid> or <opid>)"""
+    return int(Path(plane_path).name.split('_')[-1])
+
+
+def session_plane_pairs(raw_path: Union[Path, str]) -> list:
+    """Get paired planes of a session
+
+    Pairs are the imaging plane groups in the session platform json
+    (<raw_path>/<ophys folder>/*platform.json, 'imaging_plane_groups'),
+    checked against the planes found by utils.plane_paths_from_session.
+
+    Parameters
+    ----------
+    raw_path : Union[Path, str]
+        Path to the raw session directory
+
+    Returns
+    -------
+    list
+        List of (opid, paired_opid) tuples
+    """
+    raw_path = Path(raw_path)
+    opids = {opid_from_plane_path(plane_path)
+             for plane_path in utils.plane_paths_from_session(raw_path, data_level='raw')}
+    ophys_folder = utils.check_ophys_folder(raw_path)
+    platform_json_fns = [] if ophys_folder is None else list(ophys_folder.glob('*platform.json'))
+    if len(platform_json_fns) != 1:
+        raise FileNotFoundError(f'Expected one platform json in the ophys folder of {raw_path}, '
+                                f'found {len(platform_json_fns)}')
+    with open(platform_json_fns[0], 'r') as f:
+        platform = json.load(f)
+
+    plane_pairs = []
+    for plane_group in platform['imaging_plane_groups']:
+        group_opids = [int(plane['experiment_id']) for plane in plane_group['imaging_planes']]
+        if len(group_opids) != 2:
+            raise ValueError(f'Plane group with {len(group_opids)} planes in {platform_json_fns[0]}, '
+                             'cannot pair')
+        missing_opids = set(group_opids) - opids
+        if len(missing_opids) > 0:
+            raise ValueError(f'Planes {sorted(missing_opids)} of a plane group not found in {raw_path}')
+        plane_pairs.append(tuple(group_opids))
+    return plane_pairs
+
+
+def get_paired_opid(raw_path: Union[Path, str], opid: int) -> int:
+    """Ophys plane ID of the plane paired with opid (see session_plane_pairs)"""
+    for plane_pair in session_plane_pairs(raw_path):
+        if int(opid) in plane_pair:
+            return plane_pair[1] if plane_pair[0] == int(opid) else plane_pair[0]
+    raise ValueError(f'{opid} not in any plane group of {raw_path}')
+
+
+def local_zstack_cache_key(raw_path: Union[Path, str],
+                           processed_path: Union[Path, str],
+                           opid: int,
+                           paired_opid: int) -> dict:
+    """Key of a decrosstalked and registered local z-stack
+
+    Parameters
+    ----------
+    raw_path : Union[Path, str]
+        Path to the raw session directory
+    processed_path : Union[Path, str]
+        Path to the processed session directory
+    opid : int
+        Ophys plane ID
+    paired_opid : int
+        Ophys plane ID of the paired plane
+
+    Returns
+    -------
+    dict
+        Key with the input fingerprints and decrosstalk parameters
+    """
+    alpha, beta = zstack.get_alpha_beta_from_json(
+        Path(processed_path) / str(opid) / 'decrosstalk/processing.json')
+    return {'opid': int(opid),
+            'paired_opid': int(paired_opid),
+            'local_zstack': list(file_fingerprint(zstack._local_zstack_fn(raw_path, opid))),
+            'paired_local_zstack': list(file_fingerprint(zstack._local_zstack_fn(raw_path, paired_opid))),
+            'alpha': float(alpha),
+            'beta': float(beta)}
+
+
+def is_cached(opid, key: Optional[dict] = None,
+              cache_dir: Union[Path, str] = DEFAULT_CACHE_DIR) -> bool:
+    """Check if a local z-stack is in the cache (and matches the key, if given)"""
+    stack_fn = cached_zstack_fn(opid, cache_dir)
+    key_fn = cached_zstack_key_fn(opid, cache_dir)
+    if not stack_fn.exists():
+        return False
+    if key is None:
+        return True
+    if not key_fn.exists():
+        return False
+    with open(key_fn, 'r') as f:
+        return json.load(f) == key
+
+
+def load_cached_zstack(opid, cache_dir: Union[Path, str] = DEFAULT_CACHE_DIR,
+                       mmap: bool = False) -> np.ndarray:
+    """Load a decrosstalked and registered local z-stack from the cache
+
+    Parameters
+    ----------
+    opid : int
+        Ophys plane ID
+    cache_dir : Union[Path, str], optional
+        Cache directory, by default DEFAULT_CACHE_DIR
+    mmap : bool, optional
+        If to memory-map the stack (read-only) instead of reading it all, by default False
+
+    Returns
+    -------
+    np.ndarray (3D)
+        decrosstalked and registered local z-stack
+    """
+    stack_fn = cached_zstack_fn(opid, cache_dir)
+    if not stack_fn.exists():
+        raise FileNotFoundError(f'Cached local z-stack not found: {stack_fn}')
+    return np.load(stack_fn, mmap_mode='r' if mmap else None)
+
+
+def prepare_session_local_zstacks(raw_path: Union[Path, str],
+                                  processed_path: Union[Path, str],
+                                  cache_dir: Union[Path, str] = DEFAULT_CACHE_DIR,
+                                  plane_pairs: Optional[list] = None,
+                                  overwrite: bool = False,
+                                  n_processes: Optional[int] = None,
+                                  cpu_buffer: int = 2) -> dict:
+    """Decrosstalk and register all local z-stacks of a session, in parallel
+
+    Each pair of z-stacks is decrosstalked in one pass (zstack.decrosstalk_zstack_pair),
+    then each decrosstalked z-stack is registered (zstack.register_local_z_stack).
+    Results already in the cache with matching keys are not recomputed.
+
+    Parameters
+    ----------
+    raw_path : Union[Path, str]
+        Path to the raw session directory
+    processed_path : Union[Path, str]
+        Path to the processed session directory
+    cache_dir : Union[Path, str], optional
+        Cache directory, by default DEFAULT_CACHE_DIR
+    plane_pairs : list, optional
+        List of (opid, paired_opid), by default None (session_plane_pairs)
+    overwrite : bool, optional
+        If to recompute cached z-stacks, by default False
+    n_processes : int, optional
+        Number of dask worker processes, by default None (os.cpu_count() - cpu_buffer)
+    cpu_buffer : int, optional
+        Buffer for number of processes, by default 2
+
+    Returns
+    -------
+    dict
+        {opid: path to the cached z-stack}
+    """
+    raw_path = Path(raw_path)
+    processed_path = Path(processed_path)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if plane_pairs is None:
+        plane_pairs = session_plane_pairs(raw_path)
+
+    tasks = []
+    for opid, paired_opid in plane_pairs:
+        key = local_zstack_cache_key(raw_path, processed_path, opid, paired_opid)
+        paired_key = local_zstack_cache_key(raw_path, processed_path, paired_opid, opid)
+        if (not overwrite) and is_cached(opid, key, cache_dir) \
+                and is_cached(paired_opid, paired_key, cache_dir):
+            continue
+        decrosstalked = delayed(zstack.decrosstalk_zstack_pair, nout=2)(
+            raw_path, processed_path, opid, paired_opid)
+        tasks.append(delayed(_register_and_cache)(
+            raw_path, decrosstalked[0], key, cache_dir))
+        tasks.append(delayed(_register_and_cache)(
+            raw_path, decrosstalked[1], paired_key, cache_dir))
+
+    if len(tasks) > 0:
+        n_processes = n_processes if n_processes is not None else max(1, os.cpu_count() - cpu_buffer)
+        # the distributed scheduler ignores compute(num_workers=), so size the local cluster
+        with Client(n_workers=n_processes, threads_per_worker=1):
+            compute(*tasks)
+
+    cached_fns = {}
+    for opid, paired_opid in plane_pairs:
+        cached_fns[opid] = cached_zstack_fn(opid, cache_dir)
+        cached_fns[paired_opid] = cached_zstack_fn(paired_opid, cache_dir)
+    return cached_fns
+
+
+def _register_and_cache(raw_path, decrosstalked_zstack, key, cache_dir):
+    opid = key['opid']
+    zstack_reg = zstack.register_local_z_stack(zstack._local_zstack_fn(raw_path, opid),
+                                               local_z_stack=decrosstalked_zstack)
+    stack_fn = cached_zstack_fn(opid, cache_dir)
+    # write to a temporary file first, so readers never see a partial stack
+    temp_fn = stack_fn.with_name(stack_fn.stem + '_tmp.npy')
+    np.save(temp_fn, zstack_reg)
+    os.replace(temp_fn, stack_fn)
+    with open(cached_zstack_key_fn(opid, cache_dir), 'w') as f:
+        json.dump(key, f, indent=4)
+    return stack_fn
+
+
+####################################################################################################
+# Content-addressed array cache
+#
+# Arrays (e.g., registered and preprocessed reference z-stacks for z-drift) are saved as npz,
+# named by a hash of everything they depend on (input fingerprints and parameters).
+# Least recently used files are removed when the cache grows over max_cache_bytes.
+####################################################################################################
+
+DEFAULT_REF_CACHE_DIR = Path('/root/capsule/scratch/ref_zstack_cache')
+DEFAULT_MAX_CACHE_BYTES = 20 * (2**10)**3  # 20 GB
+
+
+def content_key(**key_parts) -> str:
+    """Hash of the key parts (json-serializable), used as the cache file name"""
+    key_str = json.dumps(key_parts, sort_keys=True, default=str)
+    return hashlib.sha1(key_str.encode()).hexdigest()
+
+
+def cache_load(key: str, cache_dir: Union[Path, str] = DEFAULT_REF_CACHE_DIR) -> Optional[dict]:
+    """Load cached arrays, None if not in the cache
+
+    Parameters
+    ----------
+    key : str
+        Cache key (content_key)
+    cache_dir : Union[Path, str], optional
+        Cache directory, by default DEFAULT_REF_CACHE_DIR
+
+    Returns
+    -------
+    dict or None
+        {name: array}
+    """
+    cache_fn = Path(cache_dir) / f'{key}.npz'
+    if not cache_fn.exists():
+        return None
+    with np.load(cache_fn) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    os.utime(cache_fn)  # mark as recently used
+    return arrays
+
+
+def cache_save(key: str, arrays: dict,
+               cache_dir: Union[Path, str] = DEFAULT_REF_CACHE_DIR,
+               max_cache_bytes: int = DEFAULT_MAX_CACHE_BYTES) -> Path:
+    """Save arrays to the cache, then evict old files over max_cache_bytes
+
+    Parameters
+    ----------
+    key : str
+        Cache key (content_key)
+    arrays : dict
+        {name: array}
+    cache_dir : Union[Path, str], optional
+        Cache directory, by default DEFAULT_REF_CACHE_DIR
+    max_cache_bytes : int, optional
+        Maximum total size of the cache, by default DEFAULT_MAX_CACHE_BYTES
+
+    Returns
+    -------
+    Path
+        Path to the cached file
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_fn = cache_dir / f'{key}.npz'
+    temp_fn = cache_dir / f'{key}_tmp.npz'
+    np.savez(temp_fn, **arrays)
+    os.replace(temp_fn, cache_fn)
+    evict_cache(cache_dir, max_cache_bytes, keep=[cache_fn])
+    return cache_fn
+
+
+def evict_cache(cache_dir: Union[Path, str] = DEFAULT_REF_CACHE_DIR,
+                max_cache_bytes: int = DEFAULT_MAX_CACHE_BYTES,
+                keep: Optional[list] = None) -> list:
+    """Remove least recently used cache files until the cache is within max_cache_bytes
+
+    Parameters
+    ----------
+    cache_dir : Union[Path, str], optional
+        Cache directory, by default DEFAULT_REF_CACHE_DIR
+    max_cache_bytes : int, optional
+        Maximum total size of the cache, by default DEFAULT_MAX_CACHE_BYTES
+    keep : list, optional
+        Files not to remove, by default None
+
+    Returns
+    -------
+    list
+        Removed files
+    """
+    keep = [] if keep is None else [Path(fn) for fn in keep]
+    cache_fns = sorted(Path(cache_dir).glob('*.npz'), key=lambda fn: fn.stat().st_mtime)
+    total_bytes = sum(fn.stat().st_size for fn in cache_fns)
+    removed = []
+    for cache_fn in cache_fns:
+        if total_bytes <= max_cache_bytes:
+            break
+        if cache_fn in keep:
+            continue
+        total_bytes -= cache_fn.stat().st_size
+        cache_fn.unlink()
+        removed.append(cache_fn)
+    return removed
+
+
+####################################################################################################
+# In-process array cache
+#
+# Least recently used arrays (e.g., preprocessed z-stacks reused across session pairs)
+# are kept in memory up to max_bytes. Cached arrays are read-only.
+####################################################################################################
+
+DEFAULT_MEMORY_CACHE_BYTES = 4 * (2**10)**3  # 4 GB
+
+
+class ArrayLRUCache():
+    """In-memory LRU cache of arrays with a memory ceiling
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Maximum total size of the cached arrays, by default DEFAULT_MEMORY_CACHE_BYTES
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._arrays = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self._arrays.values())
+
+    def __contains__(self, key) -> bool:
+        return key in self._arrays
+
+    def __len__(self) -> int:
+        return len(self._arrays)
+
+    def get(self, key, compute_fn=None):
+        """Get an array, computing (and caching) it with compute_fn() if not cached
+
+        Parameters
+        ----------
+        key : hashable
+            Cache key
+        compute_fn : Callable, optional
+            Function returning the array, by default None (return None if not cached)
+
+        Returns
+        -------
+        np.ndarray or None
+            Cached array (read-only)
+        """
+        with self._lock:
+            if key in self._arrays:
+                self._arrays.move_to_end(key)
+                return self._arrays[key]
+        if compute_fn is None:
+            return None
+        array = compute_fn()
+        self.put(key, array)
+        return array
+
+    def put(self, key, array: np.ndarray):
+        """Cache an array (made read-only), then evict the least recently used over max_bytes
+        Arrays larger than max_bytes are not cached (and left writeable)."""
+        if array.nbytes > self.max_bytes:
+            return
+        array.flags.writeable = False
+        with self._lock:
+            self._arrays[key] = array
+            self._arrays.move_to_end(key)
+            total_bytes = self.nbytes
+            while total_bytes > self.max_bytes:
+                _, evicted = self._arrays.popitem(last=False)
+                total_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
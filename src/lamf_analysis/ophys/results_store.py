@@ -0,0 +1,326 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterable, Optional, Union
+
+import h5py
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # not POSIX (e.g., Windows)
+    fcntl = None
+
+####################################################################################################
+# Results store
+#
+# A single HDF5 file holding many result dicts, one group per key (e.g., an opid or an opid pair).
+# Arrays (and lists of arrays) are saved as datasets, scalars and strings as attributes.
+# Scalars (plus index fields, e.g., opid, container_id) form a table that can be read
+# as columns across all results, without touching the arrays.
+# Arrays can be loaded lazily (LazyDataset), reading only the requested slices.
+#
+# One writer per store: parallel runners (zdrift, session_to_session_drift) save from the driver
+# process, either results returned by the workers or per-task stores the workers wrote
+# (copy_from). Do the same when adding new runners.
+# Reads and writes also take an fcntl file lock where available (POSIX), against occasional
+# overlapping access (e.g., a notebook reading while a runner writes). The lock is advisory,
+# is not reliable on NFS or shared scratch, and is skipped where fcntl is missing (Windows),
+# so it does not make concurrent writers safe.
+####################################################################################################
+
+
+class ResultsStore():
+    """HDF5 store of result dicts, one group per key
+
+    Parameters
+    ----------
+    store_fn : Union[Path, str]
+        Path to the h5 file, created on the first save
+    """
+
+    def __init__(self, store_fn: Union[Path, str]):
+        self.store_fn = Path(store_fn)
+
+    def keys(self) -> list:
+        """Keys of the stored results"""
+        if not self.store_fn.exists():
+            return []
+        with self._open('r') as h:
+            return list(h.keys())
+
+    def __contains__(self, key) -> bool:
+        if not self.store_fn.exists():
+            return False
+        with self._open('r') as h:
+            return str(key) in h
+
+    def save(self, key, results: dict, index: Optional[dict] = None, overwrite: bool = True):
+        """Save a result dict under a key
+        Save from one process per store (see the module notes).
+
+        Parameters
+        ----------
+        key : str or int
+            Result key
+        results : dict
+            Result dict. None values are kept as None.
+        index : dict, optional
+            Scalar index fields to query by (e.g., opid, container_id), by default None
+        overwrite : bool, optional
+            If to replace an existing result, by default True
+        """
+        self.store_fn.parent.mkdir(parents=True, exist_ok=True)
+        with self._open('a') as h:
+            if str(key) in h:
+                if not overwrite:
+                    raise KeyError(f'{key} already in {self.store_fn}')
+                del h[str(key)]
+            group = h.create_group(str(key))
+            write_results_group(group, results)
+            if index is not None:
+                for field, value in index.items():
+                    group.attrs[field] = value
+                group.attrs['_index_fields'] = np.array(list(index), dtype=h5py.string_dtype())
+
+    def copy_from(self, source, keys: Optional[Iterable] = None, overwrite: bool = True) -> list:
+        """Copy results from another store (h5 group copy, arrays are not loaded in Python)
+        E.g., to merge per-task stores written by parallel workers into this store,
+        from the one process writing it.
+
+        Parameters
+        ----------
+        source : ResultsStore or Union[Path, str]
+            Store to copy from
+        keys : Iterable, optional
+            Keys to copy, by default None (all)
+        overwrite : bool, optional
+            If to replace existing results, by default True
+
+        Returns
+        -------
+        list
+            Keys copied
+        """
+        if not isinstance(source, ResultsStore):
+            source = ResultsStore(source)
+        self.store_fn.parent.mkdir(parents=True, exist_ok=True)
+        copied = []
+        with source._open('r') as source_h, self._open('a') as h:
+            keys = list(source_h.keys()) if keys is None else [str(key) for key in keys]
+            for key in keys:
+                if key in h:
+                    if not overwrite:
+                        raise KeyError(f'{key} already in {self.store_fn}')
+                    del h[key]
+                source_h.copy(source_h[key], h, name=key)
+                copied.append(key)
+        return copied
+
+    def load(self, key, fields: Optional[Iterable[str]] = None, lazy: bool = False) -> dict:
+        """Load a result dict (or some of its fields)
+
+        Parameters
+        ----------
+        key : str or int
+            Result key
+        fields : Iterable[str], optional
+            Fields to load, by default None (all)
+        lazy : bool, optional
+            If to return arrays as LazyDataset (read on indexing or np.asarray), by default False
+
+        Returns
+        -------
+        dict
+            Result dict
+        """
+        with self._open('r') as h:
+            if str(key) not in h:
+                raise KeyError(f'{key} not in {self.store_fn}')
+            group = h[str(key)]
+            if not lazy:
+                return read_results_group(group, fields)
+            array_fields = [field for field in group.keys() if (fields is None) or (field in fields)]
+            scalar_fields = None if fields is None else [field for field in fields
+                                                         if field not in array_fields]
+            results = read_results_group(group, scalar_fields, include_arrays=False)
+        for field in array_fields:
+            results[field] = LazyDataset(self, f'{key}/{field}')
+        return results
+
+    def table(self, fields: Optional[Iterable[str]] = None, **filters) -> pd.DataFrame:
+        """Table of the scalar (and index) fields, one row per key
+
+        Parameters
+        ----------
+        fields : Iterable[str], optional
+            Columns to read, by default None (all scalar fields)
+        filters : dict
+            {field: value or list of values} to select rows, e.g., container_id=...
+
+        Returns
+        -------
+        pd.DataFrame
+            Table indexed by key
+        """
+        rows = {}
+        if self.store_fn.exists():
+            with self._open('r') as h:
+                for key, group in h.items():
+                    rows[key] = {field: _attr_value(value) for field, value in group.attrs.items()
+                                 if (not field.startswith('_'))
+                                 and ((fields is None) or (field in fields) or (field in filters))}
+        table = pd.DataFrame.from_dict(rows, orient='index')
+        for field, value in filters.items():
+            if field not in table.columns:
+                return table.iloc[0:0]
+            values = value if isinstance(value, (list, tuple, np.ndarray)) else [value]
+            table = table[table[field].isin(values)]
+        if fields is not None:
+            table = table.reindex(columns=list(fields))
+        return table
+
+    def read_column(self, field: str, keys: Optional[Iterable] = None) -> dict:
+        """Read one field (scalar or array) of many results
+
+        Parameters
+        ----------
+        field : str
+            Field to read
+        keys : Iterable, optional
+            Keys to read, by default None (all keys with the field)
+
+        Returns
+        -------
+        dict
+            {key: value}, keys not in the store (or without the field) are left out
+        """
+        column = {}
+        if not self.store_fn.exists():
+            return column
+        with self._open('r') as h:
+            keys = list(h.keys()) if keys is None else [str(key) for key in keys]
+            for key in keys:
+                if key not in h:
+                    continue
+                group = h[key]
+                if field in group:
+                    column[key] = group[field][()]
+                elif field in group.attrs:
+                    column[key] = _attr_value(group.attrs[field])
+        return column
+
+    @contextmanager
+    def _open(self, mode):
+        if fcntl is None:
+            with h5py.File(self.store_fn, mode) as h:
+                yield h
+            return
+        lock_fn = self.store_fn.with_name(self.store_fn.name + '.lock')
+        lock_fn.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_fn, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if mode == 'r' else fcntl.LOCK_EX)
+            try:
+                with h5py.File(self.store_fn, mode) as h:
+                    yield h
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class LazyDataset():
+    """Array in a ResultsStore, read only when indexed (or converted with np.asarray)"""
+
+    def __init__(self, store: ResultsStore, path: str):
+        self.store = store
+        self.path = path
+        with store._open('r') as h:
+            self.shape = h[path].shape
+            self.dtype = h[path].dtype
+
+    def __getitem__(self, index):
+        with self.store._open('r') as h:
+            return h[self.path][index]
+
+    def __array__(self, dtype=None):
+        array = self[()]
+        return array if dtype is None else array.astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'LazyDataset({self.store.store_fn}:{self.path}, shape={self.shape}, dtype={self.dtype})'
+
+
+def import_npy_results(store: ResultsStore, npy_fns: Iterable[Union[Path, str]],
+                       key_index_fn: Callable, overwrite: bool = False) -> list:
+    """Move pickled result dicts (np.save of a dict) into a results store
+
+    Parameters
+    ----------
+    store : ResultsStore
+        Store to save to
+    npy_fns : Iterable[Union[Path, str]]
+        npy files, each with a result dict
+    key_index_fn : Callable
+        npy file path -> (key, index dict)
+    overwrite : bool, optional
+        If to replace results already in the store, by default False
+
+    Returns
+    -------
+    list
+        Keys imported
+    """
+    stored_keys = set(store.keys())
+    imported = []
+    for npy_fn in npy_fns:
+        key, index = key_index_fn(Path(npy_fn))
+        if (str(key) in stored_keys) and (not overwrite):
+            continue
+        results = np.load(npy_fn, allow_pickle=True).item()
+        store.save(key, results, index=index)
+        imported.append(key)
+    return imported
+
+
+def write_results_group(group: h5py.Group, results: dict):
+    """Write a result dict to an h5 group
+    Arrays (and lists of arrays) as datasets, the rest as attributes.
+    """
+    none_keys = []
+    for key, value in results.items():
+        if value is None:
+            none_keys.append(key)
+        elif isinstance(value, (np.ndarray, list)):
+            group.create_dataset(key, data=np.asarray(value))
+        else:
+            group.attrs[key] = value
+    group.attrs['_none_keys'] = np.array(none_keys, dtype=h5py.string_dtype())
+
+
+def read_results_group(group: h5py.Group, fields: Optional[Iterable[str]] = None,
+                       include_arrays: bool = True) -> dict:
+    """Read a result dict written by write_results_group"""
+    none_keys = list(group.attrs.get('_none_keys', []))
+    index_fields = list(group.attrs.get('_index_fields', []))
+    if fields is None:
+        fields = [k for k in group.attrs.keys() if (not k.startswith('_')) and (k not in index_fields)]
+        fields += none_keys
+        if include_arrays:
+            fields += list(group.keys())
+    results = {}
+    for field in fields:
+        if field in group:
+            results[field] = group[field][()]
+        elif field in group.attrs:
+            results[field] = _attr_value(group.attrs[field])
+        elif field in none_keys:
+            results[field] = None
+        else:
+            raise KeyError(f'{field} not in {group.name}')
+    return results
+
+
+def _attr_value(value):
+    return value.item() if isinstance(value, np.generic) else value
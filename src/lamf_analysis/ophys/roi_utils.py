@@ -7,6 +7,8 @@ from skimage import measure
 from typing import Union, Tuple
 import cv2
 
+from lamf_analysis.ophys.image_warp import warp_stack_affine
+
 
 ###################################################################################################
 # I/O
@@ -148,11 +150,17 @@ def make_3d_mask_from_2d(mask_im):
 def get_moved_mask_3d(moving_mask_3d,
                       sr, # StackReg object
                       thresholding: Union['num_pix', 'pix_threshold']='num_pix',
-                      pix_threshold=0.5):                 
+                      pix_threshold=0.5,
+                      interpolation='spline',
+                      n_threads=None):
+    # all masks warped at once with the registered transformation (see image_warp.warp_stack_affine),
+    # 'spline' in float64 gives the same masks as sr.transform
+    moved_mask_3d_float = warp_stack_affine(moving_mask_3d.astype(np.float64), sr.get_matrix(),
+                                            interpolation=interpolation, n_threads=n_threads)
     moved_mask_3d = np.zeros(moving_mask_3d.shape)
     for i in range(moving_mask_3d.shape[0]):
         temp_moving_im = moving_mask_3d[i, :, :]
-        temp_moved_im = sr.transform(temp_moving_im)
+        temp_moved_im = moved_mask_3d_float[i, :, :]
         if thresholding == 'pix_threshold':
             temp_moved_im_thresholded = temp_moved_im > pix_threshold
         elif thresholding == 'num_pix':
@@ -0,0 +1,321 @@
+import copy
+import json
+import re
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import h5py
+from ScanImageTiffReader import ScanImageTiffReader
+
+####################################################################################################
+# ScanImage metadata
+#
+# Parse the ScanImage header once per file and cache the result.
+# Cache key is the file fingerprint (resolved path, size, mtime), so a rewritten file is reparsed.
+# (Optional) Persist the parsed header as a sidecar JSON, so a new process can skip parsing.
+# (Optional) Parse only the requested keys, e.g., the few stack keys needed for registration.
+####################################################################################################
+
+# Keys needed to build the typed stack metadata (see stack_metadata_from_si)
+STACK_METADATA_KEYS = ('SI.hStackManager.actualNumSlices',
+                       'SI.hStackManager.actualNumVolumes',
+                       'SI.hStackManager.framesPerSlice',
+                       'SI.hStackManager.zs',
+                       'SI.hStackManager.stackActuator',
+                       'SI.hChannels.channelSave',
+                       'SI.hStackManager.actualStackZStepSize')
+
+SIDECAR_SUFFIX = '.si_metadata.json'
+LRU_CACHE_SIZE = 128
+
+
+def file_fingerprint(file_path: Union[Path, str]) -> tuple:
+    """Fingerprint of a file used as the metadata cache key
+
+    Parameters
+    ----------
+    file_path : Union[Path, str]
+        Path to the file
+
+    Returns
+    -------
+    tuple
+        (resolved path, size in bytes, modification time in ns)
+    """
+    file_path = Path(file_path).resolve()
+    stat = file_path.stat()
+    return (str(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+def scanimage_metadata(file_path: Union[Path, str],
+                       keys: Optional[Iterable[str]] = None,
+                       sidecar_dir: Optional[Union[Path, str]] = None) -> dict:
+    """Get ScanImage 'SI' metadata from a tiff or h5 file, cached per file
+
+    Parameters
+    ----------
+    file_path : Union[Path, str]
+        Path to ScanImage tiff, or h5 with 'scanimage_metadata' dataset
+    keys : Iterable[str], optional
+        Keys to parse, by default None (all keys).
+        Missing keys are not included in the output.
+    sidecar_dir : Union[Path, str], optional
+        Directory for the sidecar JSON, by default None (no sidecar)
+
+    Returns
+    -------
+    dict
+        ScanImage metadata. Each value still a string (or bool), so convert if needed.
+        A copy, so it can be modified without changing the cache.
+    """
+    fingerprint = file_fingerprint(file_path)
+    sidecar_dir = _str_or_none(sidecar_dir)
+    if keys is None:
+        si_metadata, _ = _full_metadata(fingerprint, sidecar_dir)
+        return copy.deepcopy(si_metadata)
+
+    keys = tuple(sorted(set(keys)))
+    # reuse a full parse if there is one (or if it goes to the sidecar anyway)
+    if sidecar_dir is None:
+        sidecar_dir = _full_metadata_args.get(fingerprint, None)
+    if (sidecar_dir is not None) or (fingerprint in _full_metadata_args):
+        si_metadata, _ = _full_metadata(fingerprint, sidecar_dir)
+        return copy.deepcopy({k: si_metadata[k] for k in keys if k in si_metadata})
+    return copy.deepcopy(_partial_metadata(fingerprint, keys))
+
+
+def roi_groups_metadata(file_path: Union[Path, str],
+                        sidecar_dir: Optional[Union[Path, str]] = None) -> dict:
+    """Get ScanImage ROI groups metadata from a tiff or h5 file, cached per file
+
+    Parameters
+    ----------
+    file_path : Union[Path, str]
+        Path to ScanImage tiff, or h5 with 'scanimage_metadata' dataset
+    sidecar_dir : Union[Path, str], optional
+        Directory for the sidecar JSON, by default None (no sidecar)
+
+    Returns
+    -------
+    dict
+        ROI groups metadata
+    """
+    _, roi_groups = _full_metadata(file_fingerprint(file_path), _str_or_none(sidecar_dir))
+    return copy.deepcopy(roi_groups)
+
+
+def stack_metadata(file_path: Union[Path, str],
+                   sidecar_dir: Optional[Union[Path, str]] = None) -> dict:
+    """Get typed stack metadata from a ScanImage tiff or h5 file
+    Only the keys in STACK_METADATA_KEYS are parsed (unless already cached).
+
+    Parameters
+    ----------
+    file_path : Union[Path, str]
+        Path to ScanImage tiff, or h5 with 'scanimage_metadata' dataset
+    sidecar_dir : Union[Path, str], optional
+        Directory for the sidecar JSON, by default None (no sidecar)
+
+    Returns
+    -------
+    dict
+        Keys 'num_slices', 'num_volumes', 'frames_per_slice', 'z_steps', 'actuator',
+        'num_channels', 'channels_saved', 'z_step_size'
+    """
+    si_metadata = scanimage_metadata(file_path, keys=STACK_METADATA_KEYS,
+                                     sidecar_dir=sidecar_dir)
+    return stack_metadata_from_si(si_metadata)
+
+
+def stack_metadata_from_si(si_metadata: dict) -> dict:
+    """Convert ScanImage string values to typed stack metadata
+
+    Parameters
+    ----------
+    si_metadata : dict
+        ScanImage metadata, containing at least STACK_METADATA_KEYS
+
+    Returns
+    -------
+    dict
+        Typed stack metadata
+    """
+    stack_metadata = {}
+    stack_metadata['num_slices'] = int(si_metadata['SI.hStackManager.actualNumSlices'])
+    stack_metadata['num_volumes'] = int(si_metadata['SI.hStackManager.actualNumVolumes'])
+    stack_metadata['frames_per_slice'] = int(si_metadata['SI.hStackManager.framesPerSlice'])
+    stack_metadata['z_steps'] = _str_to_float_list(si_metadata['SI.hStackManager.zs'])
+    stack_metadata['actuator'] = si_metadata['SI.hStackManager.stackActuator']
+    channels_saved = [ss for ss in re.split(r'\[|\]| ', str(si_metadata['SI.hChannels.channelSave'])) if len(ss) > 0]
+    channels_saved = [int(cs) for cs in channels_saved if str(int(cs)) == cs]
+    stack_metadata['num_channels'] = len(channels_saved)  # TODO: need to check its validity in a larger batch of data
+    stack_metadata['channels_saved'] = channels_saved
+    stack_metadata['z_step_size'] = float(si_metadata['SI.hStackManager.actualStackZStepSize'])
+    return stack_metadata
+
+
+def parse_scanimage_header(md_string: str,
+                           keys: Optional[Iterable[str]] = None,
+                           parse_roi_groups: bool = True) -> tuple:
+    """Parse a ScanImage tiff header string
+
+    Parameters
+    ----------
+    md_string : str
+        Header string from ScanImageTiffReader.metadata()
+    keys : Iterable[str], optional
+        Keys to parse, by default None (all keys)
+    parse_roi_groups : bool, optional
+        If to parse the ROI groups JSON, by default True
+
+    Returns
+    -------
+    dict
+        si_metadata
+    dict or None
+        roi_groups_dict, None if parse_roi_groups is False
+    """
+    # split si & roi groups, prep for separate parse
+    s = md_string.split("\n{", 1)
+    si_str = s[0]
+    if keys is None:
+        si_metadata = _extract_dict_from_si_string(si_str)
+    else:
+        si_metadata = _extract_keys_from_si_string(si_str, keys)
+    roi_groups_dict = None
+    if parse_roi_groups and len(s) > 1:
+        roi_groups_dict = json.loads("{" + s[1])
+    return si_metadata, roi_groups_dict
+
+
+def clear_cache():
+    """Clear the in-process metadata cache"""
+    _full_metadata.cache_clear()
+    _partial_metadata.cache_clear()
+    _full_metadata_args.clear()
+
+
+####################################################################################################
+# Cache internals
+####################################################################################################
+
+# fingerprint -> sidecar_dir of the recent full parses, to reuse them for key subsets
+# Bounded like the _full_metadata cache it points to (least recently parsed dropped first)
+_full_metadata_args = OrderedDict()
+
+
+@lru_cache(maxsize=LRU_CACHE_SIZE)
+def _full_metadata(fingerprint: tuple, sidecar_dir: Optional[str]) -> tuple:
+    _full_metadata_args[fingerprint] = sidecar_dir
+    _full_metadata_args.move_to_end(fingerprint)
+    while len(_full_metadata_args) > LRU_CACHE_SIZE:
+        _full_metadata_args.popitem(last=False)
+    file_path = Path(fingerprint[0])
+    sidecar_fn = None
+    if sidecar_dir is not None:
+        sidecar_fn = Path(sidecar_dir) / (file_path.name + SIDECAR_SUFFIX)
+        loaded = _read_sidecar(sidecar_fn, fingerprint)
+        if loaded is not None:
+            return loaded
+
+    if _is_h5(file_path):
+        si_metadata, roi_groups = _read_h5_metadata(file_path)
+    else:
+        with ScanImageTiffReader(str(file_path)) as reader:
+            md_string = reader.metadata()
+        si_metadata, roi_groups = parse_scanimage_header(md_string)
+
+    if sidecar_fn is not None:
+        _write_sidecar(sidecar_fn, fingerprint, si_metadata, roi_groups)
+    return si_metadata, roi_groups
+
+
+@lru_cache(maxsize=LRU_CACHE_SIZE)
+def _partial_metadata(fingerprint: tuple, keys: tuple) -> dict:
+    file_path = Path(fingerprint[0])
+    if _is_h5(file_path):
+        # stored as a single JSON string, so no partial parse
+        si_metadata, _ = _full_metadata(fingerprint, None)
+        return {k: si_metadata[k] for k in keys if k in si_metadata}
+    with ScanImageTiffReader(str(file_path)) as reader:
+        md_string = reader.metadata()
+    si_metadata, _ = parse_scanimage_header(md_string, keys=keys, parse_roi_groups=False)
+    return si_metadata
+
+
+def _read_h5_metadata(file_path: Path) -> tuple:
+    with h5py.File(file_path, 'r') as f:
+        if 'scanimage_metadata' not in f:
+            raise ValueError("scanimage_metadata not found in the h5 file")
+        si = f["scanimage_metadata"][()]
+    si = json.loads(si.decode())
+    return si[0], si[1]
+
+
+def _read_sidecar(sidecar_fn: Path, fingerprint: tuple) -> Optional[tuple]:
+    if not sidecar_fn.exists():
+        return None
+    try:
+        with open(sidecar_fn, 'r') as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if tuple(sidecar.get('fingerprint', [])) != tuple(fingerprint):
+        return None
+    return sidecar['si_metadata'], sidecar['roi_groups']
+
+
+def _write_sidecar(sidecar_fn: Path, fingerprint: tuple,
+                   si_metadata: dict, roi_groups: dict):
+    # sidecar is only an optimization; read-only data directories are fine
+    try:
+        sidecar_fn.parent.mkdir(parents=True, exist_ok=True)
+        with open(sidecar_fn, 'w') as f:
+            json.dump({'fingerprint': list(fingerprint),
+                       'si_metadata': si_metadata,
+                       'roi_groups': roi_groups}, f)
+    except OSError:
+        pass
+
+
+def _is_h5(file_path: Path) -> bool:
+    return file_path.suffix.lower() in ['.h5', '.hdf5']
+
+
+def _str_or_none(path: Optional[Union[Path, str]]) -> Optional[str]:
+    return None if path is None else str(path)
+
+
+def _parse_si_value(value: str):
+    value = value.strip()
+    if value == 'true':
+        return True
+    elif value == 'false':
+        return False
+    return value.strip("'")  # Remove leading/trailing single quotes
+
+
+def _extract_dict_from_si_string(string):
+    """Parse the 'SI' variables from a scanimage metadata string"""
+    data_dict = {}
+    for line in string.split('\n'):
+        if line.strip():  # Check if the line is not empty
+            key, value = line.split(' = ', 1)
+            data_dict[key.strip()] = _parse_si_value(value)
+    return data_dict
+
+
+def _extract_keys_from_si_string(string, keys):
+    """Parse only the given 'SI' variables from a scanimage metadata string"""
+    data_dict = {}
+    for key in keys:
+        match = re.search(rf'^\s*{re.escape(key)} = (.*)$', string, re.MULTILINE)
+        if match is not None:
+            data_dict[key] = _parse_si_value(match.group(1))
+    return data_dict
+
+
+def _str_to_float_list(string):
+    return [float(s) for s in string.strip('[]').split()]
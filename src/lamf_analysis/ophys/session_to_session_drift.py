@@ -1,20 +1,43 @@
 import numpy as np
+import os
+import pandas as pd
 from pathlib import Path
 import skimage
+import time
+import traceback
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pystackreg import StackReg
 
 from lamf_analysis.ophys import zstack
+from lamf_analysis.ophys import zdrift
+from lamf_analysis.ophys import results_store
+from lamf_analysis.ophys import local_zstack_cache
+from lamf_analysis.ophys.scanimage_metadata import file_fingerprint
+
+DEFAULT_S2S_DIR = Path('/root/capsule/scratch/session_to_session_diff')
+S2S_STORE_NAME = 'session_to_session_diff.h5'
+DEFAULT_PAIR_STORE_FN = DEFAULT_S2S_DIR / S2S_STORE_NAME
 
 ######################################
 # Session to session drift calculation
 
-def calculate_session_to_session_diff(opid_1, opid_2, n_averaging_planes=10, sr_method='affine'):
+def calculate_session_to_session_diff(opid_1, opid_2, n_averaging_planes=10, sr_method='affine',
+                                      n_candidates=None, coarse_method='phase_correlation', n_processes=None,
+                                      max_plane_offset=None, return_corrcoef_mat=False):
     ''' Calculate the number of planes to shift to align two sessions
     From the second session (opid_2) to the first session (opid_1)
 
     Args:
         opid_1: int, ophys plane index of the first session
         opid_2: int, ophys plane index of the second session
+        n_candidates: int, number of planes of the first z-stack to register with StackReg
+            after coarse scoring (see fov_stack_register_stackreg), None for all planes
+        coarse_method: str, method for the coarse scoring ('phase_correlation' or 'downsampled')
+        n_processes: int, number of processes to register candidate planes in parallel
+        max_plane_offset: int, largest plane offset (in either direction) to search,
+            None for offsets within half the stack. Offsets without overlapping planes are left out.
+        return_corrcoef_mat: bool, whether to also compute the full correlation coefficient matrix
 
     Returns:
     results_info: dict, contains the following keys
@@ -32,8 +55,12 @@ def calculate_session_to_session_diff(opid_1, opid_2, n_averaging_planes=10, sr_
         'corrcoef_mat': np.array (2d), correlation coefficient between
             each plane of the second session z-stack after transformation 
             and each plane of the first session z-stack
+            None unless return_corrcoef_mat
+        'corrcoef_band': np.array (2d), diagonals of corrcoef_mat at plane_offsets
+            (see corrcoef_stack_band)
+        'plane_offsets': np.array, plane offsets (diagonals) searched
         'mean_diag': np.array, mean of the diagonal of
-            the correlation coefficient matrix (corrcoef_mat)
+            the correlation coefficient matrix (corrcoef_mat) at each of plane_offsets
         'stack_to_stack_diff_planes': int, number of planes to shift the second stack
             to align to the first stack
         'sr_method': str, method used for stack registration
@@ -42,33 +69,32 @@ def calculate_session_to_session_diff(opid_1, opid_2, n_averaging_planes=10, sr_
     if opid_1 == opid_2:
         return None
 
-    if sr_method == 'affine':
-        sr = StackReg(StackReg.AFFINE)
-    elif sr_method == 'rigid_body':
-        sr = StackReg(StackReg.RIGID_BODY)
-    else:
+    if sr_method not in ['affine', 'rigid_body']:
         raise ValueError('"sr_method" should be either "affine" or "rigid_body"')
-        
-    stack_1 = get_decrosstalked_registered_local_zstack(opid_1)
-    stack_1 = zstack.med_filt_z_stack(stack_1)
-    stack_1 = zstack.rolling_average_stack(stack_1, n_averaging_planes=n_averaging_planes)
-    stack_2 = get_decrosstalked_registered_local_zstack(opid_2)
-    stack_2 = zstack.med_filt_z_stack(stack_2)
-    stack_2 = zstack.rolling_average_stack(stack_2, n_averaging_planes=n_averaging_planes)
+
+    stack_1 = get_preprocessed_local_zstack(opid_1, n_averaging_planes=n_averaging_planes)
+    stack_2 = get_preprocessed_local_zstack(opid_2, n_averaging_planes=n_averaging_planes)
 
     fov_2 = stack_2[len(stack_2)//2]
-    corrcoef_arr_single, fov_reg, best_tmat, tmat_list, temp_cc = fov_stack_register_stackreg(fov_2, stack_1)
+    corrcoef_arr_single, fov_reg, best_tmat, tmat_list, temp_cc = fov_stack_register_stackreg(
+        fov_2, stack_1, n_candidates=n_candidates, coarse_method=coarse_method, n_processes=n_processes)
 
-    registered_stack = np.zeros_like(stack_2)
-    for zi, zstack_plane in enumerate(stack_2):
-        registered_stack[zi] = sr.transform(zstack_plane, tmat=best_tmat)
+    # 'spline': same as StackReg.transform of each plane, borders included
+    registered_stack = zstack.warp_stack_affine(stack_2, best_tmat,
+                                                interpolation='spline').astype(stack_2.dtype)
 
-    corrcoef_mat = corrcoef_stack(stack_1, registered_stack)
-    delay_range = range(-corrcoef_mat.shape[0]//2 + 1, corrcoef_mat.shape[0]//2 + 1)
-    mean_diag = np.zeros(len(delay_range))
-    for i in range(len(delay_range)):
-        mean_diag[i] = np.mean(np.diag(corrcoef_mat, delay_range[i]))
-    stack_to_stack_diff_planes = -delay_range[np.argmax(mean_diag)]  # be careful about the sign!
+    n_planes = stack_1.shape[0]
+    if max_plane_offset is None:
+        delay_range = range(-n_planes//2 + 1, n_planes//2 + 1)
+    else:
+        delay_range = range(-max_plane_offset, max_plane_offset + 1)
+    # offsets without overlapping planes (e.g., max_plane_offset >= n_planes) would be all NaN
+    delay_range = [offset for offset in delay_range
+                   if -n_planes < offset < registered_stack.shape[0]]
+    corrcoef_band = corrcoef_stack_band(stack_1, registered_stack, list(delay_range))
+    mean_diag = np.nanmean(corrcoef_band, axis=1)
+    stack_to_stack_diff_planes = -delay_range[np.nanargmax(mean_diag)]  # be careful about the sign!
+    corrcoef_mat = corrcoef_stack(stack_1, registered_stack) if return_corrcoef_mat else None
 
     results_info = {'corrcoef_arr_single': corrcoef_arr_single,
                     'fov_reg': fov_reg,
@@ -76,29 +102,58 @@ def calculate_session_to_session_diff(opid_1, opid_2, n_averaging_planes=10, sr_
                     'tmat_list': tmat_list,
                     'temp_cc': temp_cc,
                     'corrcoef_mat': corrcoef_mat,
+                    'corrcoef_band': corrcoef_band,
+                    'plane_offsets': np.array(delay_range),
                     'mean_diag': mean_diag,
                     'stack_to_stack_diff_planes': stack_to_stack_diff_planes,  # be careful about the sign!
                     'sr_method': sr_method}  
     return results_info
 
 
-def get_decrosstalked_registered_local_zstack(opid, load_dir=Path('/root/capsule/scratch/decrosstalked_zstacks')):
+def get_decrosstalked_registered_local_zstack(opid, load_dir=local_zstack_cache.DEFAULT_CACHE_DIR, mmap=True):
     ''' Get decrosstalked and registered local zstack for a given opid
-    This should be specific for pipeline or data structure
+    Stacks are prepared by local_zstack_cache.prepare_session_local_zstacks
+    Memory-mapped (read-only) by default
+    '''
+    return local_zstack_cache.load_cached_zstack(opid, cache_dir=load_dir, mmap=mmap)
+
 
-    Currently only works in this capsule (id: )
+# Preprocessed stacks shared across pairs (each stack is used in n-1 pairs of a container)
+preprocessed_stack_cache = local_zstack_cache.ArrayLRUCache()
+
+
+def set_preprocessed_stack_cache_bytes(max_bytes):
+    ''' Set the memory ceiling of the preprocessed stack cache (0 to disable caching) '''
+    preprocessed_stack_cache.max_bytes = max_bytes
+    preprocessed_stack_cache.clear()
+
+
+def get_preprocessed_local_zstack(opid, n_averaging_planes=10, load_dir=local_zstack_cache.DEFAULT_CACHE_DIR):
+    ''' Median filtered and rolling averaged local zstack of an opid, cached in memory
+    (preprocessed_stack_cache, keyed by the stack file fingerprint and n_averaging_planes)
+    The returned stack is read-only.
     '''
-    if type(load_dir) == str:
-        load_dir = Path(load_dir)
-    stack_fn = load_dir / f'{opid}_decrosstalked_local_zstack_reg.npy'
-    assert stack_fn.exists()
-    stack = np.load(stack_fn)
-    return stack
+    stack_fn = local_zstack_cache.cached_zstack_fn(opid, load_dir)
+    if not stack_fn.exists():
+        raise FileNotFoundError(f'Cached local z-stack not found: {stack_fn}')
+    key = (file_fingerprint(stack_fn), n_averaging_planes)
+
+    def _preprocess():
+        stack = get_decrosstalked_registered_local_zstack(opid, load_dir=load_dir)
+        stack = zstack.med_filt_z_stack(stack)
+        return zstack.rolling_average_stack(stack, n_averaging_planes=n_averaging_planes)
+
+    return preprocessed_stack_cache.get(key, _preprocess)
 
 
-def fov_stack_register_stackreg(fov, stack, use_clahe=True, sr_method='affine', tmat=None, use_valid_pix=True):
+def fov_stack_register_stackreg(fov, stack, use_clahe=True, sr_method='affine', tmat=None, use_valid_pix=True,
+                                n_candidates=None, coarse_method='phase_correlation', downsample_factor=4,
+                                n_processes=None):
     ''' Register a field of view (fov) to a stack of z-stack using StackReg
 
+    With n_candidates, planes are first scored cheaply (coarse_method),
+    and the full StackReg registration runs only on the n_candidates best planes.
+
     Parameters:
         fov: np.array, field of view to register
         stack: np.array, reference z-stack
@@ -106,7 +161,15 @@ def fov_stack_register_stackreg(fov, stack, use_clahe=True, sr_method='affine',
         sr_method: str, method for stack registration
         tmat: np.array, transformation matrix for the registration
         use_valid_pix: bool, whether to remove blank pixels after transformation
-    
+        n_candidates: int, number of planes to register with StackReg after the coarse scoring
+            None to register to all the planes (no coarse scoring)
+        coarse_method: str, method for the coarse scoring
+            'phase_correlation': translation-only, all planes at once (zdrift batched phase correlation)
+            'downsampled': StackReg on images downsampled by downsample_factor
+        downsample_factor: int, downsampling factor for coarse_method 'downsampled'
+        n_processes: int, number of processes to register candidate planes in parallel
+            None or 1 to run serially
+
     Returns:
         corrcoef_arr: np.array (1d), correlation coefficient between 
             each plane of the stack and the registered fov
@@ -114,28 +177,15 @@ def fov_stack_register_stackreg(fov, stack, use_clahe=True, sr_method='affine',
         best_tmat: np.array, transformation matrix for the registration
         tmat_list: list, list of transformation matrices to each plane of the stack
             best_tmat is the one that has the highest correlation coefficient
+            Identity for planes not registered (not in the candidates)
         temp_cc: list, correlation coefficient between 
             the stack and the registered fov
             using optimal transformation per plane (of the stack)
+            NaN for planes not registered (not in the candidates)
     '''
-
-    if use_clahe:
-        fov_for_reg = zstack.image_normalization(skimage.exposure.equalize_adapthist(
-            fov.astype(np.uint16)))  # normalization to make it uint16
-        stack_for_reg = np.zeros_like(stack)
-        for pi in range(stack.shape[0]):
-            stack_for_reg[pi, :, :] = zstack.image_normalization(
-                skimage.exposure.equalize_adapthist(stack[pi, :, :].astype(np.uint16)))
-    else:
-        fov_for_reg = fov.copy()
-        stack_for_reg = stack.copy()
-
-    if sr_method == 'affine':
-        sr = StackReg(StackReg.AFFINE)
-    elif sr_method == 'rigid_body':
-        sr = StackReg(StackReg.RIGID_BODY)
-    else:
-        raise ValueError('"sr_method" should be either "affine" or "rigid_body"')
+    if coarse_method not in ['phase_correlation', 'downsampled']:
+        raise ValueError('"coarse_method" should be either "phase_correlation" or "downsampled"')
+    sr = _get_stackreg(sr_method)
 
     assert fov.min() >= 0
     if use_valid_pix:
@@ -145,56 +195,196 @@ def fov_stack_register_stackreg(fov, stack, use_clahe=True, sr_method='affine',
         valid_pix_threshold = -1 # to include all pixels
     num_pix_threshold = fov.shape[0] * fov.shape[1] / 2
 
-    corrcoef_arr = np.zeros(stack.shape[0])
-
     temp_cc = []
-    if tmat is None:        
-        tmat_list = []
-        for zi in range(stack_for_reg.shape[0]):
-            zstack_plane_clahe = stack_for_reg[zi]
-            zstack_plane = stack[zi]
-            tmat = sr.register(zstack_plane_clahe, fov_for_reg)
-            fov_reg = sr.transform(fov, tmat=tmat)            
-            valid_y, valid_x = np.where(fov_reg > valid_pix_threshold)
-            if len(valid_y) > num_pix_threshold:
-                temp_cc.append(np.corrcoef(zstack_plane[valid_y, valid_x].flatten(),
-                                           fov_reg[valid_y, valid_x].flatten())[0,1])
-                tmat_list.append(tmat)
-            else:
-                temp_cc.append(0)
-                tmat_list.append(np.eye(3))
-        temp_ind = np.argmax(temp_cc)
+    tmat_list = []
+    if tmat is None:
+        use_coarse = n_candidates is not None and n_candidates < stack.shape[0]
+        if use_coarse and coarse_method == 'phase_correlation':
+            # CLAHE of the stack is done once, for both coarse and fine registration
+            prepared_ref = zdrift.PreparedReferenceStack(stack, use_clahe=use_clahe)
+            stack_for_reg = prepared_ref.stack_for_reg
+            fov_for_reg, _ = prepared_ref.prepare_fov(fov)
+            _, coarse_cc, _ = zdrift.fov_stack_register_phase_correlation_batched(
+                fov, prepared_ref, use_valid_pix=use_valid_pix)
+        else:
+            fov_for_reg, stack_for_reg = _images_for_stackreg(fov, stack, use_clahe)
+            if use_coarse:
+                coarse_cc = _coarse_scores_downsampled(fov_for_reg, stack_for_reg, sr_method,
+                                                       downsample_factor)
+
+        if use_coarse:
+            coarse_cc = np.where(np.isnan(coarse_cc), -np.inf, coarse_cc)
+            plane_inds = np.sort(np.argsort(coarse_cc)[::-1][:n_candidates])
+        else:
+            plane_inds = np.arange(stack.shape[0])
+
+        args = [(sr_method, stack_for_reg[zi], fov_for_reg, fov, stack[zi],
+                 valid_pix_threshold, num_pix_threshold) for zi in plane_inds]
+        if n_processes is not None and n_processes > 1:
+            with ProcessPoolExecutor(max_workers=n_processes) as executor:
+                plane_results = list(executor.map(_register_plane_stackreg, *zip(*args)))
+        else:
+            plane_results = [_register_plane_stackreg(*arg) for arg in args]
+
+        temp_cc = [np.nan] * stack.shape[0]
+        tmat_list = [np.eye(3)] * stack.shape[0]
+        for zi, (cc, plane_tmat) in zip(plane_inds, plane_results):
+            temp_cc[zi] = cc
+            tmat_list[zi] = plane_tmat
+        temp_ind = np.nanargmax(temp_cc)
         best_tmat = tmat_list[temp_ind]
     else:
         best_tmat = tmat
     fov_reg = sr.transform(fov, tmat=best_tmat)
-    valid_y, valid_x = np.where(fov_reg > valid_pix_threshold)
-    for zi, zstack_plane in enumerate(stack):
-        corrcoef_arr[zi] = np.corrcoef(zstack_plane[valid_y, valid_x].flatten(),
-                                   fov_reg[valid_y, valid_x].flatten())[0,1]
+    corrcoef_arr = zstack.masked_corrcoef(fov_reg, stack, fov_reg > valid_pix_threshold)
     return corrcoef_arr, fov_reg, best_tmat, tmat_list, temp_cc
 
 
-def corrcoef_stack(stack1, stack2):
-    stack1_flat = stack1.reshape(stack1.shape[0], -1)
-    stack2_flat = stack2.reshape(stack2.shape[0], -1)
+def _get_stackreg(sr_method):
+    if sr_method == 'affine':
+        return StackReg(StackReg.AFFINE)
+    elif sr_method == 'rigid_body':
+        return StackReg(StackReg.RIGID_BODY)
+    else:
+        raise ValueError('"sr_method" should be either "affine" or "rigid_body"')
+
+
+def _images_for_stackreg(fov, stack, use_clahe):
+    if use_clahe:
+        fov_for_reg = zstack.image_normalization(skimage.exposure.equalize_adapthist(
+            fov.astype(np.uint16)))  # normalization to make it uint16
+        stack_for_reg = np.zeros_like(stack)
+        for pi in range(stack.shape[0]):
+            stack_for_reg[pi, :, :] = zstack.image_normalization(
+                skimage.exposure.equalize_adapthist(stack[pi, :, :].astype(np.uint16)))
+    else:
+        fov_for_reg = fov.copy()
+        stack_for_reg = stack.copy()
+    return fov_for_reg, stack_for_reg
+
+
+def _register_plane_stackreg(sr_method, zstack_plane_for_reg, fov_for_reg, fov, zstack_plane,
+                             valid_pix_threshold, num_pix_threshold):
+    ''' Register the fov to a single plane, return (correlation coefficient, tmat)
+    Module-level (and creating its own StackReg) to run in a process pool
+    '''
+    sr = _get_stackreg(sr_method)
+    tmat = sr.register(zstack_plane_for_reg, fov_for_reg)
+    fov_reg = sr.transform(fov, tmat=tmat)
+    valid_mask = fov_reg > valid_pix_threshold
+    if valid_mask.sum() > num_pix_threshold:
+        cc = zstack.paired_masked_corrcoef(zstack_plane[None], fov_reg[None], valid_mask[None])[0]
+        return cc, tmat
+    return 0, np.eye(3)
+
+
+def _coarse_scores_downsampled(fov_for_reg, stack_for_reg, sr_method, downsample_factor):
+    ''' Score each plane by StackReg registration of downsampled images
+    Blank pixels after the transformation are excluded from the correlation.
+    '''
+    factors = (downsample_factor, downsample_factor)
+    fov_ds = skimage.transform.downscale_local_mean(fov_for_reg.astype(np.float64), factors)
+    sr = _get_stackreg(sr_method)
+    scores = np.zeros(stack_for_reg.shape[0])
+    for zi in range(stack_for_reg.shape[0]):
+        plane_ds = skimage.transform.downscale_local_mean(stack_for_reg[zi].astype(np.float64), factors)
+        fov_ds_reg = sr.transform(fov_ds, tmat=sr.register(plane_ds, fov_ds))
+        valid_mask = fov_ds_reg > 0
+        scores[zi] = zstack.paired_masked_corrcoef(plane_ds[None], fov_ds_reg[None], valid_mask[None])[0]
+    return scores
 
-    # Subtract mean along the rows (axis=1) to normalize the data
-    stack1_mean = stack1_flat - stack1_flat.mean(axis=1, keepdims=True)
-    stack2_mean = stack2_flat - stack2_flat.mean(axis=1, keepdims=True)
 
-    # Compute the numerator of the correlation coefficient (dot product of the mean-centered arrays)
-    numerator = np.dot(stack1_mean, stack2_mean.T)
+DEFAULT_CORRCOEF_MAX_BYTES = 256 * (2**10)**2  # 256 MB
 
-    # Compute the denominator of the correlation coefficient
-    denominator = np.sqrt(np.sum(stack1_mean**2, axis=1)[:, None] * np.sum(stack2_mean**2, axis=1))
 
-    # Compute the correlation coefficients matrix
-    corrcoef_arr = numerator / denominator
+def corrcoef_stack(stack1, stack2, dtype=np.float32, max_bytes=DEFAULT_CORRCOEF_MAX_BYTES):
+    ''' Correlation coefficient between each plane of stack1 and each plane of stack2
 
+    Planes are normalized (mean-centered, unit norm) in dtype and
+    dot products are accumulated over pixel chunks, so the working memory stays within max_bytes.
+
+    Args:
+        stack1: np.array (3d), (n_planes_1, height, width)
+        stack2: np.array (3d), (n_planes_2, height, width)
+        dtype: dtype of the normalized pixel chunks, by default np.float32
+        max_bytes: int, memory cap for the normalized pixel chunks
+
+    Returns:
+        corrcoef_arr: np.array (2d), (n_planes_1, n_planes_2)
+    '''
+    corrcoef_arr = np.zeros((stack1.shape[0], stack2.shape[0]))
+    for chunk1, chunk2 in _normalized_pixel_chunks(stack1, stack2, dtype, max_bytes):
+        corrcoef_arr += np.dot(chunk1, chunk2.T)
     return corrcoef_arr
 
 
+def corrcoef_stack_band(stack1, stack2, plane_offsets, dtype=np.float32,
+                        max_bytes=DEFAULT_CORRCOEF_MAX_BYTES):
+    ''' Diagonal band of corrcoef_stack, only for the given plane offsets
+
+    band[oi, i] is the correlation coefficient between stack1[i] and stack2[i + plane_offsets[oi]],
+    i.e., np.diag(corrcoef_stack(stack1, stack2), plane_offsets[oi]) placed at the stack1 plane index.
+
+    Args:
+        stack1: np.array (3d), (n_planes_1, height, width)
+        stack2: np.array (3d), (n_planes_2, height, width)
+        plane_offsets: list of int, plane offsets (diagonals) to compute
+        dtype: dtype of the normalized pixel chunks, by default np.float32
+        max_bytes: int, memory cap for the normalized pixel chunks
+
+    Returns:
+        band: np.array (2d), (len(plane_offsets), n_planes_1), NaN where stack1[i + offset] is out of range
+    '''
+    n1, n2 = stack1.shape[0], stack2.shape[0]
+    band = np.full((len(plane_offsets), n1), np.nan)
+    ranges = [(max(0, -offset), min(n1, n2 - offset)) for offset in plane_offsets]
+    for oi, (start, end) in enumerate(ranges):
+        if end > start:
+            band[oi, start:end] = 0
+    for chunk1, chunk2 in _normalized_pixel_chunks(stack1, stack2, dtype, max_bytes):
+        for oi, (offset, (start, end)) in enumerate(zip(plane_offsets, ranges)):
+            if end > start:
+                band[oi, start:end] += np.einsum('ij,ij->i', chunk1[start:end],
+                                                 chunk2[start + offset:end + offset])
+    return band
+
+
+def _normalized_pixel_chunks(stack1, stack2, dtype, max_bytes):
+    ''' Yield pixel chunks of both stacks, each plane mean-centered and scaled to unit norm
+    (so that the sum of chunk dot products is the correlation coefficient)
+    Chunks are cast to dtype first and normalized in place, so the yielded chunks
+    are all the working memory (within max_bytes). Plane means and norms are computed
+    in float64, over float64 pixel chunks also within max_bytes.
+    '''
+    stack1_flat = stack1.reshape(stack1.shape[0], -1)
+    stack2_flat = stack2.reshape(stack2.shape[0], -1)
+    assert stack1_flat.shape[1] == stack2_flat.shape[1]
+    n_pix = stack1_flat.shape[1]
+    stats = []
+    for stack_flat in [stack1_flat, stack2_flat]:
+        means = stack_flat.mean(axis=1, dtype=np.float64)
+        sum_squares = np.zeros(stack_flat.shape[0])
+        stats_chunk_size = max(1, min(n_pix, int(max_bytes // (stack_flat.shape[0] * 8))))
+        for start in range(0, n_pix, stats_chunk_size):
+            centered = stack_flat[:, start:start + stats_chunk_size].astype(np.float64)
+            centered -= means[:, None]
+            sum_squares += np.einsum('ij,ij->i', centered, centered)
+            del centered
+        stats.append((means[:, None].astype(dtype), np.sqrt(sum_squares)[:, None].astype(dtype)))
+    n_rows = stack1_flat.shape[0] + stack2_flat.shape[0]
+    # half of max_bytes per pair: the consumer still holds the previous pair while the next is made
+    chunk_size = max(1, min(n_pix, int(max_bytes // (2 * n_rows * np.dtype(dtype).itemsize))))
+    for start in range(0, n_pix, chunk_size):
+        end = min(n_pix, start + chunk_size)
+        chunks = []
+        for stack_flat, (means, norms) in zip([stack1_flat, stack2_flat], stats):
+            chunk = stack_flat[:, start:end].astype(dtype)  # a copy, also when already dtype
+            chunk -= means
+            chunk /= norms
+            chunks.append(chunk)
+        yield tuple(chunks)
+
+
 ######################################
 # Within and across z-drift
 #
@@ -218,42 +408,346 @@ def get_container_stack_matching_ordered(opids):
         for j in range(i+1, len(opids)):
             matched_inds[i, j] = get_matched_ind(opids[i], opids[j])  # be careful about the sign!
             matched_inds[j, i] = -matched_inds[i, j]
-    # from the first opid to the rest
-    relative_matched_inds = np.zeros(len(opids))
-    for i in range(len(opids)-1):
-        for j in range(i+1, len(opids)):
-            diff_ac = [matched_inds[i, j]]
-            for k in range(len(opids)):
-                if k == i or k == j:
-                    continue
-                diff_ac.append(matched_inds[i, k] + matched_inds[k, j])
-            relative_matched_inds[j] = np.mean(diff_ac)
+    return relative_matched_inds_from_matrix(matched_inds)
+
+
+def relative_matched_inds_from_matrix(matched_inds):
+    ''' Matched plane index of each session relative to the first session,
+    from the pairwise matched index matrix (see the description above)
+
+    Args:
+        matched_inds: np.array (2d), matched_inds[i, j] is the number of planes from session i to j
+            (antisymmetric, NaN for missing pairs)
+
+    Returns:
+        relative_matched_inds: np.array (1d), number of planes from the first session
+            to each session (0 for the first session)
+    '''
+    n_sessions = matched_inds.shape[0]
+    relative_matched_inds = np.zeros(n_sessions)
+    i = 0
+    for j in range(1, n_sessions):
+        # direct difference and all length-2 paths from the first session
+        others = np.setdiff1d(np.arange(n_sessions), [i, j])
+        diff_ac = np.concatenate([[matched_inds[i, j]],
+                                  matched_inds[i, others] + matched_inds[others, j]])
+        relative_matched_inds[j] = np.nanmean(diff_ac)
     return relative_matched_inds
 
 
-def get_matched_ind(opid_1, opid_2, load_dir=Path('/root/capsule/scratch/session_to_session_diff')):
+def get_matched_ind(opid_1, opid_2, load_dir=DEFAULT_S2S_DIR):
     ''' TODO: change this to a correct path in the (future) pipeline
+    Read from the pairwise results store in load_dir, or a per-pair npy file if not in the store
     '''
     if type(load_dir) == str:
         load_dir = Path(load_dir)
+    store = results_store.ResultsStore(load_dir / S2S_STORE_NAME)
+    if pair_key(opid_1, opid_2) in store:
+        return store.load(pair_key(opid_1, opid_2),
+                          ['stack_to_stack_diff_planes'])['stack_to_stack_diff_planes']  # be careful about the sign!
     sts_fn = load_dir / f'{opid_1}_{opid_2}_session_to_session_diff.npy'
     sts = np.load(sts_fn, allow_pickle=True).item()
     return sts['stack_to_stack_diff_planes'] # be careful about the sign!
 
 
-def calculate_within_across_zdrift(opids):
+def import_legacy_session_to_session_diff(load_dir=DEFAULT_S2S_DIR, store_fn=None):
+    ''' Move per-pair npy results in load_dir into the pairwise results store
+
+    Returns:
+        imported: list of pair keys imported
+    '''
+    load_dir = Path(load_dir)
+    store_fn = load_dir / S2S_STORE_NAME if store_fn is None else store_fn
+
+    def _key_index(npy_fn):
+        opid_1, opid_2 = [int(opid) for opid in npy_fn.name.split('_')[:2]]
+        return pair_key(opid_1, opid_2), {'opid_1': opid_1, 'opid_2': opid_2}
+
+    return results_store.import_npy_results(results_store.ResultsStore(store_fn),
+                                            sorted(load_dir.glob('*_session_to_session_diff.npy')),
+                                            _key_index)
+
+
+def pair_key(opid_1, opid_2):
+    ''' Key of a session pair in the pairwise results store '''
+    return f'{int(opid_1)}_{int(opid_2)}'
+
+
+class ContainerDriftEngine():
+    ''' Session-to-session drift of a container, updated as sessions are added
+
+    Pairwise results (calculate_session_to_session_diff) are kept in a single results store.
+    Adding sessions computes only the pairs not in the store (in parallel),
+    then updates matched_inds and relative_matched_inds.
+    Pairs saved as per-pair npy files (save_session_to_session_diff) in legacy_dir
+    are moved into the store instead of being recomputed.
+
+    Args:
+        opids: list of int, ophys plane ids of the container (same plane across sessions)
+        store_fn: Path, h5 file of the pairwise results store
+        legacy_dir: Path, directory of per-pair npy results, None to ignore them
+        n_processes: int, number of processes to compute missing pairs, None for os.cpu_count()
+        container_id: saved with each pair, to query the store by container
+        cache_bytes: int, preprocessed stack cache ceiling of each worker process
+            (see session_to_session_diff_for_pairs)
+        diff_kwargs: arguments for calculate_session_to_session_diff
+
+    Attributes:
+        opids: np.array, sorted opids (assumed to be in time order)
+        matched_inds: np.array (2d), matched_inds[i, j] from opids[i] to opids[j], NaN if missing
+        relative_matched_inds: np.array (1d), see relative_matched_inds_from_matrix
+        failed_pairs: dict, {(opid_1, opid_2): traceback} of pairs that failed
+    '''
+
+    def __init__(self, opids=(), store_fn=DEFAULT_PAIR_STORE_FN, legacy_dir=DEFAULT_S2S_DIR,
+                 n_processes=None, container_id=None, cache_bytes=None, **diff_kwargs):
+        self.store = results_store.ResultsStore(store_fn)
+        self.container_id = container_id
+        self.legacy_dir = None if legacy_dir is None else Path(legacy_dir)
+        self.n_processes = n_processes
+        self.cache_bytes = cache_bytes
+        self.diff_kwargs = diff_kwargs
+        self.opids = np.zeros(0, dtype=int)
+        self.matched_inds = np.zeros((0, 0))
+        self.relative_matched_inds = np.zeros(0)
+        self.failed_pairs = {}
+        if len(opids) > 0:
+            self.add_sessions(opids)
+
+    def add_sessions(self, opids):
+        ''' Add sessions, compute their missing pairs and update the matched indices
+
+        Returns:
+            relative_matched_inds: np.array (1d)
+        '''
+        new_opids = sorted(set(int(opid) for opid in opids) - set(self.opids.tolist()))
+        if len(new_opids) > 0:
+            all_opids = np.sort(np.concatenate([self.opids, new_opids])).astype(int)
+            matched_inds = np.full((len(all_opids), len(all_opids)), np.nan)
+            np.fill_diagonal(matched_inds, 0)
+            old_inds = np.searchsorted(all_opids, self.opids)
+            matched_inds[np.ix_(old_inds, old_inds)] = self.matched_inds
+            self.opids = all_opids
+            self.matched_inds = matched_inds
+        self.update()
+        return self.relative_matched_inds
+
+    def missing_pairs(self):
+        ''' (opid_1, opid_2) pairs, opid_1 < opid_2, without a matched index '''
+        inds_1, inds_2 = np.where(np.triu(np.isnan(self.matched_inds), k=1))
+        return [(int(self.opids[i]), int(self.opids[j])) for i, j in zip(inds_1, inds_2)]
+
+    def update(self):
+        ''' Fill missing pairs from the store (or legacy files), compute the rest '''
+        stored_keys = set(self.store.keys())
+        to_compute = []
+        for opid_1, opid_2 in self.missing_pairs():
+            key = pair_key(opid_1, opid_2)
+            legacy_fn = None if self.legacy_dir is None \
+                else self.legacy_dir / f'{opid_1}_{opid_2}_session_to_session_diff.npy'
+            if key in stored_keys:
+                diff = self.store.load(key, ['stack_to_stack_diff_planes'])['stack_to_stack_diff_planes']
+                self._set_matched_ind(opid_1, opid_2, diff)
+            elif legacy_fn is not None and legacy_fn.exists():
+                results_info = np.load(legacy_fn, allow_pickle=True).item()
+                self.store.save(key, results_info, index=self._pair_index(opid_1, opid_2))
+                self._set_matched_ind(opid_1, opid_2, results_info['stack_to_stack_diff_planes'])
+            elif (opid_1, opid_2) not in self.failed_pairs:
+                to_compute.append((opid_1, opid_2))
+
+        if len(to_compute) > 0:
+            summary = session_to_session_diff_for_pairs(to_compute, store_fn=self.store.store_fn,
+                                                        n_processes=self.n_processes,
+                                                        container_id=self.container_id,
+                                                        cache_bytes=self.cache_bytes,
+                                                        **self.diff_kwargs)
+            for row in summary.itertuples():
+                if row.status == 'error':
+                    self.failed_pairs[(row.opid_1, row.opid_2)] = row.traceback
+                else:
+                    self._set_matched_ind(row.opid_1, row.opid_2, row.stack_to_stack_diff_planes)
+
+        self.relative_matched_inds = relative_matched_inds_from_matrix(self.matched_inds)
+
+    def _pair_index(self, opid_1, opid_2):
+        index = {'opid_1': opid_1, 'opid_2': opid_2}
+        if self.container_id is not None:
+            index['container_id'] = self.container_id
+        return index
+
+    def _set_matched_ind(self, opid_1, opid_2, diff):
+        i, j = np.searchsorted(self.opids, [opid_1, opid_2])
+        self.matched_inds[i, j] = diff  # be careful about the sign!
+        self.matched_inds[j, i] = -diff
+
+
+def container_pairs(opids, pairs='upper'):
+    ''' Session pairs of a container
+
+    Args:
+        opids: list of int, ophys plane ids (in time order)
+        pairs: str, 'upper' for (opids[i], opids[j]) with i < j
+            (all the pairs get_container_stack_matching_ordered needs),
+            'all' for both directions
+
+    Returns:
+        list of (opid_1, opid_2)
+    '''
+    if pairs == 'upper':
+        return [(int(opids[i]), int(opids[j])) for i in range(len(opids)) for j in range(i + 1, len(opids))]
+    elif pairs == 'all':
+        return [(int(opid_1), int(opid_2)) for opid_1 in opids for opid_2 in opids if opid_1 != opid_2]
+    else:
+        raise ValueError('"pairs" should be either "upper" or "all"')
+
+
+def session_to_session_diff_for_container(opids, pairs='upper', **kwargs):
+    ''' Session to session drift of all the pairs of a container, in parallel
+    See container_pairs for pairs and session_to_session_diff_for_pairs for kwargs
+    '''
+    if isinstance(pairs, str):
+        pairs = container_pairs(opids, pairs)
+    return session_to_session_diff_for_pairs(pairs, **kwargs)
+
+
+def session_to_session_diff_for_pairs(pairs, store_fn=DEFAULT_PAIR_STORE_FN, n_processes=None,
+                                      overwrite=False, show_progress=True, container_id=None,
+                                      cache_bytes=None, **diff_kwargs):
+    ''' Session to session drift of session pairs, in a process pool
+
+    Pairs are grouped by their first opid and each group runs as one task (largest first),
+    so the first stack of a group is preprocessed once, in one worker process.
+    Worker processes also keep preprocessed stacks in memory (preprocessed_stack_cache),
+    so second stacks shared across groups are loaded about once per worker.
+    Each group is saved to the pairwise results store as it finishes. Workers return their
+    results and this (driver) process saves them, so there is one writer per store
+    (see results_store).
+    Errors are recorded per pair (with traceback) instead of stopping the run,
+    including a worker process dying (BrokenProcessPool), which fails its pending groups.
+
+    Args:
+        pairs: list of (opid_1, opid_2)
+        store_fn: Path, h5 file of the pairwise results store
+        n_processes: int, number of worker processes, None for os.cpu_count()
+        overwrite: bool, whether to recompute pairs already in the store
+        show_progress: bool, whether to show a progress bar
+        container_id: saved with each pair, to query the store by container
+        cache_bytes: int, memory ceiling of the preprocessed stack cache of each worker process,
+            set by the pool initializer (set_preprocessed_stack_cache_bytes in the calling process
+            does not reach the workers). None for local_zstack_cache.DEFAULT_MEMORY_CACHE_BYTES
+            split across the worker processes.
+        diff_kwargs: arguments for calculate_session_to_session_diff
+
+    Returns:
+        summary: pd.DataFrame, a row per pair with 'opid_1', 'opid_2',
+            'status' ('success', 'error' or 'skipped'), 'stack_to_stack_diff_planes',
+            'error', 'traceback', 'elapsed_s'
+    '''
+    store = results_store.ResultsStore(store_fn)
+    stored_keys = set(store.keys())
+    summary = []
+    to_compute = []
+    for opid_1, opid_2 in sorted(pairs):
+        if (pair_key(opid_1, opid_2) in stored_keys) and not overwrite:
+            diff = store.load(pair_key(opid_1, opid_2),
+                              ['stack_to_stack_diff_planes'])['stack_to_stack_diff_planes']
+            summary.append({'opid_1': opid_1, 'opid_2': opid_2, 'status': 'skipped',
+                            'stack_to_stack_diff_planes': diff, 'error': None,
+                            'traceback': None, 'elapsed_s': 0})
+        else:
+            to_compute.append((opid_1, opid_2))
+
+    if len(to_compute) > 0:
+        groups = {}
+        for opid_1, opid_2 in to_compute:
+            groups.setdefault(opid_1, []).append((opid_1, opid_2))
+        n_workers = min(len(groups), n_processes if n_processes is not None else (os.cpu_count() or 1))
+        if cache_bytes is None:
+            cache_bytes = local_zstack_cache.DEFAULT_MEMORY_CACHE_BYTES // n_workers
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=set_preprocessed_stack_cache_bytes,
+                                 initargs=(cache_bytes,)) as executor, \
+                tqdm(total=len(to_compute), disable=not show_progress,
+                     desc='Session to session diff') as progress:
+            futures = {executor.submit(_pair_diff_group_task, group_pairs, diff_kwargs): group_pairs
+                       for group_pairs in sorted(groups.values(), key=len, reverse=True)}
+            for future in as_completed(futures):
+                group_pairs = futures[future]
+                try:
+                    group_results = future.result()
+                except Exception as e:
+                    # e.g., BrokenProcessPool: a worker process died (e.g., out of memory),
+                    # failing this and all the other pending groups
+                    group_results = [(_pair_error_row(opid_1, opid_2, e, traceback.format_exc(), 0),
+                                      None) for opid_1, opid_2 in group_pairs]
+                for row, results_info in group_results:
+                    if results_info is not None:
+                        _save_pair_diff(store, row, results_info, container_id)
+                    summary.append(row)
+                progress.update(len(group_pairs))
+
+    return pd.DataFrame(summary, columns=['opid_1', 'opid_2', 'status', 'stack_to_stack_diff_planes',
+                                          'error', 'traceback', 'elapsed_s'])
+
+
+def _pair_diff_group_task(pairs, diff_kwargs):
+    ''' Calculate pairs sharing their first opid, in one worker process
+    Returns a list of (summary row, results_info) per pair, results_info None on error.
+    Saving is left to the driver (one writer per store).
+    '''
+    return [_pair_diff_task(opid_1, opid_2, diff_kwargs) for opid_1, opid_2 in pairs]
+
+
+def _pair_diff_task(opid_1, opid_2, diff_kwargs):
+    ''' Calculate one pair, returning (summary row, results_info) instead of raising '''
+    start_time = time.time()
+    try:
+        results_info = calculate_session_to_session_diff(opid_1, opid_2, **diff_kwargs)
+        return {'opid_1': opid_1, 'opid_2': opid_2, 'status': 'success',
+                'stack_to_stack_diff_planes': results_info['stack_to_stack_diff_planes'],
+                'error': None, 'traceback': None,
+                'elapsed_s': time.time() - start_time}, results_info
+    except Exception as e:
+        return _pair_error_row(opid_1, opid_2, e, traceback.format_exc(),
+                               time.time() - start_time), None
+
+
+def _pair_error_row(opid_1, opid_2, error, error_traceback, elapsed_s):
+    return {'opid_1': opid_1, 'opid_2': opid_2, 'status': 'error',
+            'stack_to_stack_diff_planes': np.nan, 'error': repr(error),
+            'traceback': error_traceback, 'elapsed_s': elapsed_s}
+
+
+def _save_pair_diff(store, row, results_info, container_id):
+    ''' Save one pair to the store, turning the summary row into an error row if saving fails '''
+    index = {'opid_1': row['opid_1'], 'opid_2': row['opid_2']}
+    if container_id is not None:
+        index['container_id'] = container_id
+    try:
+        store.save(pair_key(row['opid_1'], row['opid_2']), results_info, index=index)
+    except Exception as e:
+        row.update({'status': 'error', 'error': repr(e), 'traceback': traceback.format_exc()})
+
+
+def calculate_within_across_zdrift(opids, zdrift_dir=zdrift.DEFAULT_ZDRIFT_SAVE_DIR):
     ''' Calculate within and across session z-drift for a container
     TODO: change paths to the correct ones in the pipeline
+    Within-session z-drift is read from the z-drift results store in zdrift_dir
+    (calc_zdrift_compact), or per-opid npy files for opids not in the store
     '''
     stack_matched_inds = get_container_stack_matching_ordered(opids)
 
+    zdrift_dir = Path(zdrift_dir)
+    store = results_store.ResultsStore(zdrift_dir / zdrift.ZDRIFT_STORE_NAME)
+    stored_matched_inds = store.read_column('matched_plane_indices', keys=opids)
     within_session_zdrift = []
     success_session_inds = []  # To deal with occasional failures
     for i, opid in enumerate(opids):
-        zdrift_dir = Path('/root/capsule/scratch/zdrift')
         opid_dir = zdrift_dir/ str(opid)
         load_fn = opid_dir/f'{opid}_zdrift_pconly_dc_single_onemeanEMF.npy'
-        if load_fn.exists():
+        if str(opid) in stored_matched_inds:
+            within_session_zdrift.append(stored_matched_inds[str(opid)])
+            success_session_inds.append(i)
+        elif load_fn.exists():
             results = np.load(load_fn, allow_pickle=True).item()
             within_session_zdrift.append(results['matched_plane_indices'])
             success_session_inds.append(i)
@@ -265,20 +759,24 @@ def calculate_within_across_zdrift(opids):
 
 
 def save_session_to_session_diff(opid_1, opid_2, n_averaging_planes=10, sr_method='affine',
-                                 save_dir=Path('/root/capsule/scratch/session_to_session_diff')):
+                                 save_dir=DEFAULT_S2S_DIR):
     ''' Save the results of session to session drift calculation
+    to the pairwise results store in save_dir
+    Saves from the calling process, so do not call it from parallel workers sharing save_dir
+    (use session_to_session_diff_for_pairs, which saves from the driver).
     '''
     try:
         if type(save_dir) == str:
             save_dir = Path(save_dir)
         save_dir.mkdir(parents=True, exist_ok=True)
-        save_fn = save_dir / f'{opid_1}_{opid_2}_session_to_session_diff.npy'
-        if save_fn.exists():
+        store = results_store.ResultsStore(save_dir / S2S_STORE_NAME)
+        if pair_key(opid_1, opid_2) in store:
             return 0, (opid_1, opid_2)
         results_info = calculate_session_to_session_diff(opid_1, opid_2, n_averaging_planes=n_averaging_planes, sr_method=sr_method)
-        np.save(save_fn, results_info)
+        store.save(pair_key(opid_1, opid_2), results_info, index={'opid_1': opid_1, 'opid_2': opid_2})
         return 1, (opid_1, opid_2)
-    except:
+    except Exception:
+        print(f'Failed session to session diff {opid_1}-{opid_2}:\n{traceback.format_exc()}')
         return -1, (opid_1, opid_2)
 
 
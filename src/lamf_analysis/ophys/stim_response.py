@@ -281,13 +281,61 @@ def get_trace_around_timepoint(timepoint, trace, timestamps, window, frame_rate)
 
 
 def get_responses_around_event_times(trace, timestamps, event_times, frame_rate, window=[-2, 3]):
-    responses = []
-    for event_time in event_times:
-        response, times = get_trace_around_timepoint(event_time, trace, timestamps,
-                                                     frame_rate=frame_rate, window=window)
-        responses.append(response)
-    responses = np.asarray(responses)
-    return responses
+    """Trace(s) around each event, (n_events, n_window) for one trace,
+    (n_cells, n_events, n_window) for a (n_cells, n_frames) array.
+    See get_event_aligned_traces; windows past the edges of the trace are NaN-padded.
+    """
+    return get_event_aligned_traces(trace, timestamps, event_times, frame_rate, window=window)
+
+
+def get_event_aligned_traces(traces, timestamps, event_times, frame_rate, window=[-2, 3]):
+    """Dense tensor of traces around event times
+
+    Each event is aligned to its successive frame (get_successive_frame_list, one searchsorted
+    for all events). Windows are the frames [event_frame + floor(window[0] * frame_rate),
+    event_frame + floor(window[1] * frame_rate)), the same frames as get_trace_around_timepoint,
+    so every event has the same window length. Frames outside the trace are NaN.
+
+    Parameters
+    ----------
+    traces : np.ndarray
+        (n_cells, n_frames), or (n_frames,) for a single trace
+    timestamps : np.ndarray
+        (n_frames,) timestamps of the frames, increasing
+    event_times : np.ndarray
+        (n_events,) event times
+    frame_rate : float
+        Frame rate (Hz)
+    window : list, optional
+        [start, end] of the window around each event in seconds, by default [-2, 3]
+
+    Returns
+    -------
+    np.ndarray
+        (n_cells, n_events, n_window), or (n_events, n_window) for a single trace (float)
+    """
+    traces = np.asarray(traces)
+    single_trace = traces.ndim == 1
+    traces = np.atleast_2d(traces)
+    n_cells, n_frames = traces.shape
+    first_offset = int(np.floor(window[0] * frame_rate))
+    n_window = max(0, int(np.floor(window[1] * frame_rate)) - first_offset)
+    start_frames = get_successive_frame_list(np.asarray(event_times), timestamps) + first_offset
+
+    dtype = np.result_type(traces.dtype, np.float32)
+    aligned = np.full((n_cells, len(start_frames), n_window), np.nan, dtype=dtype)
+    if n_window > 0:
+        inside = (start_frames >= 0) & (start_frames + n_window <= n_frames)
+        if n_window <= n_frames:
+            # strided (n_cells, n_frames - n_window + 1, n_window) view of all windows, no copy
+            windows = np.lib.stride_tricks.sliding_window_view(traces, n_window, axis=1)
+            aligned[:, inside] = windows[:, start_frames[inside]]
+        # events at the edges: the frames within the trace, NaN for the rest
+        for event in np.flatnonzero(~inside):
+            frames = start_frames[event] + np.arange(n_window)
+            in_trace = (frames >= 0) & (frames < n_frames)
+            aligned[:, event, in_trace] = traces[:, frames[in_trace]]
+    return aligned[0] if single_trace else aligned
 
 
 def get_mean_in_window(trace, window, frame_rate, use_events=False):
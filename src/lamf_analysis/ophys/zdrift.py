@@ -1,18 +1,26 @@
 from pathlib import Path
 import h5py
 import numpy as np
-from typing import Union
+from typing import Optional, Union
 import skimage
 import scipy
+import scipy.fft
 import cv2
 import matplotlib.pyplot as plt
 import ray
 import sys
 import os
+import shutil
+import time
+import traceback
+import pandas as pd
 os.environ["RAY_verbose_spill_logs"] = "0"
 
 import lamf_analysis.utils as utils
 import lamf_analysis.ophys.zstack as zstack
+import lamf_analysis.ophys.scanimage_metadata as si_md
+import lamf_analysis.ophys.local_zstack_cache as local_zstack_cache
+import lamf_analysis.ophys.results_store as results_store
 
 ###############################################################
 # Zdrift 
@@ -27,14 +35,28 @@ import lamf_analysis.ophys.zstack as zstack
 # Session to session matching by using zstack to zstack registration (implemented in a different file) 
 ###############################################################
 
+DEFAULT_ZDRIFT_SAVE_DIR = Path('/root/capsule/scratch/zdrift')
+ZDRIFT_STORE_NAME = 'zdrift_results.h5'
+ZDRIFT_TASK_DIR_NAME = 'tasks'  # per-task stores of parallel workers, merged by the driver
+
+
 def zdrift_for_session_planes(raw_path: Union[Path, str],
                               parallel: bool = True,
+                              compact: bool = False,
+                              save_dir: Union[Path, str] = DEFAULT_ZDRIFT_SAVE_DIR,
                               **zdrift_kwargs) -> dict:
     """Get z-drift for all the planes in a session
     Parameters
     ----------
     raw_path : Path
         Path to the raw session directory
+    parallel : bool, optional
+        If to run planes in parallel using ray, by default True
+    compact : bool, optional
+        If to keep heavy arrays on disk (calc_zdrift_compact), by default False
+        Results then hold only scalars, small arrays and the path to the full result.
+    save_dir : Path, optional
+        Directory to save full results in compact mode, by default DEFAULT_ZDRIFT_SAVE_DIR
     zdrift_kwargs : dict
         Arguments for calc_zdrift (use_clahe and use_valid_pix)
 
@@ -43,6 +65,11 @@ def zdrift_for_session_planes(raw_path: Union[Path, str],
     dict
         Dictionary of z-drift for each plane
     """
+    if compact:
+        zdrift_dict = dict(iter_zdrift_for_session_planes(raw_path, save_dir=save_dir,
+                                                          parallel=parallel, **zdrift_kwargs))
+        return {plane_id: zdrift_dict[plane_id] for plane_id in sorted(zdrift_dict)}
+
     raw_path_to_all_planes = utils.plane_paths_from_session(raw_path,
                                                         data_level="raw")
 
@@ -55,13 +82,8 @@ def zdrift_for_session_planes(raw_path: Union[Path, str],
         futures = []
         for path_to_plane in raw_path_to_all_planes:
             futures.append(ray.remote(calc_zdrift).remote(path_to_plane, **zdrift_kwargs))
-        result_dict = ray.get(futures)
-        
-        plane_ids = np.sort([result['plane_id'] for result in result_dict])
-        zdrift_dict = {}
-        for plane_id in plane_ids:
-            result = [result for result in result_dict if result['plane_id'] == plane_id][0]
-            zdrift_dict[plane_id] = result
+        result_dict = {result['plane_id']: result for result in ray.get(futures)}
+        zdrift_dict = {plane_id: result_dict[plane_id] for plane_id in sorted(result_dict)}
         if ray_shutdown:
             ray.shutdown()
     else:
@@ -72,9 +94,278 @@ def zdrift_for_session_planes(raw_path: Union[Path, str],
     return zdrift_dict
 
 
+def iter_zdrift_for_session_planes(raw_path: Union[Path, str],
+                                   save_dir: Union[Path, str] = DEFAULT_ZDRIFT_SAVE_DIR,
+                                   parallel: bool = True,
+                                   **zdrift_kwargs):
+    """Yield compact z-drift results of the planes in a session, as they finish
+
+    Heavy arrays stay on disk, and only scalars, small arrays and paths are kept.
+    In parallel, each ray task saves its full result to its own task store and returns
+    the compact result, so heavy arrays do not go through the ray object store.
+    This (driver) process merges the task stores into the results store,
+    so there is one writer per store (see results_store).
+
+    Parameters
+    ----------
+    raw_path : Path
+        Path to the raw session directory
+    save_dir : Path, optional
+        Directory to save full results, by default DEFAULT_ZDRIFT_SAVE_DIR
+    parallel : bool, optional
+        If to run planes in parallel using ray, by default True
+    zdrift_kwargs : dict
+        Arguments for calc_zdrift
+
+    Yields
+    ------
+    tuple
+        (plane_id, compact result dict), in the order of completion
+    """
+    raw_path_to_all_planes = utils.plane_paths_from_session(raw_path,
+                                                        data_level="raw")
+    if not parallel:
+        for path_to_plane in raw_path_to_all_planes:
+            result = calc_zdrift_compact(path_to_plane, save_dir=save_dir, **zdrift_kwargs)
+            yield result['plane_id'], result
+        return
+
+    if not ray.is_initialized():
+        utils.initialize_ray()
+        ray_shutdown = True
+    else:
+        ray_shutdown = False
+    try:
+        pending = [ray.remote(_calc_zdrift_to_task_store).remote(path_to_plane, save_dir,
+                                                                 **zdrift_kwargs)
+                   for path_to_plane in raw_path_to_all_planes]
+        while pending:
+            done, pending = ray.wait(pending, num_returns=1)
+            for future in done:
+                result = _merge_zdrift_task_store(ray.get(future), save_dir)
+                yield result['plane_id'], result
+    finally:
+        if ray_shutdown:
+            ray.shutdown()
+
+
+def zdrift_for_sessions(raw_paths: list,
+                        save_dir: Union[Path, str] = DEFAULT_ZDRIFT_SAVE_DIR,
+                        max_retries: int = 1,
+                        overwrite: bool = False,
+                        **zdrift_kwargs) -> pd.DataFrame:
+    """Fault-tolerant z-drift for the planes of many sessions, using ray
+
+    Plane-level tasks of all the sessions are scheduled together.
+    Each task retries a raised error up to max_retries times and captures it instead of raising.
+    A crashed worker is not retried (ray max_retries=0, so retries are not compounded);
+    the plane is recorded as an error and recomputed by the next call.
+    Each task saves its full result to its own task store and returns only a summary,
+    so heavy arrays do not go through the ray object store. This (driver) process merges
+    the task stores into the results store as the tasks finish, so a failed plane does not
+    lose the others, and there is one writer per store (see results_store).
+    Planes with a saved result are skipped unless overwrite.
+
+    Parameters
+    ----------
+    raw_paths : list
+        Paths to the raw session directories
+    save_dir : Path, optional
+        Directory to save full results and the summary, by default DEFAULT_ZDRIFT_SAVE_DIR
+    max_retries : int, optional
+        Number of retries of a failed plane, by default 1
+    overwrite : bool, optional
+        If to recompute planes with a saved result, by default False
+    zdrift_kwargs : dict
+        Arguments for calc_zdrift
+
+    Returns
+    -------
+    pd.DataFrame
+        Summary with a row per plane (or per session, if its planes could not be listed):
+        'session', 'plane_id' (opid, the results store key), 'status' ('success', 'error' or
+        'skipped'), 'n_attempts', 'error', 'traceback', 'result_path'.
+        Also saved as zdrift_summary.csv in save_dir.
+    """
+    save_dir = Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    if not ray.is_initialized():
+        utils.initialize_ray()
+        ray_shutdown = True
+    else:
+        ray_shutdown = False
+
+    store = results_store.ResultsStore(save_dir / ZDRIFT_STORE_NAME)
+    summary = []
+    task_info = {}
+    try:
+        for raw_path in raw_paths:
+            session = Path(raw_path).name
+            try:
+                plane_paths = utils.plane_paths_from_session(raw_path, data_level="raw")
+            except Exception as e:
+                summary.append(_task_summary(session, None, 'error', 0, e))
+                continue
+            for plane_path in plane_paths:
+                plane_id = local_zstack_cache.opid_from_plane_path(plane_path)
+                result_path = save_dir / ZDRIFT_STORE_NAME
+                if (plane_id in store) and not overwrite:
+                    summary.append({'session': session, 'plane_id': plane_id,
+                                    'status': 'skipped', 'n_attempts': 0, 'error': None,
+                                    'traceback': None, 'result_path': str(result_path)})
+                    continue
+                # retries only within _zdrift_task (raised errors), not by ray (worker crashes)
+                future = ray.remote(_zdrift_task).options(max_retries=0).remote(
+                    session, plane_path, save_dir, max_retries, **zdrift_kwargs)
+                task_info[future] = (session, plane_id)
+
+        pending = list(task_info)
+        while pending:
+            done, pending = ray.wait(pending, num_returns=1)
+            for future in done:
+                session, plane_id = task_info.pop(future)
+                try:
+                    row, result = ray.get(future)
+                except Exception as e:
+                    summary.append(_task_summary(session, plane_id, 'error', 1, e))
+                    continue
+                if result is not None:
+                    try:
+                        row['result_path'] = _merge_zdrift_task_store(result, save_dir)['result_path']
+                    except Exception as e:
+                        row = _task_summary(session, plane_id, 'error', row['n_attempts'], e)
+                summary.append(row)
+    finally:
+        if ray_shutdown:
+            ray.shutdown()
+
+    summary_df = pd.DataFrame(summary, columns=['session', 'plane_id', 'status', 'n_attempts',
+                                                'error', 'traceback', 'result_path'])
+    # int opids, with <NA> for sessions whose planes could not be listed
+    summary_df['plane_id'] = summary_df['plane_id'].astype('Int64')
+    summary_df.to_csv(save_dir / 'zdrift_summary.csv', index=False)
+    return summary_df
+
+
+def _zdrift_task(session, raw_plane_path, save_dir, max_retries, **zdrift_kwargs):
+    """_calc_zdrift_to_task_store with retries, returning (summary row, compact result)
+    instead of raising. The compact result is None on error.
+    Merging into the results store is left to the driver (zdrift_for_sessions).
+    """
+    plane_id = local_zstack_cache.opid_from_plane_path(raw_plane_path)
+    for attempt in range(1, max_retries + 2):
+        try:
+            result = _calc_zdrift_to_task_store(raw_plane_path, save_dir, **zdrift_kwargs)
+            return {'session': session, 'plane_id': plane_id, 'status': 'success',
+                    'n_attempts': attempt, 'error': None, 'traceback': None,
+                    'result_path': None}, result
+        except Exception as e:
+            error = e
+    return _task_summary(session, plane_id, 'error', attempt, error), None
+
+
+def _task_summary(session, plane_id, status, n_attempts, error):
+    return {'session': session, 'plane_id': plane_id, 'status': status,
+            'n_attempts': n_attempts, 'error': repr(error),
+            'traceback': ''.join(traceback.format_exception(type(error), error, error.__traceback__)),
+            'result_path': None}
+
+
+def calc_zdrift_compact(raw_plane_path: Path,
+                        save_dir: Union[Path, str] = DEFAULT_ZDRIFT_SAVE_DIR,
+                        **zdrift_kwargs) -> dict:
+    """Calc zdrift, save the full result to disk and return a compact result
+
+    Parameters
+    ----------
+    raw_plane_path : Path
+        Path to the raw plane directory
+    save_dir : Path, optional
+        Directory to save the full result, by default DEFAULT_ZDRIFT_SAVE_DIR
+    zdrift_kwargs : dict
+        Arguments for calc_zdrift
+
+    Returns
+    -------
+    dict
+        plane_id, zdrift_um, matched_plane_indices, peak_corrcoef, options,
+        and result_path and result_key to the full result (load_zdrift_result)
+    """
+    results = calc_zdrift(raw_plane_path, **zdrift_kwargs)
+    save_dir = Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    # all planes in one results store, keyed by opid
+    opid = local_zstack_cache.opid_from_plane_path(raw_plane_path)
+    result_path = save_dir / ZDRIFT_STORE_NAME
+    results_store.ResultsStore(result_path).save(opid, results, index={'opid': opid})
+    return {'plane_id': results['plane_id'],
+            'zdrift_um': results['zdrift_um'],
+            'matched_plane_indices': results['matched_plane_indices'],
+            'peak_corrcoef': np.nanmax(results['corrcoef'], axis=1),
+            'use_clahe': results['use_clahe'],
+            'use_valid_pix': results['use_valid_pix'],
+            'result_path': str(result_path),
+            'result_key': str(opid)}
+
+
+def _calc_zdrift_to_task_store(raw_plane_path, save_dir, **zdrift_kwargs):
+    """calc_zdrift_compact to the task store of the plane (in save_dir/ZDRIFT_TASK_DIR_NAME),
+    written only by this task. Merge it with _merge_zdrift_task_store."""
+    opid = local_zstack_cache.opid_from_plane_path(raw_plane_path)
+    task_dir = Path(save_dir) / ZDRIFT_TASK_DIR_NAME / str(opid)
+    return calc_zdrift_compact(raw_plane_path, save_dir=task_dir, **zdrift_kwargs)
+
+
+def _merge_zdrift_task_store(result, save_dir):
+    """Copy a task store (compact result from _calc_zdrift_to_task_store) into the results store
+    of save_dir, remove the task store, and return the compact result pointing to the results store"""
+    result_path = Path(save_dir) / ZDRIFT_STORE_NAME
+    results_store.ResultsStore(result_path).copy_from(result['result_path'],
+                                                      keys=[result['result_key']])
+    shutil.rmtree(Path(result['result_path']).parent)
+    return dict(result, result_path=str(result_path))
+
+
+def load_zdrift_result(result_path: Union[Path, str], result_key: Union[str, int],
+                       keys: Optional[list] = None) -> dict:
+    """Load a calc_zdrift result from a z-drift results store (calc_zdrift_compact)
+
+    Parameters
+    ----------
+    result_path : Path
+        Path to the results store (ZDRIFT_STORE_NAME)
+    result_key : str or int
+        Key (opid) in the results store
+    keys : list, optional
+        Arrays to load, by default None (all). Scalars are always loaded.
+
+    Returns
+    -------
+    dict
+        calc_zdrift result
+    """
+    results = results_store.ResultsStore(result_path).load(result_key, lazy=True)
+    for key, value in list(results.items()):
+        if isinstance(value, results_store.LazyDataset):
+            if (keys is None) or (key in keys):
+                results[key] = value[()]
+            else:
+                del results[key]
+    return results
+
+
 def calc_zdrift(raw_plane_path: Path,
                 use_clahe=True, 
                 use_valid_pix=True, 
+                reference='raw',
+                ref_zstack_cache_dir=None,
+                vectorized=True,
+                plane_search='full',
+                search_window_flank=5,
+                segment_frames=None,
+                movie_chunk_frames=500,
+                ref_cache_dir=None,
+                max_ref_cache_bytes=local_zstack_cache.DEFAULT_MAX_CACHE_BYTES,
                 ):
     """Calc zdrift for an ophys movie relative to reference stack
 
@@ -101,6 +392,40 @@ def calc_zdrift(raw_plane_path: Path,
     use_valid_pix : bool, optional
         if to use valid pixels only for correlation coefficient calculation
         during the 1st step - phase correlation registration, by default True
+    reference : str, optional
+        Reference z-stack, by default 'raw'.
+        'raw': the local z-stack registered by zstack.register_local_z_stack.
+        'decrosstalked': the decrosstalked and registered local z-stack in ref_zstack_cache_dir
+        (local_zstack_cache.prepare_session_local_zstacks). It must be cached with a key
+        matching the current inputs (z-stack files and decrosstalk alpha/beta).
+    ref_zstack_cache_dir : Path, optional
+        Directory of decrosstalked and registered local z-stacks, for 'decrosstalked' reference,
+        by default None (local_zstack_cache.DEFAULT_CACHE_DIR)
+    vectorized : bool, optional
+        if to correlate each FOV against all the planes at once
+        (fov_stack_register_phase_correlation_batched), by default True
+    plane_search : str, optional
+        'full' to search all the planes for each segment, or
+        'temporal_prior' to search near the previous match
+        (register_segments_temporal_prior, needs vectorized), by default 'full'
+    search_window_flank : int, optional
+        Number of planes to search on each side of the previous match,
+        for 'temporal_prior' plane_search, by default 5
+    segment_frames : int, optional
+        Number of frames per segment, by default None.
+        If None, use the precomputed episodic mean FOVs from the decrosstalk directory.
+        Otherwise, segment mean FOVs are streamed from the plane movie
+        (episodic_mean_fovs_from_movie), e.g., frame rate x 60 for per-minute drift.
+    movie_chunk_frames : int, optional
+        Number of movie frames to read at a time when segment_frames is given, by default 500
+    ref_cache_dir : Path, optional
+        Directory of the content-addressed cache of the registered, cropped and
+        preprocessed reference z-stack, by default None (no cache).
+        Keyed by the input z-stack fingerprint and the crop, so re-runs with
+        different options skip the registration.
+    max_ref_cache_bytes : int, optional
+        Maximum total size of ref_cache_dir, least recently used stacks are removed,
+        by default local_zstack_cache.DEFAULT_MAX_CACHE_BYTES
 
     Returns
     -------
@@ -132,41 +457,98 @@ def calc_zdrift(raw_plane_path: Path,
         local_zstack_path = list(raw_plane_path.glob('*_z_stack_local.h5'))[0]
     except:
         raise FileNotFoundError('Local z-stack not found')
-    ref_zstack = zstack.register_local_z_stack(local_zstack_path)
-    ref_zstack_crop = ref_zstack[:, range_y[0]:range_y[1], range_x[0]:range_x[1]]
+    opid = local_zstack_cache.opid_from_plane_path(raw_plane_path)
+    if reference == 'decrosstalked':
+        if ref_zstack_cache_dir is None:
+            ref_zstack_cache_dir = local_zstack_cache.DEFAULT_CACHE_DIR
+        raw_path = raw_plane_path.parent.parent
+        ref_zstack_key = local_zstack_cache.local_zstack_cache_key(
+            raw_path, processed_path, opid, local_zstack_cache.get_paired_opid(raw_path, opid))
+        if not local_zstack_cache.is_cached(opid, key=ref_zstack_key, cache_dir=ref_zstack_cache_dir):
+            raise FileNotFoundError(f'Decrosstalked local z-stack of {opid} not cached (or stale) '
+                                    f'in {ref_zstack_cache_dir}, '
+                                    'run local_zstack_cache.prepare_session_local_zstacks first')
+        ref_zstack_fn = local_zstack_cache.cached_zstack_fn(opid, ref_zstack_cache_dir)
+    elif reference == 'raw':
+        ref_zstack_fn = local_zstack_path
+    else:
+        raise ValueError(f"reference should be 'raw' or 'decrosstalked', got {reference}")
+
+    # Registered, cropped and preprocessed z-stack, from the cache if possible
+    ref_arrays = None
+    if ref_cache_dir is not None:
+        ref_key = local_zstack_cache.content_key(
+            stage='zdrift_reference_stack',
+            source=si_md.file_fingerprint(ref_zstack_fn),
+            registered=reference == 'raw',
+            range_y=[int(r) for r in range_y], range_x=[int(r) for r in range_x],
+            med_filt_kernel_size=5, rolling_window_flank=2)
+        ref_arrays = local_zstack_cache.cache_load(ref_key, ref_cache_dir)
+    if ref_arrays is None:
+        if reference == 'decrosstalked':
+            ref_zstack = local_zstack_cache.load_cached_zstack(opid, cache_dir=ref_zstack_cache_dir)
+        else:
+            ref_zstack = zstack.register_local_z_stack(local_zstack_path)
+        ref_zstack_crop = ref_zstack[:, range_y[0]:range_y[1], range_x[0]:range_x[1]]
+        stack_pre = med_filt_z_stack(ref_zstack_crop)
+        stack_pre = rolling_average_stack(stack_pre)
+        if ref_cache_dir is not None:
+            local_zstack_cache.cache_save(ref_key, {'ref_zstack_crop': ref_zstack_crop,
+                                                    'stack_pre': stack_pre},
+                                          ref_cache_dir, max_cache_bytes=max_ref_cache_bytes)
+    else:
+        ref_zstack_crop = ref_arrays['ref_zstack_crop']
+        stack_pre = ref_arrays['stack_pre']
 
-    si_metadata, roi_groups = zstack.local_zstack_metadata(local_zstack_path)
+    si_metadata = si_md.scanimage_metadata(local_zstack_path,
+                                           keys=['SI.hStackManager.actualNumSlices',
+                                                 'SI.hStackManager.actualStackZStepSize'])
     number_of_z_planes= int(si_metadata['SI.hStackManager.actualNumSlices'])
     # number_of_repeats = int(si_metadata['SI.hStackManager.actualNumVolumes'])
     z_step = float(si_metadata['SI.hStackManager.actualStackZStepSize'])
 
-    # Get preprocessed z-stack
-    stack_pre = med_filt_z_stack(ref_zstack_crop)
-    stack_pre = rolling_average_stack(stack_pre)
-
     # Get episodic mean FOVs (emf) and crop
-    # TODO: make the mean FOV movie with finer time resolution
-    decrosstalk_dir = processed_plane_path / 'decrosstalk'
-    emf_h5_fn = list(Path(decrosstalk_dir).glob('*_decrosstalk_episodic_mean_fov.h5'))[0]
-    with h5py.File(emf_h5_fn, 'r') as h:
-        episodic_mean_fovs = h['data'][:]
-    episodic_mean_fovs_crop = episodic_mean_fovs[:, range_y[0]:range_y[1], range_x[0]:range_x[1]]
+    if segment_frames is None:
+        decrosstalk_dir = processed_plane_path / 'decrosstalk'
+        emf_h5_fn = list(Path(decrosstalk_dir).glob('*_decrosstalk_episodic_mean_fov.h5'))[0]
+        with h5py.File(emf_h5_fn, 'r') as h:
+            episodic_mean_fovs = h['data'][:]
+        episodic_mean_fovs_crop = episodic_mean_fovs[:, range_y[0]:range_y[1], range_x[0]:range_x[1]]
+    else:
+        episodic_mean_fovs_crop = episodic_mean_fovs_from_movie(
+            get_plane_movie_h5(processed_plane_path), segment_frames,
+            chunk_frames=movie_chunk_frames, range_y=range_y, range_x=range_x)
 
     # Run registration for each episodic mean FOVs
-    matched_plane_indices = np.zeros(
-        episodic_mean_fovs_crop.shape[0], dtype=int)
-    corrcoef = []
-    segment_reg_imgs = []
-    shift_list = []
-    for i in range(episodic_mean_fovs_crop.shape[0]):
-        fov_reg_stack, cc, shift = fov_stack_register_phase_correlation(
-            episodic_mean_fovs_crop[i], stack_pre, use_clahe=use_clahe,
-            use_valid_pix=use_valid_pix)
-        matched_plane_indices[i] = np.argmax(cc)
-        corrcoef.append(cc)
-        segment_reg_imgs.append(fov_reg_stack[np.argmax(cc)])
-        shift_list.append(shift)
-    corrcoef = np.asarray(corrcoef)
+    # Stack preprocessing (CLAHE, normalization, FFT) is done once for all the segments
+    prepared_ref = PreparedReferenceStack(stack_pre, use_clahe=use_clahe)
+    if plane_search == 'temporal_prior':
+        if not vectorized:
+            raise ValueError('"temporal_prior" plane_search needs vectorized=True')
+        segment_reg_imgs, corrcoef, shift_list, full_search = register_segments_temporal_prior(
+            episodic_mean_fovs_crop, prepared_ref, use_valid_pix=use_valid_pix,
+            search_window_flank=search_window_flank)
+    elif plane_search == 'full':
+        corrcoef = []
+        segment_reg_imgs = []
+        shift_list = []
+        for i in range(episodic_mean_fovs_crop.shape[0]):
+            if vectorized:
+                fov_reg, cc, shift = fov_stack_register_phase_correlation_batched(
+                    episodic_mean_fovs_crop[i], prepared_ref, use_valid_pix=use_valid_pix)
+            else:
+                fov_reg_stack, cc, shift = fov_stack_register_phase_correlation(
+                    episodic_mean_fovs_crop[i], prepared_ref, use_clahe=use_clahe,
+                    use_valid_pix=use_valid_pix)
+                fov_reg = fov_reg_stack[np.argmax(cc)]
+            corrcoef.append(cc)
+            segment_reg_imgs.append(fov_reg)
+            shift_list.append(shift)
+        corrcoef = np.asarray(corrcoef)
+        full_search = np.ones(corrcoef.shape[0], dtype=bool)
+    else:
+        raise ValueError('"plane_search" should be either "full" or "temporal_prior"')
+    matched_plane_indices = np.nanargmax(corrcoef, axis=1)
 
     center_z = number_of_z_planes // 2
     zdrift_um = z_step * (matched_plane_indices - center_z)
@@ -179,11 +561,163 @@ def calc_zdrift(raw_plane_path: Path,
                 'ref_zstack_crop': ref_zstack_crop,                   
                 'shift': shift_list,
                 'use_clahe': use_clahe,
-                'use_valid_pix': use_valid_pix}
+                'use_valid_pix': use_valid_pix,
+                'reference': reference,
+                'plane_search': plane_search,
+                'segment_frames': -1 if segment_frames is None else segment_frames,
+                'full_search_segments': full_search}
 
     return results
 
 
+def get_plane_movie_h5(processed_plane_path: Union[Path, str]) -> Path:
+    """Get the movie h5 of a processed plane
+    Decrosstalked movie if it exists (multiscope), otherwise motion-corrected movie.
+
+    Parameters
+    ----------
+    processed_plane_path : Path
+        Path to the processed plane directory
+
+    Returns
+    -------
+    Path
+        Path to the movie h5
+    """
+    processed_plane_path = Path(processed_plane_path)
+    for pattern in ['decrosstalk/*_decrosstalk.h5', 'motion_correction/*_registered.h5']:
+        movie_fns = list(processed_plane_path.glob(pattern))
+        if len(movie_fns) > 0:
+            return movie_fns[0]
+    raise FileNotFoundError(f'Movie h5 not found in {processed_plane_path}')
+
+
+def episodic_mean_fovs_from_movie(movie_h5_fn: Union[Path, str],
+                                  window_frames,
+                                  chunk_frames: int = 500,
+                                  range_y: Optional[list] = None,
+                                  range_x: Optional[list] = None,
+                                  drop_partial: bool = True,
+                                  dataset: str = 'data'):
+    """Mean FOVs of consecutive windows of a movie, streamed from h5 in one pass
+
+    Movie is read chunk_frames at a time (cropped on read), and each chunk is summed
+    into the windows it overlaps, so memory is bounded by one chunk plus the output.
+    Multiple window lengths can be computed in the same pass.
+
+    Parameters
+    ----------
+    movie_h5_fn : Path
+        Path to the movie h5 (motion-corrected or decrosstalked)
+    window_frames : int or list of int
+        Number of frames per window (e.g., frame rate x 60 for 1 min windows)
+    chunk_frames : int, optional
+        Number of frames to read at a time, by default 500
+    range_y : list, optional
+        [start, end] y range to crop, by default None (no crop)
+    range_x : list, optional
+        [start, end] x range to crop, by default None (no crop)
+    drop_partial : bool, optional
+        If to drop the last window when it has fewer frames, by default True
+    dataset : str, optional
+        Dataset name in the h5 file, by default 'data'
+
+    Returns
+    -------
+    np.ndarray (3d) or dict
+        Mean FOVs (n_windows, y, x). Dict of {window_frames: mean FOVs}
+        if window_frames is a list.
+    """
+    single_window = np.isscalar(window_frames)
+    window_list = [int(window_frames)] if single_window else [int(w) for w in window_frames]
+    crop_y = slice(None) if range_y is None else slice(range_y[0], range_y[1])
+    crop_x = slice(None) if range_x is None else slice(range_x[0], range_x[1])
+
+    with h5py.File(movie_h5_fn, 'r') as h:
+        movie = h[dataset]
+        num_frames = movie.shape[0]
+        sums = {}
+        counts = {}
+        for start in range(0, num_frames, chunk_frames):
+            end = min(num_frames, start + chunk_frames)
+            chunk = movie[start:end, crop_y, crop_x]
+            for w in window_list:
+                if w not in sums:
+                    num_windows = int(np.ceil(num_frames / w))
+                    sums[w] = np.zeros((num_windows, *chunk.shape[1:]))
+                    counts[w] = np.zeros(num_windows)
+                first_window = start // w
+                last_window = (end - 1) // w
+                # window starts within the chunk (relative to the chunk start)
+                bounds = np.arange(first_window, last_window + 1) * w - start
+                bounds[0] = 0
+                sums[w][first_window:last_window + 1] += np.add.reduceat(
+                    chunk, bounds, axis=0, dtype=np.float64)
+                counts[w][first_window:last_window + 1] += np.diff(np.append(bounds, end - start))
+
+    mean_fovs = {}
+    for w in window_list:
+        keep = counts[w] >= w if drop_partial else counts[w] > 0
+        mean_fovs[w] = sums[w][keep] / counts[w][keep][:, None, None]
+    return mean_fovs[window_list[0]] if single_window else mean_fovs
+
+
+class PreparedReferenceStack():
+    """Reference stack with the stack-side preprocessing for
+    fov_stack_register_phase_correlation computed once
+    (CLAHE, normalization and FFT of each plane).
+    Reuse it to register many FOVs (e.g., episodic mean FOVs) to the same stack.
+
+    Parameters
+    ----------
+    stack : np.ndarray (3d)
+        stack images
+    use_clahe: bool, optional
+        If to adjust contrast using CLAHE for registration, by default True
+    """
+
+    def __init__(self, stack, use_clahe=True):
+        assert len(stack.shape) == 3
+        self.stack = stack
+        self.use_clahe = use_clahe
+        if use_clahe:
+            self.stack_for_reg = np.zeros_like(stack)
+            for pi in range(stack.shape[0]):
+                self.stack_for_reg[pi, :, :] = image_normalization(
+                    skimage.exposure.equalize_adapthist(stack[pi, :, :].astype(np.uint16)))
+        else:
+            self.stack_for_reg = stack.copy()
+        self.stack_fft = scipy.fft.fft2(self.stack_for_reg, axes=(-2, -1))
+
+    @property
+    def shape(self):
+        return self.stack.shape
+
+    def prepare_fov(self, fov):
+        """Preprocess a FOV the same way as the stack
+
+        Parameters
+        ----------
+        fov : np.ndarray (2d)
+            FOV image
+
+        Returns
+        -------
+        np.ndarray (2d)
+            FOV image for registration
+        np.ndarray (2d)
+            FFT of the FOV image for registration
+        """
+        assert len(fov.shape) == 2
+        assert fov.shape == self.stack.shape[1:]
+        if self.use_clahe:
+            fov_for_reg = image_normalization(skimage.exposure.equalize_adapthist(
+                fov.astype(np.uint16)))  # normalization to make it uint16
+        else:
+            fov_for_reg = fov.copy()
+        return fov_for_reg, scipy.fft.fft2(fov_for_reg)
+
+
 def fov_stack_register_phase_correlation(fov, stack, use_clahe=True, use_valid_pix=True):
     """ Reigster FOV to each plane in the stack
 
@@ -191,10 +725,12 @@ def fov_stack_register_phase_correlation(fov, stack, use_clahe=True, use_valid_p
     ----------
     fov : np.ndarray (2d)
         FOV image
-    stack : np.ndarray (3d)
-        stack images
+    stack : np.ndarray (3d) or PreparedReferenceStack
+        stack images. Use PreparedReferenceStack to skip the stack preprocessing
+        when registering multiple FOVs to the same stack.
     use_clahe: bool, optional
         If to adjust contrast using CLAHE for registration, by default True
+        Should match the PreparedReferenceStack if it is given.
     use_valid_pix : bool, optional
         If to use valid pixels (non-blank pixels after transfromation)
         to calculate correlation coefficient, by default True
@@ -208,40 +744,399 @@ def fov_stack_register_phase_correlation(fov, stack, use_clahe=True, use_valid_p
     list
         list of translation shifts (y,x)
     """
+    if isinstance(stack, PreparedReferenceStack):
+        if stack.use_clahe != use_clahe:
+            raise ValueError(f"use_clahe ({use_clahe}) does not match the prepared reference "
+                             f"({stack.use_clahe})")
+        prepared_ref = stack
+    else:
+        assert len(stack.shape) == 3
+        prepared_ref = PreparedReferenceStack(stack, use_clahe=use_clahe)
+    stack = prepared_ref.stack
     assert len(fov.shape) == 2
-    assert len(stack.shape) == 3
     assert fov.shape == stack.shape[1:]
 
-    if use_clahe:
-        fov_for_reg = image_normalization(skimage.exposure.equalize_adapthist(
-            fov.astype(np.uint16)))  # normalization to make it uint16
-        stack_for_reg = np.zeros_like(stack)
-        for pi in range(stack.shape[0]):
-            stack_for_reg[pi, :, :] = image_normalization(
-                skimage.exposure.equalize_adapthist(stack[pi, :, :].astype(np.uint16)))
-    else:
-        fov_for_reg = fov.copy()
-        stack_for_reg = stack.copy()
+    _, fov_fft = prepared_ref.prepare_fov(fov)
 
-    fov_reg_stack = np.zeros_like(stack_for_reg)
-    corrcoef_arr = np.zeros(stack_for_reg.shape[0])
+    fov_reg_stack = np.zeros_like(prepared_ref.stack_for_reg)
     shift_list = []
-    for pi in range(stack_for_reg.shape[0]):
+    for pi in range(stack.shape[0]):
         shift, _, _ = skimage.registration.phase_cross_correlation(
-            stack_for_reg[pi, :, :], fov_for_reg, normalization=None)
-        fov_reg = scipy.ndimage.shift(fov, shift)
-        fov_reg_stack[pi, :, :] = fov_reg
-        if use_valid_pix:
-            valid_y, valid_x = np.where(fov_reg > 0)
-            corrcoef_arr[pi] = np.corrcoef(stack[pi, valid_y, valid_x].flatten(
-            ), fov_reg[valid_y, valid_x].flatten())[0, 1]
-        else:
-            corrcoef_arr[pi] = np.corrcoef(
-                stack[pi, :, :].flatten(), fov_reg.flatten())[0, 1]
-        shift_list.append(shift)    
+            prepared_ref.stack_fft[pi], fov_fft, space='fourier', normalization=None)
+        fov_reg_stack[pi, :, :] = scipy.ndimage.shift(fov, shift)
+        shift_list.append(shift)
+    valid_masks = fov_reg_stack > 0 if use_valid_pix else None
+    corrcoef_arr = zstack.paired_masked_corrcoef(stack, fov_reg_stack, valid_masks)
     return fov_reg_stack, corrcoef_arr, shift_list
 
 
+def fov_stack_register_phase_correlation_batched(fov, prepared_ref, use_valid_pix=True,
+                                                 plane_chunk_size=None, plane_indices=None):
+    """ Register FOV to each plane in the stack, all planes at once
+    Same results as fov_stack_register_phase_correlation, but
+    the cross-correlation with all the planes is one broadcasted FFT operation,
+    correlation coefficients are computed with zstack.paired_masked_corrcoef,
+    and only the registered FOV at the best-matched plane is kept.
+
+    Parameters
+    ----------
+    fov : np.ndarray (2d)
+        FOV image
+    prepared_ref : PreparedReferenceStack or np.ndarray (3d)
+        prepared reference stack (or stack images, prepared with CLAHE)
+    use_valid_pix : bool, optional
+        If to use valid pixels (non-blank pixels after transfromation)
+        to calculate correlation coefficient, by default True
+    plane_chunk_size : int, optional
+        Number of planes to cross-correlate (and correlate) at a time,
+        to limit memory, by default None (all)
+    plane_indices : array-like, optional
+        Planes to search, by default None (all).
+        Correlation coefficients and shifts of the other planes are NaN.
+
+    Returns
+    -------
+    np.ndarray (2d)
+        FOV registered to the best-matched plane (highest correlation coefficient)
+    np.array (1d)
+        correlation coefficient between the registered fov and the stack in each plane
+    list
+        list of translation shifts (y,x)
+    """
+    if not isinstance(prepared_ref, PreparedReferenceStack):
+        prepared_ref = PreparedReferenceStack(prepared_ref)
+    stack = prepared_ref.stack
+    num_planes = stack.shape[0]
+    if plane_indices is None:
+        plane_indices = np.arange(num_planes)
+    plane_indices = np.asarray(plane_indices)
+    _, fov_fft = prepared_ref.prepare_fov(fov)
+
+    shifts = np.full((num_planes, 2), np.nan)
+    if (len(plane_indices) > 0) and np.array_equal(
+            plane_indices, np.arange(plane_indices[0], plane_indices[-1] + 1)):
+        # contiguous planes (all, or a search window): a view, not a copy of the stack FFT
+        ref_fft = prepared_ref.stack_fft[plane_indices[0]:plane_indices[-1] + 1]
+    else:
+        ref_fft = prepared_ref.stack_fft[plane_indices]
+    shifts[plane_indices] = batched_phase_cross_correlation(
+        ref_fft, fov_fft, plane_chunk_size=plane_chunk_size)
+
+    corrcoef_arr = np.full(num_planes, np.nan)
+    chunk_size = len(plane_indices) if plane_chunk_size is None else plane_chunk_size
+    # shifted FOVs (and valid masks) exactly as in fov_stack_register_phase_correlation,
+    # scipy.ndimage.shift cast to the stack dtype; shifted once per distinct shift in a chunk.
+    # Only the running best (corrcoef, plane, shifted FOV) is kept across chunks.
+    best_cc, best_pi, fov_reg = -np.inf, None, None
+    for start in range(0, len(plane_indices), chunk_size):
+        chunk_indices = plane_indices[start:start + chunk_size]
+        shifted_fovs = {}
+        fov_shifted = np.zeros((len(chunk_indices), *fov.shape), dtype=prepared_ref.stack_for_reg.dtype)
+        for i, pi in enumerate(chunk_indices):
+            shift = tuple(shifts[pi])
+            if shift not in shifted_fovs:
+                shifted_fovs[shift] = scipy.ndimage.shift(fov, shift)
+            fov_shifted[i] = shifted_fovs[shift]
+        valid_masks = fov_shifted > 0 if use_valid_pix else None
+        chunk_corrcoef = zstack.paired_masked_corrcoef(stack[chunk_indices], fov_shifted, valid_masks)
+        corrcoef_arr[chunk_indices] = chunk_corrcoef
+        for cc, pi in zip(chunk_corrcoef, chunk_indices):
+            # the first plane among equal maxima, as np.nanargmax
+            if (cc > best_cc) or ((cc == best_cc) and (pi < best_pi)):
+                best_cc, best_pi = cc, pi
+                fov_reg = shifted_fovs[tuple(shifts[pi])]
+        del shifted_fovs, fov_shifted, valid_masks
+    if fov_reg is None:
+        raise ValueError("All-NaN correlation coefficients, no best-matched plane")
+    return fov_reg, corrcoef_arr, list(shifts)
+
+
+def register_segments_temporal_prior(fovs, prepared_ref, use_valid_pix=True,
+                                     search_window_flank=5, min_peak_cc_ratio=0.95,
+                                     plane_chunk_size=None):
+    """Register segment FOVs to the stack, searching near the previous match
+
+    The first segment is matched against the full stack. Each next segment is matched
+    only against planes within search_window_flank of the previous match.
+    Falls back to the full search when the peak correlation coefficient drops
+    below min_peak_cc_ratio x (the last full-search peak), or when the match is at
+    the edge of the window (drift may continue outside of the window).
+
+    Parameters
+    ----------
+    fovs : np.ndarray (3d)
+        segment FOV images
+    prepared_ref : PreparedReferenceStack
+        prepared reference stack
+    use_valid_pix : bool, optional
+        If to use valid pixels to calculate correlation coefficient, by default True
+    search_window_flank : int, optional
+        Number of planes to search on each side of the previous match, by default 5
+    min_peak_cc_ratio : float, optional
+        Ratio to the last full-search peak correlation coefficient,
+        below which the full search is done, by default 0.95
+    plane_chunk_size : int, optional
+        Number of planes to cross-correlate at a time, by default None (all)
+
+    Returns
+    -------
+    list
+        registered FOV at the best-matched plane of each segment
+    np.ndarray (2d)
+        correlation coefficients (n_segments, n_planes), NaN for planes not searched
+    list
+        list of translation shifts of each segment
+    np.ndarray (1d, bool)
+        if each segment was fully searched
+    """
+    segment_reg_imgs = []
+    corrcoef = []
+    shift_list = []
+    full_search = np.zeros(fovs.shape[0], dtype=bool)
+    prev_match = None
+    ref_peak_cc = None
+    for i in range(fovs.shape[0]):
+        result, full_search[i] = _register_segment_with_prior(
+            fovs[i], prepared_ref, prev_match, ref_peak_cc, use_valid_pix=use_valid_pix,
+            search_window_flank=search_window_flank, min_peak_cc_ratio=min_peak_cc_ratio,
+            plane_chunk_size=plane_chunk_size)
+        if full_search[i]:
+            ref_peak_cc = np.nanmax(result[1])
+        prev_match = np.nanargmax(result[1])
+        segment_reg_imgs.append(result[0])
+        corrcoef.append(result[1])
+        shift_list.append(result[2])
+    return segment_reg_imgs, np.asarray(corrcoef), shift_list, full_search
+
+
+def _register_segment_with_prior(fov, prepared_ref, prev_match, ref_peak_cc, use_valid_pix=True,
+                                 search_window_flank=5, min_peak_cc_ratio=0.95,
+                                 plane_chunk_size=None):
+    """Register one segment FOV near the previous match, with the full search fallback
+    (see register_segments_temporal_prior). Returns the registration result and
+    if the full search was done."""
+    num_planes = prepared_ref.shape[0]
+    if prev_match is not None:
+        window = np.arange(max(0, prev_match - search_window_flank),
+                           min(num_planes, prev_match + search_window_flank + 1))
+        result = fov_stack_register_phase_correlation_batched(
+            fov, prepared_ref, use_valid_pix=use_valid_pix,
+            plane_chunk_size=plane_chunk_size, plane_indices=window)
+        match = np.nanargmax(result[1])
+        at_window_edge = (match in [window[0], window[-1]]) and (match not in [0, num_planes - 1])
+        if not (at_window_edge or (np.nanmax(result[1]) < min_peak_cc_ratio * ref_peak_cc)):
+            return result, False
+    result = fov_stack_register_phase_correlation_batched(
+        fov, prepared_ref, use_valid_pix=use_valid_pix,
+        plane_chunk_size=plane_chunk_size)
+    return result, True
+
+
+class ZdriftMonitor():
+    """Incremental z-drift for in-progress acquisitions
+
+    Holds a prepared reference local z-stack and matches each new mean FOV
+    as it arrives, searching near the previous match (see register_segments_temporal_prior),
+    so the cost per FOV does not grow with the session length.
+    Calls on_drift when the drift exceeds drift_threshold_um.
+
+    Parameters
+    ----------
+    ref_stack : np.ndarray (3d) or PreparedReferenceStack
+        preprocessed reference z-stack (see from_local_zstack), cropped as the FOVs
+    z_step : float
+        z-stack step size (um)
+    center_plane : int, optional
+        plane index at 0 drift, by default None (middle plane)
+    use_clahe : bool, optional
+        If to adjust contrast using CLAHE for registration, by default True
+    use_valid_pix : bool, optional
+        If to use valid pixels to calculate correlation coefficient, by default True
+    drift_threshold_um : float, optional
+        Absolute drift (um) above which on_drift is called, by default 5
+    on_drift : callable, optional
+        Called with the estimate dict (see add_fov) when the drift exceeds the threshold,
+        by default None
+    search_window_flank : int, optional
+        Number of planes to search on each side of the previous match, by default 5
+    min_peak_cc_ratio : float, optional
+        Ratio to the last full-search peak correlation coefficient,
+        below which the full search is done, by default 0.95
+    """
+
+    def __init__(self, ref_stack, z_step, center_plane=None, use_clahe=True,
+                 use_valid_pix=True, drift_threshold_um=5, on_drift=None,
+                 search_window_flank=5, min_peak_cc_ratio=0.95):
+        if isinstance(ref_stack, PreparedReferenceStack):
+            self.prepared_ref = ref_stack
+        else:
+            self.prepared_ref = PreparedReferenceStack(ref_stack, use_clahe=use_clahe)
+        self.z_step = z_step
+        self.center_plane = self.prepared_ref.shape[0] // 2 if center_plane is None else center_plane
+        self.use_valid_pix = use_valid_pix
+        self.drift_threshold_um = drift_threshold_um
+        self.on_drift = on_drift
+        self.search_window_flank = search_window_flank
+        self.min_peak_cc_ratio = min_peak_cc_ratio
+
+        self.matched_plane_indices = []
+        self.zdrift_um = []
+        self.peak_corrcoef = []
+        self.full_search = []
+        self._ref_peak_cc = None
+
+    @classmethod
+    def from_local_zstack(cls, ref_zstack, z_step, range_y=None, range_x=None, **kwargs):
+        """Make a monitor from a registered local z-stack,
+        cropped and preprocessed (median filter and rolling average) as in calc_zdrift
+
+        Parameters
+        ----------
+        ref_zstack : np.ndarray (3d)
+            registered local z-stack
+        z_step : float
+            z-stack step size (um)
+        range_y : list, optional
+            [start, end] y range to crop, by default None (no crop)
+        range_x : list, optional
+            [start, end] x range to crop, by default None (no crop)
+        kwargs : dict
+            Arguments for ZdriftMonitor
+
+        Returns
+        -------
+        ZdriftMonitor
+        """
+        if range_y is not None:
+            ref_zstack = ref_zstack[:, range_y[0]:range_y[1], :]
+        if range_x is not None:
+            ref_zstack = ref_zstack[:, :, range_x[0]:range_x[1]]
+        stack_pre = rolling_average_stack(med_filt_z_stack(ref_zstack))
+        return cls(stack_pre, z_step, **kwargs)
+
+    def add_frames(self, frames):
+        """Add a chunk of frames (3d), matched as their mean FOV (see add_fov)"""
+        return self.add_fov(np.mean(frames, axis=0))
+
+    def add_fov(self, fov):
+        """Match a new mean FOV and update the drift estimate
+
+        Parameters
+        ----------
+        fov : np.ndarray (2d)
+            mean FOV, cropped as the reference stack
+
+        Returns
+        -------
+        dict
+            segment index, matched plane, z-drift (um), peak correlation coefficient,
+            if the full stack was searched, and shift (y,x)
+        """
+        prev_match = self.matched_plane_indices[-1] if len(self.matched_plane_indices) > 0 else None
+        result, full_search = _register_segment_with_prior(
+            fov, self.prepared_ref, prev_match, self._ref_peak_cc,
+            use_valid_pix=self.use_valid_pix, search_window_flank=self.search_window_flank,
+            min_peak_cc_ratio=self.min_peak_cc_ratio)
+        _, cc, shifts = result
+        matched_plane = int(np.nanargmax(cc))
+        peak_cc = float(np.nanmax(cc))
+        if full_search:
+            self._ref_peak_cc = peak_cc
+        zdrift_um = self.z_step * (matched_plane - self.center_plane)
+
+        self.matched_plane_indices.append(matched_plane)
+        self.zdrift_um.append(zdrift_um)
+        self.peak_corrcoef.append(peak_cc)
+        self.full_search.append(full_search)
+        estimate = {'segment': len(self.zdrift_um) - 1,
+                    'matched_plane_index': matched_plane,
+                    'zdrift_um': zdrift_um,
+                    'peak_corrcoef': peak_cc,
+                    'full_search': full_search,
+                    'shift': shifts[matched_plane]}
+        if (self.on_drift is not None) and (abs(zdrift_um) > self.drift_threshold_um):
+            self.on_drift(estimate)
+        return estimate
+
+
+def benchmark_plane_search(fovs, prepared_ref, use_valid_pix=True, search_window_flank=5):
+    """Compare run time and matched planes of the full and the temporal-prior plane search
+
+    Parameters
+    ----------
+    fovs : np.ndarray (3d)
+        segment FOV images
+    prepared_ref : PreparedReferenceStack
+        prepared reference stack
+    use_valid_pix : bool, optional
+        If to use valid pixels to calculate correlation coefficient, by default True
+    search_window_flank : int, optional
+        Number of planes to search on each side of the previous match, by default 5
+
+    Returns
+    -------
+    dict
+        run times (s), speedup, number of fully searched segments,
+        and fraction of segments with the same matched plane
+    """
+    start_time = time.time()
+    full_cc = np.asarray([fov_stack_register_phase_correlation_batched(
+        fov, prepared_ref, use_valid_pix=use_valid_pix)[1] for fov in fovs])
+    full_time = time.time() - start_time
+
+    start_time = time.time()
+    _, prior_cc, _, full_search = register_segments_temporal_prior(
+        fovs, prepared_ref, use_valid_pix=use_valid_pix,
+        search_window_flank=search_window_flank)
+    prior_time = time.time() - start_time
+
+    return {'full_search_time': full_time,
+            'temporal_prior_time': prior_time,
+            'speedup': full_time / prior_time,
+            'num_full_search_segments': int(full_search.sum()),
+            'matched_plane_agreement': np.mean(np.nanargmax(full_cc, axis=1) ==
+                                               np.nanargmax(prior_cc, axis=1))}
+
+
+def batched_phase_cross_correlation(ref_fft_stack, moving_fft, plane_chunk_size=None):
+    """Phase cross-correlation of an image against each plane of a stack,
+    in the Fourier space, without normalization or upsampling
+    (same as skimage.registration.phase_cross_correlation with
+    space='fourier', normalization=None, upsample_factor=1)
+
+    Parameters
+    ----------
+    ref_fft_stack : np.ndarray (3d, complex)
+        FFT of each reference plane
+    moving_fft : np.ndarray (2d, complex)
+        FFT of the moving image
+    plane_chunk_size : int, optional
+        Number of planes to cross-correlate at a time, to limit memory, by default None (all)
+
+    Returns
+    -------
+    np.ndarray (2d)
+        shifts (y,x) for each plane, (n_planes, 2)
+    """
+    assert ref_fft_stack.shape[1:] == moving_fft.shape
+    num_planes = ref_fft_stack.shape[0]
+    shape = np.array(moving_fft.shape)
+    midpoints = np.fix(shape / 2)
+    if plane_chunk_size is None:
+        plane_chunk_size = num_planes
+
+    moving_conj = moving_fft.conj()
+    shifts = np.zeros((num_planes, 2))
+    for start in range(0, num_planes, plane_chunk_size):
+        end = min(num_planes, start + plane_chunk_size)
+        cross_correlation = scipy.fft.ifft2(ref_fft_stack[start:end] * moving_conj,
+                                            axes=(-2, -1))
+        maxima = np.argmax(np.abs(cross_correlation).reshape(end - start, -1), axis=1)
+        shifts[start:end] = np.stack(np.unravel_index(maxima, tuple(shape)), axis=1)
+    shifts = np.where(shifts > midpoints, shifts - shape, shifts)
+    return shifts
+
+
 def med_filt_z_stack(zstack, kernel_size=5):
     """Get z-stack with each plane median-filtered
 
@@ -327,7 +1222,7 @@ def plot_session_zdrift(result, ax=None, cc_threshold=0.65,
     else:
         fig = ax.get_figure()
     zdrift_um = result['zdrift_um']
-    max_cc = np.array([max(cc) for cc in result['corrcoef']])
+    max_cc = np.array([np.nanmax(cc) for cc in result['corrcoef']])
 
     # # test
     # max_cc = np.array([0.1, 0.2, 0.3, 0.4, 0.5, 0.65, 0.7, 0.8, 0.9, 0.95])
@@ -383,7 +1278,7 @@ def plot_shifts(result, ax=None):
     """
     if ax is None:
         fig, ax = plt.subplots(1, 1, figsize=(4, 3))
-    max_cc_inds = np.array([np.argmax(cc) for cc in result['corrcoef']])        
+    max_cc_inds = np.array([np.nanargmax(cc) for cc in result['corrcoef']])        
     shifts = [result['shift'][i][max_cc_inds[i]] for i in range(len(max_cc_inds))]
     y_shift = [shift[0] for shift in shifts]
     x_shift = [shift[1] for shift in shifts]
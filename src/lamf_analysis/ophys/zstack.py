@@ -22,6 +22,9 @@ from ScanImageTiffReader import ScanImageTiffReader
 from tifffile import TiffFile, imread, imsave, imwrite
 from tqdm import tqdm
 
+from lamf_analysis.ophys import scanimage_metadata as si_md
+from lamf_analysis.ophys.image_warp import CV2_INTERPOLATION, warp_stack_affine  # noqa: F401
+
 ####################################################################################################
 # Cortical stack
 ####################################################################################################
@@ -363,17 +366,19 @@ def register_cortical_stack(zstack_path: Union[Path, str],
     return output_dict
 
 
-def metadata_from_scanimage_tif(stack_path):
+def metadata_from_scanimage_tif(stack_path, sidecar_dir=None):
     """Extract metadata from ScanImage tiff stack
 
     Dev notes:
-    Seems awkward to parse this way
     Depends on ScanImageTiffReader
+    Parsed once per file and cached (see scanimage_metadata module)
 
     Parameters
     ----------
     stack_path : str
         Path to tiff stack
+    sidecar_dir : Union[Path, str], optional
+        Directory for the parsed metadata sidecar JSON, by default None (no sidecar)
 
     Returns
     -------
@@ -384,33 +389,9 @@ def metadata_from_scanimage_tif(stack_path):
     dict
         roi_groups_dict: 
     """
-    with ScanImageTiffReader(str(stack_path)) as reader:
-        md_string = reader.metadata()
-
-    # split si & roi groups, prep for seprate parse
-    s = md_string.split("\n{")
-    rg_str = "{" + s[1]
-    si_str = s[0]
-
-    # parse 1: extract keys and values, dump, then load again
-    si_metadata = _extract_dict_from_si_string(si_str)
-    # parse 2: json loads works hurray
-    roi_groups_dict = json.loads(rg_str)
-
-    stack_metadata = {}
-    stack_metadata['num_slices'] = int(si_metadata['SI.hStackManager.actualNumSlices'])
-    stack_metadata['num_volumes'] = int(si_metadata['SI.hStackManager.actualNumVolumes'])
-    stack_metadata['frames_per_slice'] = int(si_metadata['SI.hStackManager.framesPerSlice'])
-    # stack_metadata['z_steps'] = _str_to_int_list(si_metadata['SI.hStackManager.zs'])
-    stack_metadata['z_steps'] = _str_to_float_list(si_metadata['SI.hStackManager.zs'])
-    stack_metadata['actuator'] = si_metadata['SI.hStackManager.stackActuator']
-    # stack_metadata['num_channels'] = sum(_str_to_bool_list(si_metadata['SI.hPmts.powersOn']))
-    channels_saved = [ss for ss in re.split('\[|\]| ', si_metadata['SI.hChannels.channelSave']) if len(ss)>0]
-    channels_saved = [int(cs) for cs in channels_saved if str(int(cs)) == cs]
-    stack_metadata['num_channels'] = len(channels_saved) # TODO: need to check its validity in a larger batch of data
-    stack_metadata['channels_saved'] = channels_saved
-    # stack_metadata['z_step_size'] = int(si_metadata['SI.hStackManager.actualStackZStepSize'])
-    stack_metadata['z_step_size'] = float(si_metadata['SI.hStackManager.actualStackZStepSize'])
+    si_metadata = si_md.scanimage_metadata(stack_path, sidecar_dir=sidecar_dir)
+    roi_groups_dict = si_md.roi_groups_metadata(stack_path, sidecar_dir=sidecar_dir)
+    stack_metadata = si_md.stack_metadata_from_si(si_metadata)
 
     return stack_metadata, si_metadata, roi_groups_dict
 
@@ -449,17 +430,20 @@ def register_local_zstack_from_raw_tif(zstack_path: Union[Path, str]):
     np.ndarray (3D)
         within and between plane registered z-stack
     """
-    stack_metadata, _, _ = metadata_from_scanimage_tif(zstack_path)
+    # single open for both header (only the stack keys) and data
+    with ScanImageTiffReader(str(zstack_path)) as cz_reader:
+        si_metadata, _ = si_md.parse_scanimage_header(cz_reader.metadata(),
+                                                      keys=si_md.STACK_METADATA_KEYS,
+                                                      parse_roi_groups=False)
+        total_num_frames = cz_reader.shape()[0]
+        data = cz_reader.data()
+    stack_metadata = si_md.stack_metadata_from_si(si_metadata)
     num_slices = stack_metadata['num_slices']
     num_volumes = stack_metadata['num_volumes']
     num_channels = stack_metadata['num_channels'] # TODO: need to check its validity in a larger batch of data
     channels_saved = stack_metadata['channels_saved']
-
-    cz_reader = ScanImageTiffReader(str(zstack_path))
-    total_num_frames = cz_reader.shape()[0]
     assert total_num_frames == num_slices * num_volumes * num_channels
 
-    data = cz_reader.data()
     if num_channels == 1:
         zstack_reg = _register_stack(data, total_num_frames, num_slices)
     elif num_channels > 0:
@@ -473,7 +457,7 @@ def register_local_zstack_from_raw_tif(zstack_path: Union[Path, str]):
 
     return zstack_reg, channels_saved
 
-def decrosstalk_zstack(raw_path, processed_path, opid, paired_opid):
+def decrosstalk_zstack(raw_path, processed_path, opid, paired_opid, chunk_size=32):
     ''' Decrosstalk a local z-stack using the alpha and beta values from the processing json file
 
     Parameters
@@ -486,39 +470,141 @@ def decrosstalk_zstack(raw_path, processed_path, opid, paired_opid):
         Ophys plane ID
     paired_opid : int
         Ophys plane ID of the paired plane
-
+    chunk_size : int, optional
+        Number of frames to unmix at a time, by default 32
 
     Returns
     -------
     np.ndarray
-        Decrosstalked z-stack
+        Decrosstalked z-stack (float32)
     '''
     plane_path = processed_path / str(opid)
 
-    # get local z-stack fn
-    # TODO: Use file paths information    
-    local_zstack_fn = raw_path / 'pophys' / f'ophys_experiment_{opid}' / f'{opid}_z_stack_local.h5'
-    # get paired z-stack fn
-    # TODO: Use file paths information
-    paired_zstack_fn = raw_path / 'pophys' / f'ophys_experiment_{paired_opid}' / f'{paired_opid}_z_stack_local.h5'
-
     # Decrosstalk using alpha and beta from the opid
     json_fn = plane_path / 'decrosstalk/processing.json'
     alpha, beta = get_alpha_beta_from_json(json_fn)
-    
-    with h5py.File(local_zstack_fn, 'r') as f:
-        local_zstack = f['data'][:]
-    with h5py.File(paired_zstack_fn, 'r') as f:
-        paired_zstack = f['data'][:]
-    decrosstalked_zstack = np.zeros(local_zstack.shape)
-    for zi in range(local_zstack.shape[0]):
-        zplane = local_zstack[zi]
-        paired_zplane = paired_zstack[zi]
-        decrosstalked_plane, _ = apply_mixing_matrix(alpha, beta, zplane, paired_zplane)
-        decrosstalked_zstack[zi] = decrosstalked_plane
+
+    with h5py.File(_local_zstack_fn(raw_path, opid), 'r') as f, \
+         h5py.File(_local_zstack_fn(raw_path, paired_opid), 'r') as pf:
+        decrosstalked_zstack, _ = unmix_stack_pair(f['data'], pf['data'], alpha, beta,
+                                                   signal_only=True, chunk_size=chunk_size)
     return decrosstalked_zstack
 
 
+def decrosstalk_zstack_pair(raw_path, processed_path, opid, paired_opid, chunk_size=32):
+    ''' Decrosstalk both local z-stacks of a plane pair in one pass
+    Each z-stack is read once. Each plane is unmixed with its own alpha and beta,
+    so the results are the same as decrosstalk_zstack for opid and for paired_opid.
+
+    Parameters
+    ----------
+    raw_path : Path
+        Path to the raw data directory
+    processed_path : Path
+        Path to the processed data directory
+    opid : int
+        Ophys plane ID
+    paired_opid : int
+        Ophys plane ID of the paired plane
+    chunk_size : int, optional
+        Number of frames to unmix at a time, by default 32
+
+    Returns
+    -------
+    np.ndarray
+        Decrosstalked z-stack of opid (float32)
+    np.ndarray
+        Decrosstalked z-stack of paired_opid (float32)
+    '''
+    alpha, beta = get_alpha_beta_from_json(
+        processed_path / str(opid) / 'decrosstalk/processing.json')
+    paired_alpha, paired_beta = get_alpha_beta_from_json(
+        processed_path / str(paired_opid) / 'decrosstalk/processing.json')
+
+    with h5py.File(_local_zstack_fn(raw_path, opid), 'r') as f, \
+         h5py.File(_local_zstack_fn(raw_path, paired_opid), 'r') as pf:
+        decrosstalked_zstack, paired_decrosstalked_zstack = unmix_stack_pair(
+            f['data'], pf['data'], alpha, beta,
+            paired_alpha_beta=(paired_alpha, paired_beta), chunk_size=chunk_size)
+    return decrosstalked_zstack, paired_decrosstalked_zstack
+
+
+def _local_zstack_fn(raw_path, opid):
+    # TODO: Use file paths information
+    return Path(raw_path) / 'pophys' / f'ophys_experiment_{opid}' / f'{opid}_z_stack_local.h5'
+
+
+def get_unmixing_matrix(alpha, beta):
+    """Inverse of the mixing matrix [[1-alpha, beta], [alpha, 1-beta]]"""
+    mixing_mat = [[1-alpha, beta], [alpha, 1-beta]]
+    return np.linalg.inv(mixing_mat)
+
+
+def unmix_stack_pair(signal_stack, paired_stack, alpha, beta,
+                     paired_alpha_beta=None, signal_only=False,
+                     chunk_size=32, dtype=np.float32):
+    """Apply the unmixing matrix to a pair of stacks, chunk by chunk
+    The unmixing matrix is inverted once. Stacks can be h5py datasets,
+    then only chunk_size frames of each are in memory as dtype at a time.
+
+    Parameters
+    ----------
+    signal_stack : np.ndarray or h5py.Dataset (3D)
+        stack of the signal plane
+    paired_stack : np.ndarray or h5py.Dataset (3D)
+        stack of the paired plane, same shape as signal_stack
+    alpha : float
+        alpha value of the unmixing matrix
+    beta : float
+        beta value of the unmixing matrix
+    paired_alpha_beta : tuple, optional
+        (alpha, beta) of the paired plane, by default None.
+        If given, the paired stack is reconstructed with its own unmixing matrix
+        (as if it was the signal plane). Otherwise, the second row of the
+        signal plane unmixing matrix is used (same as apply_mixing_matrix).
+    signal_only : bool, optional
+        If to reconstruct the signal stack only, by default False
+    chunk_size : int, optional
+        Number of frames to unmix at a time, by default 32
+    dtype : np.dtype, optional
+        output data type, by default np.float32
+
+    Returns
+    -------
+    np.ndarray (3D)
+        reconstructed signal stack
+    np.ndarray (3D) or None
+        reconstructed paired stack, None if signal_only
+    """
+    assert signal_stack.shape == paired_stack.shape
+    unmixing_mat = get_unmixing_matrix(alpha, beta)
+    # coefficients on (signal, paired) for each output
+    signal_coef = unmixing_mat[0].astype(dtype)
+    if paired_alpha_beta is None:
+        paired_coef = unmixing_mat[1].astype(dtype)
+    else:
+        # paired plane as the signal: its first row applies to (paired, signal)
+        paired_coef = get_unmixing_matrix(*paired_alpha_beta)[0][::-1].astype(dtype)
+
+    num_frames = signal_stack.shape[0]
+    recon_signal = np.empty(signal_stack.shape, dtype=dtype)
+    recon_paired = None if signal_only else np.empty(paired_stack.shape, dtype=dtype)
+    for start in range(0, num_frames, chunk_size):
+        end = min(num_frames, start + chunk_size)
+        signal_chunk = np.asarray(signal_stack[start:end], dtype=dtype)
+        paired_chunk = np.asarray(paired_stack[start:end], dtype=dtype)
+        _weighted_sum(signal_chunk, paired_chunk, signal_coef, recon_signal[start:end])
+        if not signal_only:
+            _weighted_sum(signal_chunk, paired_chunk, paired_coef, recon_paired[start:end])
+    return recon_signal, recon_paired
+
+
+def _weighted_sum(signal_chunk, paired_chunk, coef, out):
+    # out = coef[0] * signal + coef[1] * paired, without full-size temporaries
+    np.multiply(signal_chunk, coef[0], out=out)
+    out += coef[1] * paired_chunk
+
+
 # (Potentially) Redundant function from decrosstalk module
 def get_alpha_beta_from_json(json_fn):
     with open(json_fn, 'r') as h:
@@ -551,8 +637,7 @@ def apply_mixing_matrix(alpha, beta, signal_mean, paired_mean):
     recon_paired : np.array
         reconstructed paired image
     """
-    mixing_mat = [[1-alpha, beta], [alpha, 1-beta]]
-    unmixing_mat = np.linalg.inv(mixing_mat)
+    unmixing_mat = get_unmixing_matrix(alpha, beta)
     raw_data = np.vstack([signal_mean.ravel(), paired_mean.ravel()])
     recon_data = np.dot(unmixing_mat, raw_data)
     recon_signal = recon_data[0, :].reshape(signal_mean.shape)
@@ -582,7 +667,9 @@ def register_local_z_stack(zstack_path, local_z_stack=None):
     """
     try:
         # TODO: metadata missing from old files? (04/2024)
-        si_metadata, roi_groups = local_zstack_metadata(zstack_path)
+        si_metadata = si_md.scanimage_metadata(zstack_path,
+                                               keys=['SI.hStackManager.actualNumSlices',
+                                                     'SI.hStackManager.actualNumVolumes'])
         number_of_z_planes= int(si_metadata['SI.hStackManager.actualNumSlices'])
         number_of_repeats = int(si_metadata['SI.hStackManager.actualNumVolumes'])
 
@@ -619,6 +706,7 @@ def register_local_z_stack(zstack_path, local_z_stack=None):
 # TODO: remove if not used
 def local_zstack_metadata(zstack_path: Union[Path, str]) -> tuple:
     """Get scanimage metadata and ROI groups from a local z-stack
+    Parsed once per file and cached (see scanimage_metadata module)
 
     Parameters
     ----------
@@ -629,16 +717,11 @@ def local_zstack_metadata(zstack_path: Union[Path, str]) -> tuple:
     -------
     dict
         Scanimage metadata
+    dict
+        ROI groups
     """
-    zstack_path = Path(zstack_path)
-    with h5py.File(zstack_path, 'r') as f:
-        if 'scanimage_metadata' not in f:
-            raise ValueError("scanimage_metadata not found in the h5 file")
-        si = f["scanimage_metadata"][()]
-    si = si.decode()
-    si = json.loads(si)
-    scanimage_metadata = si[0]
-    roi_groups = si[1]
+    scanimage_metadata = si_md.scanimage_metadata(zstack_path)
+    roi_groups = si_md.roi_groups_metadata(zstack_path)
     return scanimage_metadata, roi_groups
 
 
@@ -675,6 +758,101 @@ def calculate_valid_pix(img1, img2, valid_pix_threshold=1e-3):
     return valid_y, valid_x
 
 
+def masked_corrcoef(fovs, stack, masks=None):
+    """Correlation coefficients between FOV(s) and every plane of a stack,
+    using only the valid pixels of each FOV, in one set of matrix operations.
+    Same as np.corrcoef(stack[pi][mask], fov[mask])[0, 1] for each FOV and plane.
+    NaN for empty masks, and for FOVs or planes constant within the mask.
+
+    Parameters
+    ----------
+    fovs : np.ndarray (2D or 3D)
+        FOV image (y, x) or images (n_fovs, y, x)
+    stack : np.ndarray (3D)
+        stack images (n_planes, y, x)
+    masks : np.ndarray (2D or 3D, bool), optional
+        valid pixels of each FOV, same shape as fovs, by default None (all pixels)
+
+    Returns
+    -------
+    np.ndarray (1D or 2D)
+        correlation coefficients, (n_planes,) or (n_fovs, n_planes)
+    """
+    single_fov = fovs.ndim == 2
+    fovs = fovs.reshape(-1, fovs.shape[-2] * fovs.shape[-1]).astype(np.float64)
+    stack = stack.reshape(stack.shape[0], -1).astype(np.float64)
+    assert fovs.shape[1] == stack.shape[1]
+    if masks is None:
+        masks = np.ones(fovs.shape, dtype=np.float64)
+    else:
+        masks = masks.reshape(fovs.shape).astype(np.float64)
+
+    # centering each plane does not change correlation, but keeps the sums small
+    stack -= stack.mean(axis=1, keepdims=True)
+    num_pix = masks.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fovs_centered = (fovs - ((fovs * masks).sum(axis=1) / num_pix)[:, None]) * masks
+        cov = fovs_centered @ stack.T
+        fov_ss = np.square(fovs_centered).sum(axis=1)
+        fov_ss[fov_ss <= 1e-12 * (np.square(fovs) * masks).sum(axis=1)] = np.nan
+        stack_sum = masks @ stack.T
+        stack_sq_sum = masks @ np.square(stack).T
+        stack_ss = stack_sq_sum - np.square(stack_sum) / num_pix[:, None]
+        # constant within the mask: the sum of squares is only rounding error
+        stack_ss[stack_ss <= 1e-12 * stack_sq_sum] = np.nan
+        corrcoef_arr = cov / np.sqrt(fov_ss[:, None] * stack_ss)
+    return corrcoef_arr[0] if single_fov else corrcoef_arr
+
+
+def paired_masked_corrcoef(images_1, images_2, masks=None):
+    """Correlation coefficient between each pair of images (images_1[i], images_2[i]),
+    using only the valid pixels of each pair, vectorized over pairs.
+    Same as np.corrcoef(images_1[i][masks[i]], images_2[i][masks[i]])[0, 1] for each i.
+    NaN for empty masks, and for images constant within the mask.
+
+    Parameters
+    ----------
+    images_1 : np.ndarray (3D)
+        images (n_pairs, y, x)
+    images_2 : np.ndarray (3D)
+        images (n_pairs, y, x)
+    masks : np.ndarray (3D, bool), optional
+        valid pixels of each pair, same shape as images, by default None (all pixels)
+
+    Returns
+    -------
+    np.ndarray (1D)
+        correlation coefficients, (n_pairs,)
+    """
+    assert images_1.shape == images_2.shape
+    num_pairs = images_1.shape[0]
+    images_1 = images_1.reshape(num_pairs, -1).astype(np.float64)
+    images_2 = images_2.reshape(num_pairs, -1).astype(np.float64)
+    if masks is None:
+        masks = np.ones(images_1.shape, dtype=bool)
+    else:
+        masks = masks.reshape(num_pairs, -1)
+    num_pix = masks.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centered_1 = images_1 - (np.where(masks, images_1, 0).sum(axis=1) / num_pix)[:, None]
+        centered_1[~masks] = 0
+        centered_2 = images_2 - (np.where(masks, images_2, 0).sum(axis=1) / num_pix)[:, None]
+        centered_2[~masks] = 0
+        cov = np.einsum('ij,ij->i', centered_1, centered_2)
+        ss_1 = _masked_sum_of_squares(centered_1, images_1, masks)
+        ss_2 = _masked_sum_of_squares(centered_2, images_2, masks)
+        return cov / np.sqrt(ss_1 * ss_2)
+
+
+def _masked_sum_of_squares(centered, images, masks):
+    """Sum of squares of the centered images, NaN if constant within the mask
+    (the sum of squares is then only rounding error of the mean)"""
+    sum_of_squares = np.einsum('ij,ij->i', centered, centered)
+    sum_of_squares[sum_of_squares <= 1e-12 * np.where(masks, np.square(images), 0).sum(axis=1)] = np.nan
+    return sum_of_squares
+
+
 def im_blend(image, overlay, alpha):
     """Blend two images to show match or discrepancy
 
@@ -812,28 +990,6 @@ def get_cortical_stack_paths(specimen_folder):
     return cz_paths
 
 
-def _extract_dict_from_si_string(string):
-    """Parse the 'SI' variables from a scanimage metadata string"""
-
-    lines = string.split('\n')
-    data_dict = {}
-    for line in lines:
-        if line.strip():  # Check if the line is not empty
-            key, value = line.split(' = ')
-            key = key.strip()
-            if value.strip() == 'true':
-                value = True
-            elif value.strip() == 'false':
-                value = False
-            else:
-                value = value.strip().strip("'")  # Remove leading/trailing whitespace and single quotes
-            data_dict[key] = value
-
-    json_data = json.dumps(data_dict, indent=2)
-    loaded_data_dict = json.loads(json_data)
-    return loaded_data_dict
-
-
 def _str_to_int_list(string):
     return [int(s) for s in string.strip('[]').split()]
 
@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from lamf_analysis.ophys import zstack
+
+
+SHAPE = (24, 20)
+
+
+def _reference_corrcoef(image_1, image_2, mask):
+    """np.corrcoef on the masked pixels (np.where mask subset), NaN for < 2 pixels or constant"""
+    inds = np.where(mask)
+    if len(inds[0]) < 2:
+        return np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.corrcoef(image_1[inds], image_2[inds])[0, 1]
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def stack(rng):
+    return rng.normal(100, 20, (7, *SHAPE))
+
+
+@pytest.fixture
+def fovs(rng, stack):
+    # correlated with some of the planes, so the coefficients span a range
+    return stack[[1, 3, 5]] + rng.normal(0, 15, (3, *SHAPE))
+
+
+####################################################################################################
+# masked_corrcoef
+####################################################################################################
+
+@pytest.mark.parametrize('mask_fraction', [0.1, 0.5, 0.9])
+def test_masked_corrcoef_random_masks(rng, fovs, stack, mask_fraction):
+    masks = rng.random(fovs.shape) < mask_fraction
+    corrcoef = zstack.masked_corrcoef(fovs, stack, masks)
+    assert corrcoef.shape == (fovs.shape[0], stack.shape[0])
+    for fi in range(fovs.shape[0]):
+        for pi in range(stack.shape[0]):
+            expected = _reference_corrcoef(stack[pi], fovs[fi], masks[fi])
+            np.testing.assert_allclose(corrcoef[fi, pi], expected, rtol=1e-10, atol=1e-12)
+
+
+def test_masked_corrcoef_all_true_mask(fovs, stack):
+    masks = np.ones(fovs.shape, dtype=bool)
+    corrcoef = zstack.masked_corrcoef(fovs, stack, masks)
+    np.testing.assert_allclose(corrcoef, zstack.masked_corrcoef(fovs, stack), rtol=1e-12)
+    for fi in range(fovs.shape[0]):
+        for pi in range(stack.shape[0]):
+            expected = np.corrcoef(stack[pi].ravel(), fovs[fi].ravel())[0, 1]
+            np.testing.assert_allclose(corrcoef[fi, pi], expected, rtol=1e-10, atol=1e-12)
+
+
+def test_masked_corrcoef_single_fov(rng, fovs, stack):
+    mask = rng.random(SHAPE) < 0.5
+    np.testing.assert_allclose(zstack.masked_corrcoef(fovs[0], stack, mask),
+                               zstack.masked_corrcoef(fovs[:1], stack, mask[None])[0], rtol=1e-12)
+
+
+def test_masked_corrcoef_empty_mask_is_nan(fovs, stack):
+    masks = np.zeros(fovs.shape, dtype=bool)
+    assert np.all(np.isnan(zstack.masked_corrcoef(fovs, stack, masks)))
+
+
+@pytest.mark.parametrize('value', [50.0, 0.1, 1e5 / 3])
+def test_masked_corrcoef_constant_fov_is_nan(rng, stack, value):
+    fov = np.full(SHAPE, value)
+    mask = rng.random(SHAPE) < 0.37
+    assert np.all(np.isnan(zstack.masked_corrcoef(fov, stack, mask)))
+
+
+def test_masked_corrcoef_constant_plane_in_mask_is_nan(rng, fovs, stack):
+    stack = stack.copy()
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[4:12, 3:9] = True
+    stack[2][mask] = 123.4
+    corrcoef = zstack.masked_corrcoef(fovs[0], stack, mask)
+    assert np.isnan(corrcoef[2])
+    assert np.all(np.isfinite(np.delete(corrcoef, 2)))
+
+
+####################################################################################################
+# paired_masked_corrcoef
+####################################################################################################
+
+@pytest.mark.parametrize('mask_fraction', [0.1, 0.5, 0.9])
+def test_paired_masked_corrcoef_random_masks(rng, stack, mask_fraction):
+    images_2 = stack + rng.normal(0, 15, stack.shape)
+    masks = rng.random(stack.shape) < mask_fraction
+    corrcoef = zstack.paired_masked_corrcoef(stack, images_2, masks)
+    assert corrcoef.shape == (stack.shape[0],)
+    for i in range(stack.shape[0]):
+        expected = _reference_corrcoef(stack[i], images_2[i], masks[i])
+        np.testing.assert_allclose(corrcoef[i], expected, rtol=1e-10, atol=1e-12)
+
+
+def test_paired_masked_corrcoef_all_true_mask(rng, stack):
+    images_2 = stack + rng.normal(0, 15, stack.shape)
+    masks = np.ones(stack.shape, dtype=bool)
+    corrcoef = zstack.paired_masked_corrcoef(stack, images_2, masks)
+    np.testing.assert_allclose(corrcoef, zstack.paired_masked_corrcoef(stack, images_2), rtol=1e-12)
+    for i in range(stack.shape[0]):
+        expected = np.corrcoef(stack[i].ravel(), images_2[i].ravel())[0, 1]
+        np.testing.assert_allclose(corrcoef[i], expected, rtol=1e-10, atol=1e-12)
+
+
+def test_paired_masked_corrcoef_empty_and_constant_are_nan(rng, stack):
+    images_2 = stack + rng.normal(0, 15, stack.shape)
+    masks = rng.random(stack.shape) < 0.5
+    masks[0] = False  # empty mask
+    images_2[1] = 0.1  # constant image (mean not exact in floating point)
+    stack = stack.copy()
+    stack[2][masks[2]] = 3.0  # constant within the mask
+    corrcoef = zstack.paired_masked_corrcoef(stack, images_2, masks)
+    assert np.all(np.isnan(corrcoef[:3]))
+    assert np.all(np.isfinite(corrcoef[3:]))